@@ -0,0 +1,361 @@
+# coding=utf-8
+"""Admission control: whether this host has room for one more grading container, and if not, when.
+
+Without it an executor takes whatever core sends until gunicorn runs out of workers, and after that
+requests wait in the socket backlog where nobody can see them. Core has no way to tell a saturated
+executor from a slow one, so it keeps sending to both. With it, an executor that is full says so at
+once — 429, and a `Retry-After` estimating when it will not be — and core can send the work elsewhere.
+
+### What counts as full
+
+Two budgets, both for the host rather than the process:
+
+- **Memory.** The sum of `max_mem_mb` over the containers running now, against the host's RAM less
+  a reserve for the daemon, the executor and the kernel. What is counted is the limit, not what a
+  container happens to use: a limit is a promise that the container may use that much, and admitting
+  on current use is how a host ends up with every container at its limit at once and the OOM killer
+  choosing which student's submission dies.
+- **Containers.** At most `ADMISSION_MAX_CONTAINERS`, by default one per CPU. Grading is CPU-bound,
+  and a second container per core makes both slower without grading more per second — it only turns
+  the time limit into a lottery.
+
+### Where the state lives
+
+Every gunicorn worker admits, so the count has to be shared: each admitted run holds a **lease**, a
+small file in a directory every worker can see, and an admission decision is made under an exclusive
+`flock` on that directory, so two workers cannot both take the last slot. A lease records its size,
+when it started and its time limit.
+
+A lease is removed when its run ends. One left behind by a process that died is recognised by its
+pid, and one that has outlived its time limit by `ADMISSION_LEASE_GRACE_SEC` is ignored — its
+container was killed long ago, whatever happened to the file.
+
+### Which cores
+
+With `ADMISSION_CPU_PINNING` on, admission also chooses the cores a run is pinned to, since it is the
+one place that sees every container on the host: each lease records its cpuset, and a new run gets the
+`ceil(cpus)` cores with the fewest leases on them, lowest-numbered first among equals. That keeps
+containers apart while there are idle cores, and spreads them evenly once there are not. Off by
+default: the quota alone stops one container taking the host, and pinning trades the kernel's own
+balancing for ours, which is only better when runs are long and evenly sized.
+
+Pinning does not need admission on. With admission off and pinning on, a run still takes a lease, so
+that the next one can see its cores, but nothing is ever refused for want of room.
+
+### Retry-After
+
+An estimate, made from the leases: each is expected to end after as long as runs on this process have
+recently taken (the median), or at its time limit if that is sooner, or at its time limit if it has
+already overrun the median. Walking those in order of expected end, the answer is the first moment
+enough would have ended to fit the request. Clamped to `ADMISSION_MAX_RETRY_AFTER_SEC`: the estimate
+is only as good as the median, and telling core to stay away for ten minutes on the strength of one
+slow exercise would be worse than asking it to check again.
+
+### Slots in this process
+
+The leases count containers on the host. Separately, each process has `ADMISSION_PROCESS_SLOTS`
+slots, and a run takes one before it asks for a lease. Under sync gunicorn workers that changes
+nothing, because a worker grades one request at a time. It matters when the executor runs as one
+process with many threads (`gunicorn-threads-conf.py.sample`). Then the threads, not the processes,
+set how many requests arrive at once. The slots keep how many of them can be grading at once to what
+the host can run, and the rest wait here, in memory, rather than polling the lease directory.
+A thread that runs out of `wait_sec` waiting for a slot is told Saturated, like one that finds the
+host full. Its Retry-After is the typical run length, since that is when a slot next frees up. With
+admission off the slots still apply, but a thread waits for one however long it takes.
+
+### Off by default
+
+`EASY_ADMISSION=1` turns it on. Core does not yet retry a request answered 429, here or on another
+executor, so on a busy host admission would turn a slow grade into a lost one. Until it does, the
+executor keeps its old behaviour and nothing here answers 429.
+"""
+import collections
+import contextlib
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+import uuid
+from time import time
+
+ADMISSION_ENABLED = os.environ.get("EASY_ADMISSION", "0") == "1"
+ADMISSION_DIR = os.environ.get("EASY_ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "easy-admission"))
+# Left for everything that is not a grading container.
+ADMISSION_RESERVE_MB = int(os.environ.get("EASY_ADMISSION_RESERVE_MB", "1024"))
+# The memory budget. 0 derives it from the host: MemTotal less the reserve.
+ADMISSION_MEM_MB = int(os.environ.get("EASY_ADMISSION_MEM_MB", "0"))
+ADMISSION_MAX_CONTAINERS = int(os.environ.get("EASY_ADMISSION_MAX_CONTAINERS", "0")) or (os.cpu_count() or 1)
+# How long past its time limit a lease still counts. Covers preparing the exercise image and removing
+# the container, which the time limit does not.
+ADMISSION_LEASE_GRACE_SEC = 5 * 60
+ADMISSION_MAX_RETRY_AFTER_SEC = 60
+# How long a job waits for room before giving up. A job was accepted to be queued, so this is long.
+ADMISSION_JOB_WAIT_SEC = 10 * 60
+ADMISSION_POLL_SEC = 0.5
+ADMISSION_CPU_PINNING = os.environ.get("EASY_CPU_PINNING", "0") == "1"
+# Runs this process grades at once, whatever admission says about the host. 0 for one per container
+# the host may run.
+ADMISSION_PROCESS_SLOTS = int(os.environ.get("EASY_PROCESS_SLOTS", "0")) or ADMISSION_MAX_CONTAINERS
+
+# Recent run durations on this process, for the Retry-After estimate.
+_durations = collections.deque(maxlen=100)
+_durations_lock = threading.Lock()
+
+_slots_taken = 0
+_slots_cond = threading.Condition()
+
+
+class Saturated(Exception):
+    """No room for the run. `retry_after` is whole seconds until there probably is."""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+@contextlib.contextmanager
+def lease(mem_mb, max_time_sec, wait_sec=0, cpus=1):
+    """
+    Holds room for one grading run for as long as the block runs, and gives the block the cpuset the
+    run is pinned to: a string for Docker's `cpuset_cpus`, or None when pinning is off.
+
+    Raises Saturated if there is no room, after waiting up to `wait_sec` for some. A block that raises
+    still gives the room back. The wait covers both the slot in this process and the lease on the host.
+    """
+    deadline = time() + wait_sec
+    # Off, nothing may answer 429: a run waits for its slot for as long as it takes.
+    _take_slot(deadline if ADMISSION_ENABLED else None)
+    try:
+        if not ADMISSION_ENABLED and not ADMISSION_CPU_PINNING:
+            yield None
+            return
+
+        while True:
+            try:
+                path, cpuset = _admit(mem_mb, max_time_sec, cpus)
+                break
+            except Saturated:
+                if time() >= deadline:
+                    raise
+                threading.Event().wait(min(ADMISSION_POLL_SEC, max(deadline - time(), 0)))
+
+        started = time()
+        try:
+            yield cpuset
+        finally:
+            with _durations_lock:
+                _durations.append(time() - started)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    finally:
+        _give_slot()
+
+
+def _take_slot(deadline):
+    global _slots_taken
+    with _slots_cond:
+        while _slots_taken >= ADMISSION_PROCESS_SLOTS:
+            if deadline is None:
+                _slots_cond.wait()
+                continue
+            left = deadline - time()
+            if left <= 0:
+                typical = _typical_duration()
+                retry_after = int(min(max(math.ceil(typical or 1), 1), ADMISSION_MAX_RETRY_AFTER_SEC))
+                raise Saturated(retry_after, "all {} grading slots of this process are taken".format(
+                    ADMISSION_PROCESS_SLOTS))
+            _slots_cond.wait(left)
+        _slots_taken += 1
+
+
+def _give_slot():
+    global _slots_taken
+    with _slots_cond:
+        _slots_taken -= 1
+        _slots_cond.notify()
+
+
+def check(mem_mb, max_time_sec):
+    """Raises Saturated if a run of this size would not be admitted now. Holds nothing."""
+    if not ADMISSION_ENABLED:
+        return
+    with _decision_lock():
+        _refuse_if_full(_live_leases(), int(mem_mb), int(max_time_sec))
+
+
+def _admit(mem_mb, max_time_sec, cpus):
+    mem_mb, max_time_sec = int(mem_mb), int(max_time_sec)
+    with _decision_lock():
+        leases = _live_leases()
+        if ADMISSION_ENABLED:
+            _refuse_if_full(leases, mem_mb, max_time_sec)
+        cpuset = _choose_cpuset(leases, cpus) if ADMISSION_CPU_PINNING else None
+        path = os.path.join(ADMISSION_DIR, "{}-{}.lease".format(os.getpid(), uuid.uuid4().hex))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "mem_mb": mem_mb, "max_time_sec": max_time_sec, "start": time(),
+                       "cpus": cpus, "cpuset": cpuset}, f)
+        return path, cpuset
+
+
+def _choose_cpuset(leases, cpus):
+    """The `ceil(cpus)` least used cores, as Docker writes a cpuset. None if there is nothing to choose."""
+    cores = host_cores()
+    if not cores:
+        return None
+    load = dict.fromkeys(cores, 0)
+    for lease in leases:
+        for core in _cores_of(lease.get("cpuset")):
+            if core in load:
+                load[core] += 1
+    wanted = min(max(math.ceil(cpus or len(cores)), 1), len(cores))
+    chosen = sorted(cores, key=lambda core: (load[core], core))[:wanted]
+    return ",".join(str(core) for core in sorted(chosen))
+
+
+def _cores_of(cpuset):
+    return [int(core) for core in cpuset.split(",")] if cpuset else []
+
+
+def host_cores():
+    """The cores this executor may schedule onto: its own affinity, which systemd may have narrowed."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return list(range(os.cpu_count() or 1))
+
+
+def _refuse_if_full(leases, mem_mb, max_time_sec):
+    mem_budget = memory_budget_mb()
+    # A run bigger than the whole budget is admitted on an otherwise empty host rather than never.
+    mem_mb = min(mem_mb, mem_budget) if mem_budget else 0
+    used_mb = sum(lease["mem_mb"] for lease in leases)
+
+    if len(leases) < ADMISSION_MAX_CONTAINERS and (not mem_budget or used_mb + mem_mb <= mem_budget):
+        return
+
+    reason = "{} of {} containers running, {} of {} MB promised".format(
+        len(leases), ADMISSION_MAX_CONTAINERS, used_mb, mem_budget)
+    raise Saturated(_retry_after(leases, mem_mb, mem_budget), reason)
+
+
+def _retry_after(leases, mem_mb, mem_budget):
+    now = time()
+    typical = _typical_duration()
+    ends = []
+    for lease in leases:
+        limit = lease["start"] + lease["max_time_sec"]
+        expected = lease["start"] + typical if typical is not None else limit
+        ends.append((min(expected, limit) if expected > now else limit, lease["mem_mb"]))
+
+    count = len(leases)
+    used_mb = sum(mem for _, mem in ends)
+    for end, mem in sorted(ends):
+        count -= 1
+        used_mb -= mem
+        if count < ADMISSION_MAX_CONTAINERS and (not mem_budget or used_mb + mem_mb <= mem_budget):
+            return int(min(max(math.ceil(end - now), 1), ADMISSION_MAX_RETRY_AFTER_SEC))
+    return ADMISSION_MAX_RETRY_AFTER_SEC
+
+
+def _typical_duration():
+    with _durations_lock:
+        durations = sorted(_durations)
+    return durations[len(durations) // 2] if durations else None
+
+
+def memory_budget_mb():
+    """The memory grading containers may be promised on this host, in MB. 0 means unknown: no limit."""
+    if ADMISSION_MEM_MB:
+        return ADMISSION_MEM_MB
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    # At least 1, so a host smaller than the reserve grades one at a time rather than
+                    # reading as "unknown" and admitting everything.
+                    return max(int(line.split()[1]) // 1024 - ADMISSION_RESERVE_MB, 1)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+@contextlib.contextmanager
+def _decision_lock():
+    os.makedirs(ADMISSION_DIR, exist_ok=True)
+    with open(os.path.join(ADMISSION_DIR, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _live_leases():
+    """The leases that still count, removing the ones that do not. Called under the decision lock."""
+    leases = []
+    now = time()
+    for name in os.listdir(ADMISSION_DIR):
+        if not name.endswith(".lease"):
+            continue
+        path = os.path.join(ADMISSION_DIR, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                lease = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if pid_gone(lease.get("pid")) or now > lease["start"] + lease["max_time_sec"] + ADMISSION_LEASE_GRACE_SEC:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        leases.append(lease)
+    return leases
+
+
+def pid_gone(pid):
+    """
+    Whether the process `pid` (an int, or a string of one) has exited. Anything that is not a pid, or
+    a process this user may not signal, counts as alive: what cannot be checked is not cleaned up.
+    """
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, TypeError, ValueError):
+        return False
+    return False
+
+
+def admission_status():
+    """What is admitted on this host now, and the budgets it is admitted against."""
+    if not ADMISSION_ENABLED:
+        if not ADMISSION_CPU_PINNING:
+            return {"enabled": False}
+        # Pinning alone still leases every run, for its cores.
+        with _decision_lock():
+            leases = _live_leases()
+        return {"enabled": False, "cpu_pinning": True, "leases_per_core": _leases_per_core(leases)}
+    with _decision_lock():
+        leases = _live_leases()
+    return {
+        "enabled": True,
+        "running": len(leases),
+        "max_containers": ADMISSION_MAX_CONTAINERS,
+        "mem_mb_promised": sum(lease["mem_mb"] for lease in leases),
+        "mem_mb_budget": memory_budget_mb(),
+        "typical_duration_sec": _typical_duration(),
+        "cpu_pinning": ADMISSION_CPU_PINNING,
+        "leases_per_core": _leases_per_core(leases) if ADMISSION_CPU_PINNING else None,
+        "process_slots": ADMISSION_PROCESS_SLOTS,
+        "process_slots_taken": _slots_taken,
+    }
+
+
+def _leases_per_core(leases):
+    load = {str(core): 0 for core in host_cores()}
+    for lease in leases:
+        for core in _cores_of(lease.get("cpuset")):
+            load[str(core)] = load.get(str(core), 0) + 1
+    return load
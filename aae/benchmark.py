@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""Measures what the executor itself costs per submission, with Docker replaced by a fake that only waits.
+
+    python3 benchmark.py                          # every scenario, a table on stdout
+    python3 benchmark.py --json bench.json        # and the numbers, for keeping
+    python3 benchmark.py --latency create=40 --latency start=120 --concurrency 4
+    python3 benchmark.py --baseline bench.json    # exit 1 if p50 got worse than --tolerance
+
+A real grading run is dominated by Docker — creating, starting and removing a container take tens to
+hundreds of milliseconds — so a change that makes the executor's own work twice as slow disappears in
+the noise of any measurement made with Docker in it. Here Docker is an in-process fake whose every call
+does nothing but sleep for the latency it is configured with, zero by default. What remains is ours:
+Flask and JSON, the tar archive, admission, the result cache's bookkeeping, metrics and traces, the
+output capture and the parser.
+
+### Scenarios
+
+Each is run twice: through `server.py` — a `POST /v1/grade` on Flask's test client, which is the whole
+request path bar the socket and gunicorn — and by calling `containers.grade_submission` directly.
+
+- **small**: a one-line submission, no assets, a few lines of output. The common case.
+- **large_assets**: 20 assets of 25 KB, as a TSL exercise with data files sends them.
+- **huge_output**: 64 MB of output, which is the `while True: print()` that `OutputCapture` bounds.
+
+### What is reported
+
+Per scenario and target: requests per second, latency at p50/p90/p99 and the mean, the part of the
+mean that was the fake Docker's sleeping (so `overhead_ms` is ours), and from a separate, shorter
+pass under `tracemalloc` the peak memory allocated during one request and the blocks still held
+after it. `tracemalloc` makes everything slower, which is why it never runs during the timed pass.
+
+`--json` writes all of it with the configuration and the machine it ran on. Numbers are only
+comparable with numbers from the same machine; `--baseline` compares p50s against an earlier file.
+
+The executor's state — metrics, traces, leases, jobs — goes to a temporary directory, and the result
+and exercise caches are off: a benchmark that answered from the result cache would be measuring a
+dictionary lookup. Runs under pytest too (`tests/test_benchmark.py`, a few requests per scenario to
+prove it still works), where conftest does the isolating.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import trace_report
+
+# Fake Docker calls, and the milliseconds each takes unless --latency says otherwise.
+OPERATIONS = ("create", "put_archive", "start", "logs", "wait", "inspect", "kill", "remove")
+SCENARIOS = ("small", "large_assets", "huge_output")
+TARGETS = ("server", "containers")
+SEPARATOR = "#" * 50
+HUGE_OUTPUT_MB = 64
+OUTPUT_CHUNK_BYTES = 64 * 1024
+
+
+class FakeDocker:
+    """
+    `docker.from_env()` for the benchmark: every call sleeps for its configured latency and succeeds.
+
+    Records how long it slept, so the report can take Docker's share out of the latency.
+    """
+
+    def __init__(self, latency_ms, output):
+        self.latency = {name: latency_ms.get(name, 0.0) / 1000 for name in OPERATIONS}
+        self.output = output
+        self._slept = 0.0
+        self._lock = threading.Lock()
+        self.containers = _FakeContainers(self)
+
+    def wait_for(self, operation):
+        seconds = self.latency[operation]
+        if seconds:
+            time.sleep(seconds)
+            with self._lock:
+                self._slept += seconds
+
+    def slept(self):
+        with self._lock:
+            return self._slept
+
+
+class _FakeContainers:
+    def __init__(self, docker):
+        self.docker = docker
+
+    def create(self, image, **kwargs):
+        self.docker.wait_for("create")
+        return _FakeContainer(self.docker)
+
+
+class _FakeContainer:
+    short_id = "bench00"
+
+    def __init__(self, docker):
+        self.docker = docker
+
+    def update(self, **kwargs):
+        pass
+
+    def put_archive(self, path, data):
+        self.docker.wait_for("put_archive")
+        return True
+
+    def start(self):
+        self.docker.wait_for("start")
+
+    def logs(self, stream=False, follow=False):
+        self.docker.wait_for("logs")
+        return _OutputStream(self.docker.output)
+
+    def wait(self, timeout=None):
+        self.docker.wait_for("wait")
+        return {"StatusCode": 0}
+
+    def reload(self):
+        self.docker.wait_for("inspect")
+        self.attrs = {"State": {"OOMKilled": False, "ExitCode": 0}}
+
+    def kill(self):
+        self.docker.wait_for("kill")
+
+    def remove(self, force=False):
+        self.docker.wait_for("remove")
+
+
+class _OutputStream:
+    """A follow-mode log stream: the output in chunks, as the daemon hands it over."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def __iter__(self):
+        return iter(self.output())
+
+    def close(self):
+        pass
+
+
+def scenario(name):
+    """(request body, a callable giving the container's output in chunks) for a scenario."""
+    body = {
+        "submission": "print(input())",
+        "grading_script": "#!/bin/sh\npython3 /evaluate.py",
+        "assets": [],
+        "image_name": "python:3.12",
+        "max_time_sec": 30,
+        "max_mem_mb": 128,
+    }
+    feedback = "Test 1: OK\nTest 2: OK\n"
+    if name == "large_assets":
+        body["assets"] = [{"file_name": "data_{}.txt".format(n), "file_content": ("{} ".format(n) * 8192)[:25600]}
+                          for n in range(20)]
+    tail = "{}\n{}\ngrade: 100\n".format(feedback, SEPARATOR).encode()
+
+    if name == "huge_output":
+        line = b"still printing\n" * (OUTPUT_CHUNK_BYTES // 15)
+
+        def output():
+            for _ in range(HUGE_OUTPUT_MB * 1024 * 1024 // len(line)):
+                yield line
+            yield tail
+    else:
+        def output():
+            yield tail
+    return body, output
+
+
+def run_one(target, body, modules, client):
+    """One request. Raises if the answer is not the grade the fake output holds."""
+    server, containers = modules
+    if target == "server":
+        resp = client.post("/v1/grade", data=json.dumps(body), content_type="application/json")
+        if resp.status_code != 200 or resp.get_json()["grade"] != 100:
+            raise RuntimeError("unexpected answer {}: {}".format(resp.status_code, resp.get_data(as_text=True)[:200]))
+    else:
+        outcome, output = containers.grade_submission(
+            body["submission"], body["grading_script"], server.assets_to_tuples(body["assets"]), body["image_name"],
+            body["max_time_sec"], body["max_mem_mb"], _QuietLogger(), "bench")
+        if outcome.status != containers.RunStatus.SUCCESS or "grade: 100" not in output[-200:]:
+            raise RuntimeError("unexpected run: {}".format(outcome))
+
+
+def measure(target, scenario_name, requests, concurrency, latency_ms, alloc_requests, modules):
+    """The numbers for one scenario and target."""
+    server, containers = modules
+    body, output = scenario(scenario_name)
+    fake = FakeDocker(latency_ms, output)
+    original = containers.docker.from_env
+    containers.docker.from_env = lambda **kwargs: fake
+    try:
+        for _ in range(min(3, requests)):  # imports, first-use caches, the reaper thread
+            run_one(target, body, modules, server.app.test_client())
+        containers.drain_reaper(30)
+        slept_before = fake.slept()
+
+        latencies = []
+        lock = threading.Lock()
+        shares = [requests // concurrency + (1 if n < requests % concurrency else 0) for n in range(concurrency)]
+
+        def worker(count):
+            client = server.app.test_client()
+            for _ in range(count):
+                started = time.perf_counter()
+                run_one(target, body, modules, client)
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(count,)) for count in shares if count]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+        if len(latencies) != requests:
+            raise RuntimeError("{} of {} requests failed".format(requests - len(latencies), requests))
+        containers.drain_reaper(30)
+        # The removal runs on the reaper, off the request path; it is in the sleeping, not in a latency.
+        docker_ms = (fake.slept() - slept_before) * 1000 / requests - fake.latency["remove"] * 1000
+
+        peak, retained = allocations(target, body, modules, alloc_requests)
+    finally:
+        containers.docker.from_env = original
+
+    ms = sorted(1000 * s for s in latencies)
+    mean = statistics.fmean(ms)
+    return {
+        "scenario": scenario_name,
+        "target": target,
+        "requests": requests,
+        "concurrency": concurrency,
+        "rps": round(requests / wall, 1),
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p90_ms": round(percentile(ms, 90), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "mean_ms": round(mean, 3),
+        "docker_ms": round(docker_ms, 3),
+        "overhead_ms": round(mean - docker_ms, 3),
+        "peak_alloc_kib": round(peak / 1024, 1),
+        "retained_blocks": retained,
+    }
+
+
+def allocations(target, body, modules, count):
+    """(peak bytes allocated during a request, blocks still allocated after it), each the median of `count`."""
+    server, containers = modules
+    if count <= 0:
+        return 0, 0
+    client = server.app.test_client()
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            containers.drain_reaper(30)
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            blocks = sys.getallocatedblocks()
+            run_one(target, body, modules, client)
+            containers.drain_reaper(30)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+            retained.append(sys.getallocatedblocks() - blocks)
+    finally:
+        tracemalloc.stop()
+    return statistics.median(peaks), int(statistics.median(retained))
+
+
+def percentile(values, p):
+    # The same nearest rank as the trace report, so the two never disagree about what a p99 is.
+    return trace_report.percentile(values, p)
+
+
+class _QuietLogger:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def isolate(directory):
+    """
+    Points every piece of executor state at `directory`, and turns the caches off. Before the executor's
+    modules are imported, because they read their configuration once, at import.
+    """
+    settings = {
+        "EASY_METRICS_DIR": os.path.join(directory, "metrics"),
+        "EASY_TRACE_DIR": os.path.join(directory, "traces"),
+        "EASY_ADMISSION_DIR": os.path.join(directory, "admission"),
+        "EASY_ADMISSION_MAX_CONTAINERS": "1000",
+        "EASY_ADMISSION_MEM_MB": str(1000 * 1000),
+        "EASY_JOBS_DIR": os.path.join(directory, "jobs"),
+        "EASY_RESULT_CACHE_MB": "0",
+        "EASY_RESULT_CACHE_DIR": "",
+        "EASY_EXERCISE_CACHE_MB": "0",
+        "EASY_EXERCISE_CACHE_DIR": os.path.join(directory, "exercise-images"),
+        "EASY_ORPHAN_SWEEP_SEC": "0",
+        "EASY_ORPHAN_SWEEP_FILE": os.path.join(directory, "orphan-sweep.json"),
+    }
+    os.environ.update(settings)
+
+
+def load(quiet=False):
+    """(server, containers), imported. `quiet` sends the executor's log to /dev/null, formatted all the same."""
+    import containers
+    import server
+    if quiet:
+        import logging
+        from flask.logging import default_handler
+
+        handler = logging.StreamHandler(open(os.devnull, "w"))
+        handler.setFormatter(default_handler.formatter)
+        server.app.logger.removeHandler(default_handler)
+        server.app.logger.addHandler(handler)
+    return server, containers
+
+
+def run(scenarios=SCENARIOS, targets=TARGETS, requests=200, concurrency=1, latency_ms=None, alloc_requests=10,
+        modules=None):
+    """Every scenario against every target, and the configuration they ran with, as a dict."""
+    modules = modules or load()
+    latency_ms = latency_ms or {}
+    results = []
+    for scenario_name in scenarios:
+        # A 64 MB output a few hundred times is minutes of the capture doing its job, not more signal.
+        count = max(1, requests // 20) if scenario_name == "huge_output" else requests
+        for target in targets:
+            results.append(measure(target, scenario_name, count, concurrency, latency_ms,
+                                   min(alloc_requests, count), modules))
+    return {
+        "benchmark": "aae-executor",
+        "version": 1,
+        "at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "executor_version": getattr(modules[0], "VERSION", ""),
+        "commit": getattr(modules[0], "COMMIT", ""),
+        "python": platform.python_version(),
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"requests": requests, "concurrency": concurrency, "alloc_requests": alloc_requests,
+                   "latency_ms": {name: latency_ms.get(name, 0.0) for name in OPERATIONS}},
+        "results": results,
+    }
+
+
+def regressions(report, baseline, tolerance):
+    """Scenario/target pairs whose p50 is more than `tolerance` (0.2 = 20%) worse than in `baseline`."""
+    before = {(r["scenario"], r["target"]): r for r in baseline.get("results", [])}
+    worse = []
+    for r in report["results"]:
+        old = before.get((r["scenario"], r["target"]))
+        if old and old["p50_ms"] > 0 and r["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            worse.append("{} via {}: p50 {:.3f} ms, was {:.3f} ms".format(
+                r["scenario"], r["target"], r["p50_ms"], old["p50_ms"]))
+    return worse
+
+
+def table(report):
+    columns = ["scenario", "target", "rps", "p50_ms", "p90_ms", "p99_ms", "overhead_ms", "peak_alloc_kib",
+               "retained_blocks"]
+    rows = [[str(r[c]) for c in columns] for r in report["results"]]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines += ["  ".join(v.ljust(w) for v, w in zip(row, widths)) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+def _latency(text):
+    name, _, ms = text.partition("=")
+    if name not in OPERATIONS:
+        raise argparse.ArgumentTypeError("not one of {}".format(", ".join(OPERATIONS)))
+    return name, float(ms)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--scenario", action="append", choices=SCENARIOS, help="only these (default: all)")
+    p.add_argument("--target", action="append", choices=TARGETS, help="only these (default: both)")
+    p.add_argument("--requests", type=int, default=200, help="per scenario and target; huge_output runs a 20th")
+    p.add_argument("--concurrency", type=int, default=1, help="threads sending requests at once")
+    p.add_argument("--latency", type=_latency, action="append", default=[], metavar="OP=MS",
+                   help="milliseconds a fake Docker call takes, e.g. start=120 ({})".format(", ".join(OPERATIONS)))
+    p.add_argument("--alloc-requests", type=int, default=10, help="requests in the tracemalloc pass; 0 skips it")
+    p.add_argument("--json", help="write the results here, '-' for stdout")
+    p.add_argument("--baseline", help="an earlier --json file to compare p50s against")
+    p.add_argument("--tolerance", type=float, default=0.2, help="how much worse a p50 may be, 0.2 = 20%%")
+    args = p.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="easy-bench-") as directory:
+        isolate(directory)
+        report = run(args.scenario or SCENARIOS, args.target or TARGETS, args.requests, args.concurrency,
+                     dict(args.latency), args.alloc_requests, load(quiet=True))
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        sys.stdout.write(table(report))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            worse = regressions(report, json.load(f), args.tolerance)
+        for line in worse:
+            print("slower: " + line, file=sys.stderr)
+        return 1 if worse else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""gzip on the wire: request bodies sent with `Content-Encoding: gzip`, and answers to clients that ask.
+
+A grade request carries the exercise's assets — TSL-generated test files, data files, sometimes a
+picture for imgrec — and the answer carries V3 feedback, which for a failing submission lists every
+check with its message. Tens to hundreds of kilobytes each way, per submission, of text that gzip
+makes five to ten times smaller. Both directions are opt-in per request, so a core that does neither
+sees exactly the contract it always had.
+
+### Requests
+
+A body sent with `Content-Encoding: gzip` is inflated before Flask sees it, so every endpoint reads
+JSON as it always has and none of them knows. Inflated with a cap: `REQUEST_MAX_MB` is the most a
+body may come to, counted while inflating rather than after, because a few kilobytes of gzip can
+inflate to gigabytes and the executor is not going to hold those in memory to find out. Over the cap
+is 413; a body that is not gzip after all is 400; any other encoding is 415, which is what HTTP says
+for "I cannot read that". An uncompressed body is passed through untouched and uncapped, as before.
+
+Done as WSGI middleware rather than in Flask, because Flask reads the body from the WSGI input stream
+and there is no hook between the two that could swap it.
+
+### Answers
+
+Compressed when the request's `Accept-Encoding` allows gzip and the body is at least
+`RESPONSE_MIN_BYTES` — below that the header costs about as much as it saves. Never a streamed answer
+(a batch's NDJSON lines go out as each submission finishes, and buffering them to compress would undo
+that), never one that is already encoded. `Vary: Accept-Encoding` on whatever could have been
+compressed, so nothing between core and here serves one client's encoding to another.
+
+`RESPONSE_LEVEL` is gzip's level. This is a host that grades with every core it has, so it is the
+cheap end: almost all of the saving for a fraction of level 9's CPU.
+"""
+import gzip
+import io
+import json
+import os
+import zlib
+
+from flask import request
+from werkzeug.wrappers import Response
+
+# The most a gzip request body may inflate to. Uncompressed bodies are not counted against it.
+REQUEST_MAX_MB = int(os.environ.get("EASY_REQUEST_MAX_MB", "32"))
+RESPONSE_MIN_BYTES = int(os.environ.get("EASY_GZIP_MIN_BYTES", "1024"))
+RESPONSE_LEVEL = 5
+# Read from the socket and inflated this much at a time.
+CHUNK_BYTES = 64 * 1024
+
+
+def install(app):
+    """Inflates gzip request bodies in front of `app`, and compresses its answers where asked to."""
+    app.wsgi_app = GunzipRequests(app.wsgi_app)
+    app.after_request(compress_response)
+
+
+class RequestRefused(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class GunzipRequests:
+    """WSGI middleware: a `Content-Encoding: gzip` body is inflated, capped, and handed on as plain."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding in ("", "identity"):
+            return self.wsgi_app(environ, start_response)
+        try:
+            if encoding not in ("gzip", "x-gzip"):
+                raise RequestRefused(415, "Content-Encoding {} is not supported, only gzip".format(encoding))
+            body = inflate(environ["wsgi.input"], _content_length(environ), REQUEST_MAX_MB * 1024 * 1024)
+        except RequestRefused as e:
+            # In the shape of the app's own errors, which this never reaches.
+            refused = Response(json.dumps({"message": str(e)}) + "\n", status=e.status,
+                               mimetype="application/json")
+            return refused(environ, start_response)
+        environ = dict(environ)
+        del environ["HTTP_CONTENT_ENCODING"]
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        return self.wsgi_app(environ, start_response)
+
+
+def inflate(stream, length, limit):
+    """The gzip body of `length` bytes read from `stream`, inflated. RequestRefused past `limit`."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = bytearray()
+    remaining = length
+    try:
+        while remaining is None or remaining > 0:
+            chunk = stream.read(CHUNK_BYTES if remaining is None else min(CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            # `max_length` is what makes the cap hold while inflating: at most one byte past it is ever
+            # produced, however much the input would inflate to.
+            data = chunk
+            while data:
+                out += decompressor.decompress(data, limit + 1 - len(out))
+                if len(out) > limit:
+                    raise RequestRefused(413, "Request body inflates to more than {} MB".format(REQUEST_MAX_MB))
+                data = decompressor.unconsumed_tail
+        out += decompressor.flush()
+    except zlib.error:
+        raise RequestRefused(400, "Request body is not valid gzip")
+    if len(out) > limit:
+        raise RequestRefused(413, "Request body inflates to more than {} MB".format(REQUEST_MAX_MB))
+    if not decompressor.eof:
+        raise RequestRefused(400, "Request body is not valid gzip")
+    return bytes(out)
+
+
+def _content_length(environ):
+    try:
+        return int(environ["CONTENT_LENGTH"])
+    except (KeyError, ValueError):
+        # Chunked, or not said: read to the end, which the cap bounds all the same.
+        return None
+
+
+def compress_response(response):
+    """Flask `after_request`: gzips `response` if the client accepts it and it is worth it."""
+    if response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    if not request.accept_encodings["gzip"]:
+        return response
+    body = response.get_data()
+    if len(body) < RESPONSE_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=RESPONSE_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
@@ -1,19 +1,69 @@
 # coding=utf-8
 
+import atexit
+import codecs
+import collections
+import contextlib
+import contextvars
 import enum
+import fcntl
+import functools
+import hashlib
+import io
 import json
 import os
 import os.path
 import re
+import tarfile
 import tempfile
 import threading
-from time import time, sleep
+from time import monotonic, sleep, time
 
 import docker
 import docker.errors
+# docker-py's own HTTP layer: what a wait that outlives its timeout raises.
+import requests.exceptions
 
-# Interval in seconds for polling Docker daemon for container status
-POLL_INTERVAL_SEC = 0.5
+import admission
+import load
+import metrics
+import runtimes
+import tracing
+
+# How long past its time limit a container may take to exit after being killed before the wait for it
+# is abandoned. A kill normally lands in milliseconds; this is for a daemon that is not answering.
+WAIT_GRACE_SEC = 10
+
+# --- one Docker client per process ------------------------------------------------------------------
+#
+# Every request used to call `docker.from_env()`, and so did every pass of the warm pool, the orphan
+# sweeper and the image refresh: a new client, a new HTTP connection pool, a `/version` round trip to
+# negotiate the API, and a socket opened to the daemon and dropped again. Under 30 sync gunicorn
+# workers that was 30 of everything, and a busy host kept the daemon busy answering handshakes.
+#
+# Now the process holds one client, made on first use, and everything shares it. docker-py's client is
+# a `requests.Session` over the daemon's socket, which is safe to share between threads and keeps its
+# connections alive between calls. The pool is sized for the worst case of a threaded executor: a
+# connection per running container's log stream, plus the background threads' own. Past that
+# urllib3 opens a connection anyway and drops it afterwards, so a low setting costs speed, not runs.
+#
+# The client is remade if `docker.from_env` is not the function that made it, which is how the tests
+# and `benchmark.py` stand a fake daemon in for the real one.
+
+DOCKER_POOL_SIZE = int(os.environ.get("EASY_DOCKER_POOL_SIZE") or 0) or max(10, 2 * (os.cpu_count() or 1))
+
+_docker = {"factory": None, "client": None}
+_docker_lock = threading.Lock()
+
+
+def shared_docker_client():
+    """This process's Docker client, made on first use and shared by every thread."""
+    factory = docker.from_env
+    with _docker_lock:
+        if _docker["client"] is None or _docker["factory"] is not factory:
+            _docker["client"] = factory(max_pool_size=DOCKER_POOL_SIZE)
+            _docker["factory"] = factory
+        return _docker["client"]
 
 # --- reporting which grading libraries this host actually has (EZ-1781) -----------------------------
 #
@@ -69,18 +119,31 @@ _image_cache = {"at": 0.0, "images": []}
 _image_cache_lock = threading.Lock()
 _refresh_running = threading.Event()
 
-DOCKERFILE_TEMPLATE = '''FROM {}
-COPY student-submission /student-submission
-COPY evaluate.sh /
-CMD /evaluate.sh'''
+# --- grading without `docker build` -------------------------------------------------------------------
+#
+# A submission used to be graded by writing a Dockerfile and its files to a temp dir, building an image
+# from that, running it, and deleting the image again. The build and the delete were most of the
+# per-submission overhead on a busy host, and every submission added and removed layers in the
+# daemon's store to deliver three small files.
+#
+# Now the container is created straight from the base image and the files are streamed into it as an
+# in-memory tar before it starts. What the grading script finds is the same as before: `/evaluate.sh`,
+# and `/student-submission` holding the submission under both names plus the assets. Nothing touches
+# the executor's disk, and there is no image to delete afterwards.
+#
+# `containers.create` does not pull, so a base image missing from this host fails here with
+# ImageNotFound rather than fetching something — the "must already exist" the API has always stated.
 
-# Raw docker daemon status strings
-RUNNING_STATUS = 'running'
-EXITED_STATUS = 'exited'
+# Exactly what the Dockerfile's shell-form `CMD /evaluate.sh` ran.
+GRADING_COMMAND = ["/bin/sh", "-c", "/evaluate.sh"]
+SUBMISSION_DIR = "student-submission"
+# New automatic tests use the lahendus.py file because that produces nicer error messages, but
+# submission.py is kept as well for legacy tests.
+SUBMISSION_FILE_NAMES = ("submission.py", "lahendus.py")
 
 
 def grade_submission(submission, grading_script, assets, base_image_name, max_run_time_sec, max_mem_MB, logger,
-                     request_id):
+                     request_id, cpus=None, cpuset=None, listener=None, limits=None):
     """
     :param submission: str, submission content
     :param grading_script: str, grading script content
@@ -90,98 +153,536 @@ def grade_submission(submission, grading_script, assets, base_image_name, max_ru
     :param max_run_time_sec: int, maximum run time of the container / grading script in seconds
     :param max_mem_MB: int, maximum memory usage of the container in megabytes, must be >= 4
     :param logger: logger object, must have standard debug, info etc methods
+    :param cpus: float, CPUs the container may use, as a quota; None for CPU_QUOTA, 0 for no quota
+    :param cpuset: str, cores to pin the container to, as Docker writes them ("0,3"); None for any
+    :param listener: told about the run as it happens, see "following a run"; None for nobody
+    :param limits: runtimes.Limits, the PID, swap and /tmp limits, see `run_limits`; None for the host's
 
-    :return pair (run_status: RunStatus, raw_output: str)
+    :return pair (outcome: RunOutcome, raw_output: CapturedOutput)
     """
+    exercise = prepare_exercise(grading_script, assets, base_image_name, logger, request_id)
+    return grade_prepared(exercise, submission, max_run_time_sec, max_mem_MB, logger, request_id, cpus, cpuset,
+                          listener, limits)
 
-    # Create temporary dir for this submission and write submission data as files
-    with tempfile.TemporaryDirectory() as student_dir:
-        with open(os.path.join(student_dir, 'Dockerfile'), mode='w', encoding='utf-8') as docker_file:
-            docker_file.write(DOCKERFILE_TEMPLATE.format(base_image_name))
 
-        with open(os.path.join(student_dir, 'evaluate.sh'), mode='w', encoding='utf-8') as evaluate_file:
-            evaluate_file.write(grading_script)
+def image_id(image_name):
+    """
+    The ID `image_name` names right now, or None if Docker cannot say. ImageNotFound propagates: a
+    grading from it would fail the same way.
+    """
+    try:
+        return _resolve_image_id(shared_docker_client(), image_name)
+    except docker.errors.ImageNotFound:
+        raise
+    except (docker.errors.DockerException, requests.exceptions.RequestException):
+        return None
+
+
+# The tags a request has resolved so far, inside `resolving_once`. The result cache's key and the warm
+# pool's claim both need the ID the request's image names, milliseconds apart; without this each asked
+# the daemon. Per request rather than per process, so a retag is still seen by the very next request.
+_resolved_ids = contextvars.ContextVar("resolved_image_ids", default=None)
+
+
+@contextlib.contextmanager
+def resolving_once():
+    """Within the block, a tag is resolved at most once: later lookups of it get the first answer."""
+    if _resolved_ids.get() is not None:
+        # Already inside one, whose answers hold here too.
+        yield
+        return
+    token = _resolved_ids.set({})
+    try:
+        yield
+    finally:
+        _resolved_ids.reset(token)
 
-        # Grading script needs read and execution permissions
-        os.chmod(os.path.join(student_dir, 'evaluate.sh'), 0o500)
 
-        os.mkdir(os.path.join(student_dir, 'student-submission'))
+def _resolve_image_id(docker_client, image_name):
+    resolved = _resolved_ids.get()
+    if resolved is not None and image_name in resolved:
+        return resolved[image_name]
+    with tracing.span("docker.image_get"):
+        found = docker_client.images.get(image_name).id
+    if resolved is not None:
+        resolved[image_name] = found
+    return found
 
-        # New automatic tests use the lahendus.py file because that produces nicer error messages
-        # but keeping submission.py as well for legacy tests
-        with open(os.path.join(student_dir, 'student-submission', 'submission.py'), mode='w',
-                  encoding='utf-8') as submission_file:
-            submission_file.write(submission)
 
-        with open(os.path.join(student_dir, 'student-submission', 'lahendus.py'), mode='w',
-                  encoding='utf-8') as submission_file:
-            submission_file.write(submission)
+# What every submission to one exercise shares, worked out once. `image_name` is the per-exercise image
+# when `prebuilt`, and the base image otherwise.
+Exercise = collections.namedtuple("Exercise", "image_name base_image_name grading_script assets prebuilt")
 
-        for asset in assets:
-            with open(os.path.join(student_dir, 'student-submission', asset[0]), mode='w',
-                      encoding='utf-8') as asset_file:
-                asset_file.write(asset[1])
 
-        return _run_in_container(student_dir, max_run_time_sec, max_mem_MB, logger, request_id)
+def prepare_exercise(grading_script, assets, base_image_name, logger, request_id):
+    """
+    The exercise-level half of grading: the per-exercise image, found or built.
 
+    Split from `grade_submission` for a batch, which grades many submissions to one exercise and would
+    otherwise hash the same script and assets and look up the same image once per submission.
+    """
+    if EXERCISE_CACHE_MB > 0 and runtime().exercise_images:
+        try:
+            with tracing.context(request_id, base_image_name):
+                image = exercise_image(shared_docker_client(), base_image_name, grading_script, assets, logger,
+                                       request_id)
+            return Exercise(image, base_image_name, grading_script, assets, True)
+        except ExerciseImageUnavailable as e:
+            # The cache is an optimisation. Grading the slow way is always better than not grading.
+            logger.error("{}, grading without the exercise image ({})".format(e, request_id))
+
+    return Exercise(base_image_name, base_image_name, grading_script, assets, False)
+
+
+def grade_prepared(exercise, submission, max_run_time_sec, max_mem_MB, logger, request_id, cpus=None, cpuset=None,
+                   listener=None, limits=None):
+    """Grades one submission to a prepared exercise. Returns what `grade_submission` does."""
+    started = monotonic()
+    try:
+        with tracing.context(request_id, exercise.base_image_name):
+            outcome, output = _grade_prepared(exercise, submission, max_run_time_sec, max_mem_MB, logger,
+                                              request_id, cpus, cpuset, listener, limits)
+    except GradingAbandoned:
+        metrics.count_run("ABANDONED", exercise.base_image_name)
+        raise
+    except Exception:
+        metrics.count_run("ERROR", exercise.base_image_name)
+        raise
+    # Counted by the base image, which is what a teacher chose; an exercise image's tag is a hash.
+    metrics.count_run(outcome.status.name, exercise.base_image_name)
+    load.record_grade(exercise.base_image_name, monotonic() - started)
+    return outcome, output
+
+
+def _grade_prepared(exercise, submission, max_run_time_sec, max_mem_MB, logger, request_id, cpus, cpuset, listener,
+                    limits):
+    if exercise.prebuilt:
+        try:
+            return _run_in_container(exercise.image_name, student_archive(submission, exercise.assets),
+                                     max_run_time_sec, max_mem_MB, logger, request_id, cpus, cpuset, listener, limits)
+        except docker.errors.ImageNotFound:
+            # Evicted by another worker since it was prepared — possible in a batch that runs for
+            # minutes. The base is still there, or the line below says so.
+            logger.info("Exercise image {} is gone, grading from the base ({})".format(
+                exercise.image_name, request_id))
+
+    archive = submission_archive(submission, exercise.grading_script, exercise.assets)
+    return _run_in_container(exercise.base_image_name, archive, max_run_time_sec, max_mem_MB, logger, request_id,
+                             cpus, cpuset, listener, limits)
+
+
+def submission_archive(submission, grading_script, assets):
+    """The files a grading container starts with, as a tar to extract at `/`.
+
+    Ownership and modes are what `COPY` used to produce: everything root's, the script 0o500 so it is
+    executable, the rest 0o644 under a 0o755 directory. Assets are applied after the submission, so an
+    asset called `lahendus.py` replaces the student's file — some exercises supply a fixed program
+    that way. One entry per path, rather than relying on extraction order to settle a duplicate.
+    """
+    files = {name: submission for name in SUBMISSION_FILE_NAMES}
+    for file_name, file_content in assets:
+        files[file_name] = file_content
+    return _archive(grading_script, files)
 
-def _run_in_container(source_dir, max_run_time_sec, max_mem_MB, logger, request_id):
-    docker_client = docker.from_env()
 
-    # Create image
-    image_id = docker_client.images.build(path=source_dir, rm=True)[0].id
-    logger.debug('Built image {} ({})'.format(image_id, request_id))
+def exercise_archive(grading_script, assets):
+    """What every submission to one exercise has in common: the grading script and the assets."""
+    return _archive(grading_script, dict(assets))
 
-    # Create and run container
-    container = docker_client.containers.run(image_id, detach=True, mem_limit='{}m'.format(max_mem_MB),
-                                             network_mode='host')
-    logger.debug("Started container {} ({})".format(container.short_id, request_id))
-    start_time = time()
-    i = 0
 
-    while True:
-        # Reload container status from docker daemon
-        container.reload()
-        status = container.status
-        if status == EXITED_STATUS:
-            logger.info('Container exited ({})'.format(request_id))
-            run_status = RunStatus.SUCCESS
-            break
-        elif status == RUNNING_STATUS:
-            logger.debug('Container still running... iteration {} ({})'.format(i, request_id))
-        else:
-            logger.error('Unexpected container status {} ({})'.format(status, request_id))
+def student_archive(submission, assets):
+    """The submission alone, for a container whose image already holds the exercise.
 
-        if time() - start_time > max_run_time_sec:
-            logger.warn('Timeout, killing container ({})'.format(request_id))
-            try:
-                container.kill()
-            except docker.errors.APIError as e:
-                logger.error("{} ({})".format(e, request_id))
-            run_status = RunStatus.TIME_EXCEEDED
-            break
+    A name that an asset also uses is left out, so the asset still wins as it does in
+    `submission_archive` — here the asset is already in the image, and writing the submission over it
+    would reverse the order.
+    """
+    shadowed = {file_name for file_name, _ in assets}
+    return _archive(None, {name: submission for name in SUBMISSION_FILE_NAMES if name not in shadowed})
+
+
+def _archive(grading_script, files):
+    now = time()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        _add_to_tar(tar, SUBMISSION_DIR, None, 0o755, now)
+        if grading_script is not None:
+            _add_to_tar(tar, "evaluate.sh", grading_script, 0o500, now)
+        for file_name, content in files.items():
+            _add_to_tar(tar, SUBMISSION_DIR + "/" + file_name, content, 0o644, now)
+    return buffer.getvalue()
+
+
+def _add_to_tar(tar, name, content, mode, mtime):
+    info = tarfile.TarInfo(name)
+    info.mode = mode
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = "root"
+    if content is None:
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        return
+    data = content.encode("utf-8")
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _run_in_container(image_name, archive, max_run_time_sec, max_mem_MB, logger, request_id, cpus=None,
+                      cpuset=None, listener=None, limits=None):
+    run = runtime()
+    cpus = CPU_QUOTA if cpus is None else cpus
+    limits = run_limits() if limits is None else limits
+    phases = metrics.Phases()
+
+    with metrics.container_in_flight():
+        with phases("create_start"):
+            handle = run.create(image_name, max_mem_MB, cpus, limits, logger, request_id)
+
+        try:
+            with phases("create_start"):
+                if cpuset is not None:
+                    # Chosen per run by admission, so it cannot be part of the pool's key; a created
+                    # container's cpuset can still be changed before it starts.
+                    run.pin(handle, cpuset)
+            with phases("materialise"):
+                run.inject(handle, archive)
+            with phases("create_start"):
+                run.start(handle)
+            started = monotonic()
+            logger.debug("Started container {} ({})".format(handle.short_id, request_id))
+            if listener is not None:
+                listener.started(handle.short_id)
+            outcome, output = _run_to_exit(run, handle, max_run_time_sec, logger, request_id, phases, listener)
+            usage = _usage(run, handle, monotonic() - started, logger, request_id)
+        finally:
+            # Also when the archive or the start was refused: a created container is as much a leak as
+            # a stopped one. In the background: the grade does not wait for it.
+            logger.debug('Handing container {} to the reaper ({})'.format(handle.short_id, request_id))
+            _reap("container {}".format(handle.short_id), functools.partial(run.destroy, handle), logger)
+            phases.observe()
+
+    exit_code = usage.get("exit_code") if outcome.exit_code is None else outcome.exit_code
+    oom_killed = usage.get("oom_killed")
+    if exit_code is not None:
+        usage["exit_code"] = exit_code
+    return outcome._replace(status=_status(outcome.timed_out, exit_code, oom_killed), exit_code=exit_code,
+                            oom_killed=oom_killed, usage=usage), output
+
+
+def _usage(run, handle, wall_sec, logger, request_id):
+    """What the run used, as far as the runtime can say (see "resource usage" in `runtimes.py`)."""
+    try:
+        usage = run.stats(handle)
+    except Exception as e:
+        # Only numbers for the response, and a flag with a fallback: never a reason to lose the grade.
+        logger.info("Could not read what container {} used: {} ({})".format(handle.short_id, e, request_id))
+        usage = {}
+    return dict(usage, wall_sec=round(wall_sec, 3))
+
+
+def _run_to_exit(run, handle, max_run_time_sec, logger, request_id, phases=None, listener=None):
+    """Follows the container's output until it exits, killing it exactly when its time is up.
+
+    The end of the output stream is the exit: the runtime closes it when the container stops, so a
+    submission that takes a second comes back in a second rather than at the next poll, and nothing
+    asks every half second whether it has finished. The output is read as it is produced, so it never
+    exists in memory as a whole — see `OutputCapture`.
 
-        i += 1
-        sleep(POLL_INTERVAL_SEC)
+    The limit is a timer that kills the container when it fires. Only a kill that *succeeds* is a
+    timeout — a container that exited on its own in the same instant makes the kill fail, and it
+    finished inside its time. A second, later timer closes the stream in case a kill never lands, and
+    the wait for the exit status has its own timeout, so a worker cannot be held by a container the
+    runtime has lost track of.
 
-    output = container.logs().decode('utf-8')
-    logger.debug('Removing container {} ({})'.format(container.short_id, request_id))
-    container.remove()
-    logger.debug('Removing image {} ({})'.format(image_id, request_id))
+    `phases`, when given, gets `logs` and `run` timed into it (see `metrics.py`). `listener`, when given,
+    is handed the output as it is read, and may ask for the container to be killed before its time (see
+    "following a run").
+    """
+    phases = phases or metrics.Phases()
+    timed_out = threading.Event()
+    abandoned = threading.Event()
+    killed_at = []
+
+    def kill():
+        logger.warn('Timeout, killing container ({})'.format(request_id))
+        try:
+            run.kill(handle)
+            killed_at.append(monotonic())
+            timed_out.set()
+        except runtimes.RuntimeRefused as e:
+            logger.info("{} ({})".format(e, request_id))
+
+    def abandon():
+        logger.info('Nobody is waiting for the grade any more, killing container ({})'.format(request_id))
+        try:
+            run.kill(handle)
+            abandoned.set()
+        except runtimes.RuntimeRefused as e:
+            logger.info("{} ({})".format(e, request_id))
+
+    capture = OutputCapture(OUTPUT_LIMIT_BYTES)
+    with phases("logs"):
+        stream = run.output(handle)
+    # In this request's trace context, which a new thread would otherwise start without.
+    timer = threading.Timer(max_run_time_sec, contextvars.copy_context().run, [kill])
+    watchdog = threading.Timer(max_run_time_sec + WAIT_GRACE_SEC, stream.close)
+    for t in (timer, watchdog):
+        t.daemon = True
+        t.start()
+    if listener is not None:
+        listener.on_abandon(abandon)
     try:
-        docker_client.images.remove(image=image_id)
-    except docker.errors.APIError as e:
-        logger.error('{}, ({})'.format(e, request_id))
+        with phases("run"):
+            for chunk in stream:
+                capture.feed(chunk)
+                if listener is not None:
+                    listener.output(chunk)
+            exited_at = monotonic()
+            exit_code = run.wait(handle, WAIT_GRACE_SEC)
+    except runtimes.NotExited as e:
+        # Not even the kill ended it. Whatever state it is in, it did not finish in time.
+        logger.error("Container did not exit after being killed: {} ({})".format(e, request_id))
+        with phases("logs"):
+            output = capture.result()
+        return RunOutcome(RunStatus.TIME_EXCEEDED, timed_out=True, truncated=output.truncated), output
+    finally:
+        timer.cancel()
+        watchdog.cancel()
+        if listener is not None:
+            listener.on_abandon(None)
+
+    if abandoned.is_set():
+        # Killed halfway, so what it printed is not a grade, and must not be remembered as one.
+        raise GradingAbandoned("abandoned by the client after {} bytes of output ({})".format(
+            capture.fed_bytes, request_id))
+    with phases("logs"):
+        output = capture.result()
+    if output.truncated:
+        logger.info("Output truncated, {} bytes dropped ({})".format(output.dropped_bytes, request_id))
+    if timed_out.is_set():
+        kill_to_exit_sec = round(max(exited_at - killed_at[0], 0.0), 3)
+        return RunOutcome(RunStatus.TIME_EXCEEDED, exit_code, None, True, kill_to_exit_sec, output.truncated), output
+    logger.info('Container exited ({})'.format(request_id))
+    return RunOutcome(RunStatus.SUCCESS, exit_code, truncated=output.truncated), output
+
+
+# --- the runtime --------------------------------------------------------------------------------------
+#
+# `_run_in_container` is written against `runtimes.Runtime`, and which one this host uses is
+# `EASY_RUNTIME` (see `runtimes.py`). Docker's is here rather than there because it is the warm pool's
+# and the reaper's as much as the run's.
+
+RUNTIME = os.environ.get("EASY_RUNTIME", "docker")
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+class DockerRuntime(runtimes.Runtime):
+    """The Docker daemon through docker-py, and the warm pool in front of its creates."""
+
+    name = "docker"
+    exercise_images = True
+
+    def __init__(self):
+        self._samplers = {}
+        self._samplers_lock = threading.Lock()
+
+    def create(self, image_name, max_mem_MB, cpus, limits, logger, request_id):
+        return _claim_container(shared_docker_client(), image_name, max_mem_MB, logger, request_id, cpus, limits)
+
+    def pin(self, container, cpuset):
+        with tracing.span("docker.update"):
+            container.update(cpuset_cpus=cpuset)
+
+    def inject(self, container, archive):
+        with tracing.span("docker.put_archive"):
+            container.put_archive("/", archive)
+
+    def start(self, container):
+        if _is_zygote(container):
+            _wake_zygote(container)
+        else:
+            with tracing.span("docker.start"):
+                container.start()
+        # The cgroup is gone the moment the container exits, so it is read while it runs.
+        if getattr(container, "id", None):
+            with self._samplers_lock:
+                self._samplers[container.id] = runtimes.CgroupSampler(_docker_cgroups(container.id))
+
+    def output(self, container):
+        with tracing.span("docker.logs"):
+            return _DockerOutput(container.logs(stream=True, follow=True))
+
+    def wait(self, container, timeout):
+        try:
+            with tracing.span("docker.wait"):
+                return container.wait(timeout=timeout)["StatusCode"]
+        except requests.exceptions.RequestException as e:
+            raise runtimes.NotExited(str(e))
+
+    def kill(self, container):
+        try:
+            with tracing.span("docker.kill"):
+                container.kill()
+        except docker.errors.APIError as e:
+            raise runtimes.RuntimeRefused(str(e))
+
+    def _sampled(self, container):
+        with self._samplers_lock:
+            sampler = self._samplers.pop(getattr(container, "id", None), None)
+        return sampler.stop() if sampler is not None else {}
 
-    if _was_memory_killed(output):
-        run_status = RunStatus.MEM_EXCEEDED
+    def destroy(self, container):
+        self._sampled(container)  # a run that never got as far as `stats`
+        _remove_container(container)
 
-    return run_status, output
+    def stats(self, container):
+        usage = self._sampled(container)
+        # The OOM flag from the container's state, which outlives the exit. The cgroup's own count is
+        # kept as well: Docker records a kill of the container's main process, and under the zygote or
+        # `/bin/sh` the process the OOM killer picks is seldom that one.
+        with tracing.span("docker.inspect"):
+            container.reload()
+        state = container.attrs.get("State", {})
+        if state.get("OOMKilled"):
+            usage["oom_killed"] = True
+        # With no cgroup reading, Docker's False is only about the main process: say nothing, and let
+        # the run fall back to its exit status (see `_status`).
+        usage["exit_code"] = state.get("ExitCode")
+        return usage
 
 
-def _was_memory_killed(output):
-    # Assume the process was killed by OOM killer if the last non-empty lowercased line of the output contains 'killed'
-    return 'killed' in output.strip().split('\n')[-1].lower()
+class _DockerOutput:
+    """A log stream, with docker-py's HTTP errors as the NotExited the run expects."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        except requests.exceptions.RequestException as e:
+            raise runtimes.NotExited(str(e))
+
+    def close(self):
+        self.stream.close()
+
+
+def _docker_cgroups(container_id):
+    """Where a container's cgroup is under the systemd cgroup driver, and under cgroupfs."""
+    return [os.path.join(runtimes.CGROUP_ROOT, "system.slice", "docker-{}.scope".format(container_id)),
+            os.path.join(runtimes.CGROUP_ROOT, "docker", container_id)]
+
+
+def _remove_container(container):
+    with metrics.phase("remove"), tracing.span("docker.remove"):
+        container.remove(force=True)
+
+
+RUNTIMES = {"docker": DockerRuntime, "oci": runtimes.OciRuntime, "fake": runtimes.FakeRuntime}
+if RUNTIME not in RUNTIMES:
+    raise ValueError("EASY_RUNTIME must be one of {}, not {!r}".format(", ".join(sorted(RUNTIMES)), RUNTIME))
+
+
+def runtime():
+    """This host's runtime, made on first use."""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = RUNTIMES[RUNTIME]()
+        return _runtime
+
+
+# --- bounded output --------------------------------------------------------------------------------
+#
+# A student's `while True: print(...)` can produce hundreds of megabytes before the time limit ends
+# it, and all of it used to be read into one gunicorn worker, decoded in one go, and then split
+# whole — twice. Now the output is read as a stream and only the first and last parts are kept.
+#
+# The tail gets most of the room, because the end is where the answer is: a legacy grader's `grade:`
+# line is the last line, and a V3 grader's JSON is the last thing printed. The head is kept as well
+# because the beginning is where a traceback or the first wrong answer usually is, and that is what a
+# teacher reading the feedback needs.
+#
+# Decoding is incremental and tolerant: invalid UTF-8 becomes U+FFFD instead of an exception that
+# loses the grade, and a character split across two chunks is reassembled rather than mangled.
+
+# What a container's output may hold in memory, head and tail together.
+OUTPUT_LIMIT_BYTES = int(os.environ.get("EASY_OUTPUT_LIMIT_BYTES", str(4 * 1024 * 1024)))
+# Where the dropped middle was, in the text a teacher reads.
+OUTPUT_TRUNCATED_MARKER = "\n\n[... väljundist jäeti vahelt välja {} baiti ...]\n\n"
+
+
+class CapturedOutput(str):
+    """A container's output as text, and whether the middle of it had to be dropped.
+
+    A `str`, so everything that always read the output as one keeps doing so. When it was truncated,
+    `tail` is the kept end on its own, without the head and the marker in front of it — what a parser
+    looking for a V3 JSON document wants.
+    """
+
+    def __new__(cls, text, dropped_bytes=0, tail=None):
+        output = super().__new__(cls, text)
+        output.dropped_bytes = dropped_bytes
+        output.truncated = dropped_bytes > 0
+        output.tail = text if tail is None else tail
+        return output
+
+
+class OutputCapture:
+    """Keeps the first quarter of the limit and the last three quarters of whatever is fed to it."""
+
+    def __init__(self, limit):
+        self._head_limit = limit // 4
+        self._tail_limit = limit - self._head_limit
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._head = []
+        self._head_bytes = 0
+        self._tail = collections.deque()
+        self._tail_bytes = 0
+        self._dropped = 0
+        self.fed_bytes = 0
+
+    def feed(self, chunk):
+        self.fed_bytes += len(chunk)
+        room = self._head_limit - self._head_bytes
+        if room > 0:
+            kept = chunk[:room]
+            self._head.append(self._decoder.decode(kept))
+            self._head_bytes += len(kept)
+            chunk = chunk[room:]
+        if not chunk:
+            return
+        self._tail.append(chunk)
+        self._tail_bytes += len(chunk)
+        # Whole chunks only, so this costs nothing per byte; `result` trims the last bit exactly.
+        while self._tail_bytes - len(self._tail[0]) >= self._tail_limit:
+            dropped = self._tail.popleft()
+            self._tail_bytes -= len(dropped)
+            self._dropped += len(dropped)
+
+    def result(self):
+        tail = b"".join(self._tail)
+        excess = max(0, len(tail) - self._tail_limit)
+        dropped = self._dropped + excess
+        tail = tail[excess:]
+        head = "".join(self._head)
+
+        if not dropped:
+            return CapturedOutput(head + self._decoder.decode(tail, final=True))
+
+        # Whatever the head's decoder still holds is the end of the head, even if only part of a character.
+        head += self._decoder.decode(b"", final=True)
+        # A cut can land inside a character. Continuation bytes at the start of what is kept belong to
+        # one that is gone, and decoding them would only add replacement characters.
+        start = 0
+        while start < min(3, len(tail)) and tail[start] & 0xC0 == 0x80:
+            start += 1
+        tail_text = tail[start:].decode("utf-8", errors="replace")
+        dropped += start
+        return CapturedOutput(head + OUTPUT_TRUNCATED_MARKER.format(dropped) + tail_text, dropped, tail_text)
 
 
 @enum.unique
@@ -191,6 +692,1015 @@ class RunStatus(enum.Enum):
     MEM_EXCEEDED = enum.auto()
 
 
+# How a run ended, beside its output: what `grade_submission` returns first. `status` is what a student
+# is told, and the rest is what it was decided from, kept for the response and for whoever has to
+# explain a grade — the exit code (None if the run never reported one), whether the kernel's OOM
+# killer took a process (None if the runtime could not say), whether the time limit's kill landed, how
+# long the container took to go after it (None without a kill, or when it never went), whether the
+# output was cut, and the runtime's `usage` (see `_usage`).
+RunOutcome = collections.namedtuple("RunOutcome", "status exit_code oom_killed timed_out kill_to_exit_sec truncated usage",
+                                    defaults=(None, None, False, None, False, None))
+
+# What `/bin/sh` and the zygote exit with when the process they ran was SIGKILLed: 128 + 9.
+SIGKILL_EXIT_CODE = 137
+
+
+def _status(timed_out, exit_code, oom_killed):
+    """
+    What a run's end means for the student. A memory kill first, because it is the cause when both
+    happened: a grader whose child was OOM-killed can go on to run out of time.
+
+    The OOM flag decides when the runtime has one. Without it, a SIGKILL's exit status that the time
+    limit did not send is a memory kill: inside a container nothing else sends one. That replaces
+    reading "Killed" off the last line of the output, which cost a copy of the output on every run and
+    told a student whose program printed "killed" that it ran out of memory.
+    """
+    if oom_killed or (oom_killed is None and not timed_out and exit_code == SIGKILL_EXIT_CODE):
+        return RunStatus.MEM_EXCEEDED
+    if timed_out:
+        return RunStatus.TIME_EXCEEDED
+    return RunStatus.SUCCESS
+
+
+# --- following a run ----------------------------------------------------------------------------------
+#
+# A grade is one answer at the end, and for most runs that is all anyone wants. An imgrec run or a
+# heavy silmused suite takes long enough that core would rather show that something is happening, and
+# would rather stop paying for a run whose student has closed the tab. So a run can be followed: a
+# `listener` handed to `grade_submission` is told
+#
+# - `started(container_id)`, once the container is running;
+# - `output(chunk)`, with each piece of output as it is read from the log stream — the same bytes
+#   `OutputCapture` is fed, as they arrive rather than at the exit;
+# - `on_abandon(callback)`, with a callback that kills the container, once it is running, and with
+#   None when the run is over. A listener that is no longer wanted calls the callback, and the run
+#   then ends with GradingAbandoned rather than a grade. A listener abandoned before the callback
+#   arrived should call it at once.
+#
+# The listener is called on the grading thread, between reads, so it must not block. `streaming.py` is
+# the one there is.
+
+
+class GradingAbandoned(Exception):
+    """A run killed because nobody was waiting for its grade any more. Nothing to tell anybody."""
+
+
+# --- CPU ----------------------------------------------------------------------------------------------
+#
+# Memory was always limited and CPU never was, so a few submissions spinning in a loop could take
+# every core on the host between them, and what the other containers saw was a time limit that ran
+# out while they waited for a CPU — a timeout that was the neighbours' fault, reported to a student as
+# theirs. Every grading container now has a CPU quota, `CPU_QUOTA` CPUs unless the request asks for
+# another, enforced by the kernel's CFS bandwidth control: a container over its quota is throttled, the
+# others are not.
+#
+# A quota caps how much CPU time a container gets, not where. Pinning to cores as well — so that two
+# containers do not share a core's caches while other cores sit idle — is a host setting, done by
+# admission (see `admission.py`), which already knows every container running on the host and so can
+# spread them.
+
+# CPUs per grading container, by default. 0 leaves containers unlimited, as they used to be.
+CPU_QUOTA = float(os.environ.get("EASY_CPU_QUOTA", "1"))
+
+
+# --- PIDs, swap and scratch space ------------------------------------------------------------------
+#
+# Memory and CPU are what a grade is judged by; they are not all one container can take from the
+# others. A fork bomb fills the host's process table, and every container after it fails to start its
+# interpreter. A program that writes in a loop fills the disk Docker's layers live on. And the memory
+# limit was never a limit on swap: Docker lets a container swap as much again as its limit, so a
+# submission over it thrashed the disk that every other container reads its image from, slowly, until
+# its time ran out — reported as a timeout, after making everybody's run slower.
+#
+# So every grading container also gets
+#
+# - `PIDS_LIMIT` processes and threads (`pids_limit`), enough for a grader that runs a subprocess or
+#   a pool of threads and nowhere near what a fork bomb wants;
+# - `SWAP_MB` of swap beyond its memory limit (`memswap_limit`), 0 by default: over the limit is an
+#   OOM kill, at once, with the flag that says so;
+# - a tmpfs of `TMPFS_MB` at `/tmp`, for the scratch files programs write there. Its pages are charged
+#   to the container's memory, so it cannot take more than the memory limit already allows, and it
+#   goes with the container. The rest of the filesystem is the container's writable layer as before:
+#   capping that is `--storage-opt size`, which needs xfs with project quotas under Docker's data root.
+#
+# Per host, by the three settings, and per request (`max_pids`, `max_swap_mb`, `max_tmp_mb`) for an
+# exercise that needs more. 0 turns a PID limit or the tmpfs off. All three are fixed at create time,
+# so they are part of the warm pool's key.
+
+PIDS_LIMIT = int(os.environ.get("EASY_PIDS_LIMIT", "512"))
+SWAP_MB = int(os.environ.get("EASY_SWAP_MB", "0"))
+TMPFS_MB = int(os.environ.get("EASY_TMPFS_MB", "64"))
+
+
+def run_limits(pids=None, swap_mb=None, tmp_mb=None):
+    """The `runtimes.Limits` for a run: what the request asked for, and the host's for the rest."""
+    return runtimes.Limits(PIDS_LIMIT if pids is None else pids, SWAP_MB if swap_mb is None else swap_mb,
+                           TMPFS_MB if tmp_mb is None else tmp_mb)
+
+
+def _limit_args(max_mem_MB, cpus, limits):
+    """`containers.create`'s arguments for a grading container's limits."""
+    args = {"mem_limit": "{}m".format(max_mem_MB), "memswap_limit": "{}m".format(max_mem_MB + limits.swap_mb)}
+    if cpus:
+        args["nano_cpus"] = int(cpus * 1e9)
+    if limits.pids:
+        args["pids_limit"] = limits.pids
+    if limits.tmp_mb:
+        args["tmpfs"] = {"/tmp": "rw,nosuid,nodev,mode=1777,size={}m".format(limits.tmp_mb)}
+    return args
+
+
+def _create_grading_container(docker_client, image, max_mem_MB, cpus=0, limits=None):
+    """A grading container, created and not started. The limits are fixed here, at create time."""
+    args = _limit_args(max_mem_MB, cpus, run_limits() if limits is None else limits)
+    with tracing.span("docker.create"):
+        return docker_client.containers.create(image, command=GRADING_COMMAND, network_mode='host',
+                                               labels=_owner_labels(ROLE_GRADING), **args)
+
+
+# --- the warm pool ------------------------------------------------------------------------------------
+#
+# Creating a container is the one Docker round trip left on the request path that does not depend on
+# the submission, so it is done ahead of time: per grading image and memory limit, a few containers
+# are kept created-but-not-started, and a submission claims one, puts its files in and starts it. A
+# background thread tops the pool up again after every claim.
+#
+# Keyed by the memory limit, CPU quota and the other limits as well as the image, because all are fixed
+# when the container is created and exercises set their own. The keys are learnt from the requests
+# themselves — the first submission with a new (image, limit) pays for a cold create, the ones after it
+# do not — and bounded, so an unusual limit cannot grow the pool without end.
+#
+# Only images named by `grading_image_names()` are pooled, and the per-exercise images built from them
+# below. Those are the images this host is meant to grade with; anything else is rare enough that
+# holding idle containers for it costs more than it saves. An exercise image earns a pool the same way
+# any key does — by being claimed — so it is the exercises with a deadline tonight that stay warm. But
+# there is one exercise image per exercise, against a handful of base images, so they are bounded
+# separately: at most `WARM_POOL_MAX_EXERCISE_KEYS` of them, the least recently claimed going first,
+# and never at the expense of a base image's pool. A busy week of many exercises churns those few keys
+# rather than pushing out the pools every other submission relies on.
+#
+# **A pooled container must not outlive its image.** A bare tag is moved by easy_grading_sync.py when a
+# new grading library version goes live, and a container created before that would grade with the old
+# one for as long as it sat in the pool. So a claim resolves the tag first — one inspect, far cheaper
+# than the create it saves — and a pool whose image ID no longer matches is thrown away whole.
+#
+# Per process. Under gunicorn every worker has its own pool and its own counters, so the sizes are per
+# worker and `/v1/pool` describes whichever worker answered.
+
+WARM_POOL_SIZE = int(os.environ.get("EASY_WARM_POOL_SIZE", "2"))
+# Distinct (base image, limits) keys kept warm. Four images and a couple of common limits each.
+WARM_POOL_MAX_KEYS = int(os.environ.get("EASY_WARM_POOL_MAX_KEYS", "8"))
+# Keys for per-exercise images, counted apart so they cannot crowd out the base images' keys above.
+# 0 pools base images only.
+WARM_POOL_MAX_EXERCISE_KEYS = int(os.environ.get("EASY_WARM_POOL_MAX_EXERCISE_KEYS", "2"))
+# How often the refill thread re-checks the tags when no claim has woken it.
+WARM_POOL_CHECK_SEC = 30
+
+_warm_pool = collections.OrderedDict()
+_warm_pool_stale = []
+_warm_pool_lock = threading.Lock()
+_warm_pool_wake = threading.Event()
+_warm_pool_thread = None
+
+
+def _is_poolable(image_name):
+    if _is_exercise_image(image_name):
+        return WARM_POOL_MAX_EXERCISE_KEYS > 0
+    return image_name in grading_image_names()
+
+
+def _is_exercise_image(image_name):
+    return image_name.startswith(EXERCISE_IMAGE_REPO + ":")
+
+
+def _trim_warm_pool():
+    """Drops the least recently claimed keys past either bound. Called with the lock held."""
+    for exercise, limit in ((False, WARM_POOL_MAX_KEYS), (True, WARM_POOL_MAX_EXERCISE_KEYS)):
+        keys = [key for key in _warm_pool if _is_exercise_image(key[0]) == exercise]
+        for key in keys[:max(len(keys) - limit, 0)]:
+            _reset_pool(_warm_pool.pop(key), None)
+
+
+def _new_pool(image_id):
+    return {"image_id": image_id, "ready": [], "hits": 0, "misses": 0, "discarded": 0}
+
+
+def _reset_pool(pool, image_id):
+    """Empties a pool whose image has moved. Called with the lock held; removal is the thread's job."""
+    _warm_pool_stale.extend(pool["ready"])
+    pool["discarded"] += len(pool["ready"])
+    pool["ready"] = []
+    pool["image_id"] = image_id
+
+
+def _claim_container(docker_client, image_name, max_mem_MB, logger, request_id, cpus=0, limits=None):
+    """A created grading container for this image and these limits: from the pool if one is ready."""
+    limits = run_limits() if limits is None else limits
+    container = None
+    if WARM_POOL_SIZE > 0 and _is_poolable(image_name):
+        key = (image_name, max_mem_MB, cpus, limits)
+        # Raises ImageNotFound for a missing image, as the create below would.
+        image_id = _resolve_image_id(docker_client, image_name)
+        with _warm_pool_lock:
+            pool = _warm_pool.get(key)
+            if pool is None:
+                pool = _warm_pool[key] = _new_pool(image_id)
+                _trim_warm_pool()
+            elif pool["image_id"] != image_id:
+                _reset_pool(pool, image_id)
+            _warm_pool.move_to_end(key)
+            if pool["ready"]:
+                container = pool["ready"].pop()
+                pool["hits"] += 1
+            else:
+                pool["misses"] += 1
+        _start_warm_pool_thread(logger)
+        _warm_pool_wake.set()
+
+    if container is not None:
+        logger.debug("Claimed warm container {} for {} ({})".format(container.short_id, image_name, request_id))
+        return container
+
+    container = _create_grading_container(docker_client, image_name, max_mem_MB, cpus, limits)
+    logger.debug("Created container {} from {} ({})".format(container.short_id, image_name, request_id))
+    return container
+
+
+def _discard_warm_pools_for(image_name):
+    """Drops every pool of this image right away: the image itself is about to go."""
+    leftover = []
+    with _warm_pool_lock:
+        for key in [k for k in _warm_pool if k[0] == image_name]:
+            leftover.extend(_warm_pool.pop(key)["ready"])
+    # Removed here rather than by the thread, because the image cannot be removed until they are.
+    for container in leftover:
+        try:
+            container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+
+
+def _start_warm_pool_thread(logger):
+    global _warm_pool_thread
+    with _warm_pool_lock:
+        if _warm_pool_thread is not None:
+            return
+        _warm_pool_thread = threading.Thread(target=_warm_pool_loop, args=(logger,), daemon=True,
+                                             name="warm-pool")
+    _warm_pool_thread.start()
+
+
+def _warm_pool_loop(logger):
+    while True:
+        _warm_pool_wake.wait(WARM_POOL_CHECK_SEC)
+        _warm_pool_wake.clear()
+        try:
+            _refill_warm_pool(shared_docker_client(), logger)
+        except Exception as e:
+            # The pool is an optimisation: a daemon that is down means cold creates, not no grading.
+            logger.info("could not refill the warm container pool: {}".format(e))
+
+
+def _refill_warm_pool(docker_client, logger):
+    """Removes what was discarded, drops pools whose image moved, and tops the rest up."""
+    with _warm_pool_lock:
+        stale = list(_warm_pool_stale)
+        del _warm_pool_stale[:]
+        keys = list(_warm_pool)
+    for container in stale:
+        _remove_quietly(container, logger)
+
+    for key in keys:
+        image_name, max_mem_MB, cpus, limits = key
+        try:
+            image = docker_client.images.get(image_name)
+            image_id, preload = image.id, _zygote_preload(image)
+        except docker.errors.ImageNotFound:
+            image_id = preload = None
+        with _warm_pool_lock:
+            pool = _warm_pool.get(key)
+            if pool is None:
+                continue
+            if pool["image_id"] != image_id:
+                _reset_pool(pool, image_id)
+            wanted = WARM_POOL_SIZE - len(pool["ready"])
+        if image_id is None:
+            continue
+
+        for _ in range(wanted):
+            # By ID rather than by name, so what is created is exactly the image the pool is for even
+            # if the tag moves halfway through this loop.
+            if preload is None:
+                container = _create_grading_container(docker_client, image_id, max_mem_MB, cpus, limits)
+            else:
+                container = _start_zygote(docker_client, image_id, max_mem_MB, cpus, limits, preload, logger)
+            with _warm_pool_lock:
+                pool = _warm_pool.get(key)
+                if pool is not None and pool["image_id"] == image_id:
+                    pool["ready"].append(container)
+                    container = None
+            if container is not None:
+                _remove_quietly(container, logger)
+
+    with _warm_pool_lock:
+        stale = list(_warm_pool_stale)
+        del _warm_pool_stale[:]
+    for container in stale:
+        _remove_quietly(container, logger)
+
+
+def _remove_quietly(container, logger):
+    try:
+        container.remove(force=True)
+    except docker.errors.APIError as e:
+        logger.info("could not remove pooled container {}: {}".format(container.short_id, e))
+
+
+@atexit.register
+def _drain_warm_pool():
+    """Best effort on the way out. A worker that is killed leaves its pool behind regardless."""
+    with _warm_pool_lock:
+        leftover = list(_warm_pool_stale)
+        for pool in _warm_pool.values():
+            leftover.extend(pool["ready"])
+            pool["ready"] = []
+        del _warm_pool_stale[:]
+    for container in leftover:
+        try:
+            container.remove(force=True)
+        except Exception:
+            pass
+
+
+def warm_pool_status():
+    """Sizes and hit/miss counters of this process's pool. Answers from memory, never from Docker."""
+    with _warm_pool_lock:
+        pools = [
+            {
+                "image_name": image_name,
+                "max_mem_mb": max_mem_MB,
+                "cpus": cpus,
+                "pids": limits.pids,
+                "swap_mb": limits.swap_mb,
+                "tmp_mb": limits.tmp_mb,
+                "image_id": pool["image_id"],
+                "ready": len(pool["ready"]),
+                "hits": pool["hits"],
+                "misses": pool["misses"],
+                "discarded": pool["discarded"],
+            }
+            for (image_name, max_mem_MB, cpus, limits), pool in _warm_pool.items()
+        ]
+    return {
+        "pid": os.getpid(),
+        "size": WARM_POOL_SIZE,
+        "max_keys": WARM_POOL_MAX_KEYS,
+        "max_exercise_keys": WARM_POOL_MAX_EXERCISE_KEYS,
+        "zygote": ZYGOTE,
+        "hits": sum(p["hits"] for p in pools),
+        "misses": sum(p["misses"] for p in pools),
+        "pools": pools,
+    }
+
+
+# --- the zygote ---------------------------------------------------------------------------------------
+#
+# A pooled container saves the create, and the start is still cold: `/bin/sh`, then a Python
+# interpreter, then the grader's imports — for a short tiivad or pygrader run, most of its time. With
+# `ZYGOTE` on, a pooled container of an image that asks for it is *started* when it is pooled, running
+# `zygote.py` instead of the grading command. That imports the grader and waits; a claim puts the files
+# in as always, and then, in place of the start, sends it a line on stdin. The zygote forks a child
+# that runs `/evaluate.sh` — in the already-warm interpreter when the script is the usual `cd` and one
+# `python3` line, through `/bin/sh` otherwise — and exits with its status. See `zygote.py`.
+#
+# Everything after the start is unchanged: the log stream ends when the zygote exits, the time limit
+# kills the whole container, and the container is thrown away after its one run, so a submission's
+# child cannot leave anything behind for the next. The memory limit is the container's and so the
+# child's, counting what the zygote holds. That is why an image names what to preload rather than the
+# executor guessing: the grader, which the child would import anyway, and not numpy, which most
+# submissions never touch and which would come out of a 30 MB limit before the student's code ran.
+#
+# Per image, by the `easy.aae.zygote-preload` label set in its Dockerfile (comma-separated modules),
+# and per host, by `EASY_ZYGOTE`, so it can be tried on one executor first. Only pooled containers:
+# a cold one would start the zygote and wake it at once, which is slower than not having one.
+
+ZYGOTE = os.environ.get("EASY_ZYGOTE", "0") == "1"
+LABEL_ZYGOTE_PRELOAD = "easy.aae.zygote-preload"
+LABEL_ZYGOTE = "easy.aae.zygote"
+ZYGOTE_PATH = "/easy-zygote.py"
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "zygote.py"), "rb") as _f:
+    ZYGOTE_SOURCE = _f.read()
+del _f
+
+
+def _zygote_preload(image):
+    """What a zygote of this image preloads, or None for no zygote. An empty label is no zygote."""
+    if not ZYGOTE:
+        return None
+    return (getattr(image, "labels", None) or {}).get(LABEL_ZYGOTE_PRELOAD) or None
+
+
+def _is_zygote(container):
+    return (getattr(container, "labels", None) or {}).get(LABEL_ZYGOTE) == "1"
+
+
+def _start_zygote(docker_client, image, max_mem_MB, cpus, limits, preload, logger):
+    """A running zygote container for the pool, with the grader imported and stdin open."""
+    with tracing.span("docker.create"):
+        container = docker_client.containers.create(
+            image, command=["python3", ZYGOTE_PATH, preload], network_mode='host', stdin_open=True,
+            labels=dict(_owner_labels(ROLE_GRADING), **{LABEL_ZYGOTE: "1"}), **_limit_args(max_mem_MB, cpus, limits))
+    try:
+        now = time()
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo(ZYGOTE_PATH.lstrip("/"))
+            info.mode, info.mtime, info.size = 0o444, now, len(ZYGOTE_SOURCE)
+            tar.addfile(info, io.BytesIO(ZYGOTE_SOURCE))
+        container.put_archive("/", buffer.getvalue())
+        with tracing.span("docker.start"):
+            container.start()
+    except Exception:
+        _remove_quietly(container, logger)
+        raise
+    return container
+
+
+def _wake_zygote(container):
+    """The start, for a zygote: the line it is waiting for. The files are already in."""
+    with tracing.span("docker.attach"):
+        sock = container.attach_socket(params={"stdin": 1, "stream": 1})
+        try:
+            # docker-py hands back a SocketIO on a unix socket; the socket itself is what can send.
+            getattr(sock, "_sock", sock).sendall(b"go\n")
+        finally:
+            sock.close()
+
+
+# --- the reaper ---------------------------------------------------------------------------------------
+#
+# Removing a container takes the daemon anything from milliseconds to a second when it is busy, and
+# the student waiting for a grade gains nothing from it: the output has been captured by then. So
+# cleanup is handed to a background thread per process, and a run returns as soon as it has its
+# output — the container and the exercise cache's trimming both go here.
+#
+# A removal that fails is tried again, `REAPER_ATTEMPTS` times in all with a doubling delay, because a
+# daemon that refuses one is usually a daemon that is busy rather than one that never will. "No such
+# container" is success: somebody else removed it, which is all that was wanted. A task that fails
+# every attempt is counted and logged as a leak, and the orphan sweep below picks it up later.
+#
+# The backlog is bounded by `REAPER_BACKLOG`. When it is full the removal is done on the spot, in the
+# request that asked for it — the old cost, paid only by a host that is falling behind, rather than a
+# queue that grows until the process runs out of memory holding references to dead containers.
+#
+# A task runs in the trace context it was queued from (see `tracing.py`), so a removal still shows up
+# under the request that created the container.
+
+REAPER_BACKLOG = int(os.environ.get("EASY_REAPER_BACKLOG", "256"))
+REAPER_ATTEMPTS = 5
+# The first retry's delay; each one after doubles it.
+REAPER_RETRY_SEC = 1.0
+# How long a process on its way out waits for its backlog.
+REAPER_EXIT_WAIT_SEC = 10
+
+_reaper_backlog = []
+_reaper_cond = threading.Condition()
+_reaper_busy = 0
+_reaper_thread = None
+_reaper_stats = {"queued": 0, "done": 0, "retried": 0, "failed": 0, "inline": 0}
+
+
+def _reap(description, task, logger):
+    """Runs `task` — a removal — in the background, retried if it fails. Inline if the backlog is full."""
+    item = {"description": description, "task": task, "logger": logger, "attempts": 0, "due": 0.0,
+            "context": contextvars.copy_context()}
+    with _reaper_cond:
+        if len(_reaper_backlog) < REAPER_BACKLOG:
+            _reaper_backlog.append(item)
+            _reaper_stats["queued"] += 1
+            _reaper_cond.notify()
+            metrics.gauge("reaper_backlog", len(_reaper_backlog) + _reaper_busy)
+            queued = True
+        else:
+            _reaper_stats["inline"] += 1
+            queued = False
+    if queued:
+        _start_reaper_thread()
+        return
+    logger.info("Reaper backlog full, removing {} inline".format(description))
+    while not _reap_once(item):
+        sleep(max(0.0, item["due"] - time()))
+
+
+def _start_reaper_thread():
+    global _reaper_thread
+    with _reaper_cond:
+        if _reaper_thread is not None:
+            return
+        _reaper_thread = threading.Thread(target=_reaper_loop, daemon=True, name="reaper")
+    _reaper_thread.start()
+
+
+def _reaper_loop():
+    global _reaper_busy
+    while True:
+        with _reaper_cond:
+            item = _next_due()
+            while item is None:
+                pending = [i["due"] for i in _reaper_backlog]
+                _reaper_cond.wait(max(0.0, min(pending) - time()) if pending else None)
+                item = _next_due()
+            _reaper_busy += 1
+        try:
+            if not _reap_once(item) and item["attempts"] < REAPER_ATTEMPTS:
+                with _reaper_cond:
+                    _reaper_backlog.append(item)
+        finally:
+            with _reaper_cond:
+                _reaper_busy -= 1
+                _reaper_cond.notify_all()
+                metrics.gauge("reaper_backlog", len(_reaper_backlog) + _reaper_busy)
+
+
+def _next_due():
+    """The first item whose time has come, taken off the backlog. Called with the condition held."""
+    now = time()
+    for i, item in enumerate(_reaper_backlog):
+        if item["due"] <= now:
+            return _reaper_backlog.pop(i)
+    return None
+
+
+def _reap_once(item):
+    """One attempt. True if the task is finished with, whether it succeeded or was given up on."""
+    item["attempts"] += 1
+    try:
+        item["context"].run(item["task"])
+    except docker.errors.NotFound:
+        pass
+    except (docker.errors.APIError, requests.exceptions.RequestException, runtimes.RuntimeRefused, OSError) as e:
+        if item["attempts"] >= REAPER_ATTEMPTS:
+            with _reaper_cond:
+                _reaper_stats["failed"] += 1
+            metrics.count("reaper_failures")
+            item["logger"].error("Gave up removing {} after {} attempts, it is leaked: {}".format(
+                item["description"], item["attempts"], e))
+            return True
+        with _reaper_cond:
+            _reaper_stats["retried"] += 1
+        item["due"] = time() + REAPER_RETRY_SEC * 2 ** (item["attempts"] - 1)
+        item["logger"].info("Could not remove {}, will try again: {}".format(item["description"], e))
+        return False
+    with _reaper_cond:
+        _reaper_stats["done"] += 1
+    return True
+
+
+def drain_reaper(timeout):
+    """
+    Waits up to `timeout` seconds for the backlog to empty, retries included. True if it did.
+
+    For a process on its way out, and for anything that needs a removal to have *happened* — a test
+    asserting on it, say.
+    """
+    deadline = time() + timeout
+    with _reaper_cond:
+        while _reaper_backlog or _reaper_busy:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            _reaper_cond.wait(remaining)
+    return True
+
+
+@atexit.register
+def _drain_reaper_at_exit():
+    drain_reaper(REAPER_EXIT_WAIT_SEC)
+
+
+def reaper_status():
+    """The backlog and what became of what went through it, for this process."""
+    with _reaper_cond:
+        return dict(_reaper_stats, backlog=len(_reaper_backlog) + _reaper_busy, max_backlog=REAPER_BACKLOG)
+
+
+# --- orphans ------------------------------------------------------------------------------------------
+#
+# Everything above removes what it creates, and none of it runs when the process is gone: a gunicorn
+# worker killed mid-grade by its timeout, by the OOM killer or by a restart leaves its container, its
+# warm pool and any half-built exercise image behind, and so does a removal the reaper gave up on. On
+# a host that runs for months these pile up until every `docker ps -a` and every list the daemon does
+# for us is slower for them.
+#
+# So everything aae creates is labelled: `LABEL_OWNER`, which is how the sweep below tells our
+# containers from anybody else's on the host, the time it was created, the pid of the process that
+# created it and what it was for. The sweep lists what carries the owner label and removes
+#
+# - **containers** created more than `ORPHAN_AGE_SEC` ago. That is far beyond any plausible run —
+#   core's time limits are seconds, gunicorn kills a worker after a minute — so nothing that old is
+#   still grading. Except a pooled container, which is created ahead of time and may wait in its
+#   pool for as long as nobody grades on its image: a grading container not yet started is left
+#   alone while the process that created it is alive. Its pool is that process's to empty.
+# - **images** the exercise cache built that have lost their tag, and are as old. A tagged one is
+#   the cache's to evict; an untagged one is nobody's.
+#
+# Containers and images from before these labels existed carry none, and are left for a person to
+# remove once: the sweep never guesses at what it did not create.
+#
+# Once per host rather than per worker. The workers start together and would otherwise all list
+# the same containers and race each other to remove them, so the one that gets the lock on
+# `ORPHAN_SWEEP_FILE` sweeps and writes down what it reclaimed, and the others find the sweep done.
+# Each worker tries at its start and every `ORPHAN_SWEEP_SEC` after. `/v1/pool` reports the last
+# sweep from that file, whichever worker answers, and the counts go to `/v1/metrics` as well.
+
+LABEL_OWNER = "easy.aae.owner"
+LABEL_CREATED = "easy.aae.created"
+LABEL_PID = "easy.aae.pid"
+LABEL_ROLE = "easy.aae.role"
+OWNER = "aae"
+ROLE_GRADING = "grading"
+ROLE_BUILD = "build"
+ROLE_EXERCISE = "exercise"
+ROLE_INSPECT = "inspect"
+
+ORPHAN_AGE_SEC = int(os.environ.get("EASY_ORPHAN_AGE_SEC", str(60 * 60)))
+# 0 turns the sweep off, at start as well.
+ORPHAN_SWEEP_SEC = int(os.environ.get("EASY_ORPHAN_SWEEP_SEC", str(10 * 60)))
+ORPHAN_SWEEP_FILE = os.environ.get(
+    "EASY_ORPHAN_SWEEP_FILE", os.path.join(tempfile.gettempdir(), "easy-orphan-sweep.json")
+)
+
+_orphan_sweeper_thread = None
+_orphan_sweeper_lock = threading.Lock()
+
+
+def _owner_labels(role):
+    """The labels that make a container or an image ours, and say how old it is and who made it."""
+    return {LABEL_OWNER: OWNER, LABEL_CREATED: str(int(time())), LABEL_PID: str(os.getpid()), LABEL_ROLE: role}
+
+
+def start_orphan_sweeper(logger):
+    """Sweeps now, in the background, and every `ORPHAN_SWEEP_SEC` after. Once per process."""
+    global _orphan_sweeper_thread
+    if ORPHAN_SWEEP_SEC <= 0:
+        return
+    with _orphan_sweeper_lock:
+        if _orphan_sweeper_thread is not None:
+            return
+        _orphan_sweeper_thread = threading.Thread(target=_orphan_sweeper_loop, args=(logger,), daemon=True,
+                                                  name="orphan-sweeper")
+    _orphan_sweeper_thread.start()
+
+
+def _orphan_sweeper_loop(logger):
+    while True:
+        try:
+            sweep_orphans(shared_docker_client(), logger)
+        except Exception as e:
+            # Tidying up, not grading: a daemon that is down now is one to try again next time.
+            logger.info("could not sweep orphaned containers: {}".format(e))
+        sleep(ORPHAN_SWEEP_SEC)
+
+
+def sweep_orphans(docker_client, logger, force=False):
+    """
+    Removes orphaned containers and images, if no process on this host has in the last half interval.
+
+    Returns what was reclaimed, or None if the sweep was somebody else's to do. `force` sweeps
+    regardless of when the last one was.
+    """
+    os.makedirs(os.path.dirname(ORPHAN_SWEEP_FILE) or ".", exist_ok=True)
+    with open(ORPHAN_SWEEP_FILE, "a+") as sweep_file:
+        try:
+            fcntl.flock(sweep_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            sweep_file.seek(0)
+            last = _parse_sweep(sweep_file.read())
+            if not force and last and time() - last.get("at", 0) < ORPHAN_SWEEP_SEC / 2:
+                return None
+            swept = _sweep(docker_client, logger)
+            sweep_file.seek(0)
+            sweep_file.truncate()
+            sweep_file.write(json.dumps(swept))
+            sweep_file.flush()
+        finally:
+            fcntl.flock(sweep_file, fcntl.LOCK_UN)
+
+    metrics.count("orphan_containers_removed", swept["containers"])
+    metrics.count("orphan_images_removed", swept["images"])
+    if swept["containers"] or swept["images"] or swept["failed"]:
+        logger.info("Swept {} orphaned containers and {} images, {:.1f} MB; {} could not be removed".format(
+            swept["containers"], swept["images"], swept["image_bytes"] / 1024 / 1024, swept["failed"]))
+    return swept
+
+
+def _sweep(docker_client, logger):
+    started = time()
+    cutoff = started - ORPHAN_AGE_SEC
+    swept = {"at": started, "pid": os.getpid(), "containers": 0, "images": 0, "image_bytes": 0, "failed": 0,
+             "kept_pooled": 0}
+
+    for container in docker_client.containers.list(all=True, filters={"label": "{}={}".format(LABEL_OWNER, OWNER)}):
+        labels = container.labels or {}
+        if _created_at(labels) > cutoff:
+            continue
+        # A pooled zygote is running, and waiting: it has no other way to be ready.
+        pooled = container.status == "created" or (container.status == "running" and labels.get(LABEL_ZYGOTE))
+        if labels.get(LABEL_ROLE) == ROLE_GRADING and pooled and not admission.pid_gone(labels.get(LABEL_PID)):
+            swept["kept_pooled"] += 1
+            continue
+        try:
+            container.remove(force=True)
+        except docker.errors.NotFound:
+            continue
+        except docker.errors.APIError as e:
+            swept["failed"] += 1
+            logger.info("could not remove orphaned container {}: {}".format(container.short_id, e))
+            continue
+        swept["containers"] += 1
+
+    for image in docker_client.images.list(filters={"label": "{}={}".format(LABEL_OWNER, OWNER), "dangling": True}):
+        labels = image.labels or {}
+        if image.tags or _created_at(labels) > cutoff:
+            continue
+        try:
+            docker_client.images.remove(image=image.id, force=False)
+        except docker.errors.NotFound:
+            continue
+        except docker.errors.APIError as e:
+            # Still in use by a container, most likely, which is then gone by the next sweep.
+            swept["failed"] += 1
+            logger.info("could not remove orphaned image {}: {}".format(image.id[:19], e))
+            continue
+        swept["images"] += 1
+        swept["image_bytes"] += (image.attrs or {}).get("Size", 0)
+
+    swept["sec"] = round(time() - started, 3)
+    return swept
+
+
+def _created_at(labels):
+    """When the labels say it was created. Unreadable counts as now: what cannot be dated is kept."""
+    try:
+        return float(labels[LABEL_CREATED])
+    except (KeyError, TypeError, ValueError):
+        return time()
+
+
+def _parse_sweep(text):
+    try:
+        return json.loads(text) if text else None
+    except ValueError:
+        return None
+
+
+def orphan_sweep_status():
+    """The last sweep on this host, by whichever process did it, or None if there has not been one."""
+    try:
+        with open(ORPHAN_SWEEP_FILE) as f:
+            last = _parse_sweep(f.read())
+    except OSError:
+        last = None
+    return {"interval_sec": ORPHAN_SWEEP_SEC, "age_sec": ORPHAN_AGE_SEC, "last": last}
+
+
+# --- the per-exercise image cache ---------------------------------------------------------------------
+#
+# Every submission to one exercise ships the same grading script and the same assets — TSL-generated
+# `generated_0.py` and friends — and only the student's file differs. So those are put into an image
+# once, and each submission's container is created from that image and handed only its own file.
+#
+# The image is found by content, not by exercise: its tag is a hash of the base image's ID, the script
+# and the assets, so a teacher editing a test gets a new image without anyone invalidating anything,
+# and two exercises that happen to share everything share one image. The base image's *ID* is in the
+# key rather than its name, which is what makes a retag by easy_grading_sync.py safe — the next
+# submission hashes to a different tag and builds afresh, and the superseded images are removed on the
+# next pass over the cache because their base is no longer what the bare tag names.
+#
+# Built by committing a created container rather than by `docker build`, for the reasons above.
+#
+# The state lives where every gunicorn worker can see it: the images themselves are in Docker, and
+# the recency that decides what to evict is the mtime of a marker file per entry in a directory they
+# share. A per-key lock in the same directory stops two workers building the same image at once, which
+# would leave the loser's image behind untagged.
+#
+# Bounded by a disk budget, counted as what each image adds over its base — the script and assets,
+# usually kilobytes — rather than the size Docker reports, which includes the base and would evict
+# everything the first time.
+
+EXERCISE_IMAGE_REPO = "easy-exercise"
+LABEL_EXERCISE_KEY = "easy.aae.exercise-key"
+LABEL_EXERCISE_BASE = "easy.aae.exercise-base"
+LABEL_EXERCISE_BASE_NAME = "easy.aae.exercise-base-name"
+# Part of the key, so changing what goes into an exercise image retires every image built before.
+EXERCISE_IMAGE_LAYOUT = 1
+# 0 turns the cache off and grades every submission from the base image.
+EXERCISE_CACHE_MB = int(os.environ.get("EASY_EXERCISE_CACHE_MB", "2048"))
+# A trim lists every exercise image, so a hit does it at most this often.
+EXERCISE_CACHE_TRIM_SEC = 5 * 60
+EXERCISE_CACHE_DIR = os.environ.get(
+    "EASY_EXERCISE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "easy-exercise-images")
+)
+
+_exercise_cache_stats = {"hits": 0, "misses": 0, "built": 0, "evicted": 0, "invalidated": 0, "entries": None,
+                         "bytes": None}
+_exercise_cache_lock = threading.Lock()
+_exercise_cache_trimmed_at = 0.0
+
+
+class ExerciseImageUnavailable(Exception):
+    pass
+
+
+def exercise_image_key(base_image_id, grading_script, assets):
+    payload = json.dumps([EXERCISE_IMAGE_LAYOUT, base_image_id, grading_script, [list(a) for a in assets]])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def exercise_image(docker_client, base_image_name, grading_script, assets, logger, request_id):
+    """The tag of an image holding this exercise's script and assets on top of its base, built if needed."""
+    global _exercise_cache_trimmed_at
+
+    try:
+        base_id = docker_client.images.get(base_image_name).id
+        key = exercise_image_key(base_id, grading_script, assets)
+        tag = "{}:{}".format(EXERCISE_IMAGE_REPO, key[:40])
+
+        built = False
+        if _exercise_image_exists(docker_client, tag):
+            _count_exercise_cache("hits")
+        else:
+            _count_exercise_cache("misses")
+            with _exercise_build_lock(key):
+                # Somebody else may have built it while this waited for the lock.
+                if not _exercise_image_exists(docker_client, tag):
+                    with metrics.phase("build"):
+                        _build_exercise_image(docker_client, base_id, base_image_name, key, tag, grading_script,
+                                              assets, logger)
+                    _count_exercise_cache("built")
+                    built = True
+                    logger.info("Built exercise image {} ({})".format(tag, request_id))
+        _touch_exercise_entry(key)
+    except docker.errors.ImageNotFound:
+        # The base is missing: grading from it would fail the same way, so there is nothing to fall
+        # back to and the caller should hear it as it always has.
+        raise
+    except (docker.errors.APIError, OSError) as e:
+        raise ExerciseImageUnavailable("could not prepare the exercise image: {}".format(e))
+
+    # Only a build can push the cache over its budget, so that is when it is trimmed. A timer as well,
+    # because a retag makes images stale without anything being built on this process. By the reaper,
+    # since it lists and removes images and the submission that triggered it does not need to wait.
+    with _exercise_cache_lock:
+        trim = built or time() - _exercise_cache_trimmed_at > EXERCISE_CACHE_TRIM_SEC
+        if trim:
+            _exercise_cache_trimmed_at = time()
+    if trim:
+        _reap("images evicted from the exercise cache",
+              functools.partial(_evict_exercise_images, docker_client, logger), logger)
+    return tag
+
+
+def _exercise_image_exists(docker_client, tag):
+    try:
+        docker_client.images.get(tag)
+        return True
+    except docker.errors.ImageNotFound:
+        return False
+
+
+def _build_exercise_image(docker_client, base_id, base_image_name, key, tag, grading_script, assets, logger):
+    container = docker_client.containers.create(base_id, command=GRADING_COMMAND, network_disabled=True,
+                                                labels=_owner_labels(ROLE_BUILD))
+    try:
+        container.put_archive("/", exercise_archive(grading_script, assets))
+        repository, _, version = tag.partition(":")
+        container.commit(repository=repository, tag=version, conf={"Labels": dict(_owner_labels(ROLE_EXERCISE), **{
+            LABEL_EXERCISE_KEY: key,
+            LABEL_EXERCISE_BASE: base_id,
+            LABEL_EXERCISE_BASE_NAME: base_image_name,
+        })})
+    finally:
+        # The image is committed by now, or failed to be; the container that made it is nobody's wait.
+        _reap("build container {}".format(container.short_id), functools.partial(_remove_container, container),
+              logger)
+
+
+@contextlib.contextmanager
+def _exercise_build_lock(key):
+    os.makedirs(EXERCISE_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(EXERCISE_CACHE_DIR, key + ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _touch_exercise_entry(key):
+    try:
+        os.makedirs(EXERCISE_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(EXERCISE_CACHE_DIR, key + ".used"), "a"):
+            pass
+        os.utime(os.path.join(EXERCISE_CACHE_DIR, key + ".used"))
+    except OSError:
+        # Recency is only the order of eviction. Losing it makes a hot entry look cold, nothing worse.
+        pass
+
+
+def _last_used(key):
+    try:
+        return os.path.getmtime(os.path.join(EXERCISE_CACHE_DIR, key + ".used"))
+    except OSError:
+        # No marker: built before a restart wiped the directory. Oldest is the honest guess.
+        return 0.0
+
+
+def _forget_exercise_entry(key):
+    for suffix in (".used", ".lock"):
+        try:
+            os.remove(os.path.join(EXERCISE_CACHE_DIR, key + suffix))
+        except OSError:
+            pass
+
+
+def _evict_exercise_images(docker_client, logger):
+    """Removes images whose base has been retagged, then the least recently used until within budget."""
+    base_ids = {}
+    base_sizes = {}
+
+    def current_base_id(name):
+        if name not in base_ids:
+            try:
+                base_ids[name] = docker_client.images.get(name).id
+            except docker.errors.ImageNotFound:
+                base_ids[name] = None
+        return base_ids[name]
+
+    def base_size(image_id):
+        if image_id not in base_sizes:
+            try:
+                base_sizes[image_id] = (docker_client.images.get(image_id).attrs or {}).get("Size", 0)
+            except docker.errors.ImageNotFound:
+                base_sizes[image_id] = 0
+        return base_sizes[image_id]
+
+    entries = []
+    for image in docker_client.images.list(filters={"label": LABEL_EXERCISE_KEY}):
+        labels = image.labels or {}
+        key = labels.get(LABEL_EXERCISE_KEY)
+        base_id = labels.get(LABEL_EXERCISE_BASE)
+        stale = current_base_id(labels.get(LABEL_EXERCISE_BASE_NAME)) != base_id
+        added = max(0, (image.attrs or {}).get("Size", 0) - base_size(base_id))
+        entries.append({"image": image, "key": key, "stale": stale, "bytes": added, "used": _last_used(key)})
+
+    budget = EXERCISE_CACHE_MB * 1024 * 1024
+    total = sum(e["bytes"] for e in entries)
+    for entry in sorted(entries, key=lambda e: (not e["stale"], e["used"])):
+        if not entry["stale"] and total <= budget:
+            break
+        if _remove_exercise_image(docker_client, entry, logger):
+            total -= entry["bytes"]
+            _count_exercise_cache("invalidated" if entry["stale"] else "evicted")
+            entries.remove(entry)
+
+    with _exercise_cache_lock:
+        _exercise_cache_stats["entries"] = len(entries)
+        _exercise_cache_stats["bytes"] = total
+
+
+def _remove_exercise_image(docker_client, entry, logger):
+    tags = entry["image"].tags or []
+    # Pooled containers hold a reference to the image and would make the removal fail.
+    for tag in tags:
+        _discard_warm_pools_for(tag)
+    try:
+        with metrics.phase("remove"):
+            docker_client.images.remove(image=entry["image"].id, force=False)
+    except docker.errors.APIError as e:
+        # Most likely a submission is running on it right now. The next pass will try again.
+        logger.info("could not remove exercise image {}: {}".format(entry["image"].id[:19], e))
+        return False
+    _forget_exercise_entry(entry["key"])
+    return True
+
+
+def _count_exercise_cache(name):
+    with _exercise_cache_lock:
+        _exercise_cache_stats[name] += 1
+
+
+def exercise_cache_status():
+    """Counters of this process, and the size of the cache as this process last measured it."""
+    with _exercise_cache_lock:
+        stats = dict(_exercise_cache_stats)
+    stats.update({"pid": os.getpid(), "budget_mb": EXERCISE_CACHE_MB})
+    return stats
+
+
 # --- grading image reporting ------------------------------------------------------------------------
 
 def parse_versions(summary):
@@ -238,6 +1748,7 @@ def _installed_from_pip(docker_client, image, packages, logger):
             command=["python3", "-m", "pip", "list", "--format=json", "--disable-pip-version-check"],
             network_disabled=True,
             mem_limit="256m",
+            labels=_owner_labels(ROLE_INSPECT),
         )
         container.start()
         container.wait(timeout=PIP_TIMEOUT_SEC)
@@ -289,9 +1800,9 @@ def _live_grading_images(client):
     were built by hand before any of this existed and carry none. Production is where version
     questions actually get asked, so that is the case worth getting right.
 
-    So the rule is the one grading itself uses: `aae/containers.py` builds `FROM <bare name>`, so the
-    image a bare tag resolves to *is* the image that grades. A retained rollback copy has only its
-    `<registry>/<name>:i<digest>` tag and is correctly invisible.
+    So the rule is the one grading itself uses: `aae/containers.py` creates its containers from the
+    bare name, so the image a bare tag resolves to *is* the image that grades. A retained rollback
+    copy has only its `<registry>/<name>:i<digest>` tag and is correctly invisible.
     """
     wanted = set(grading_image_names())
     live = {}
@@ -311,7 +1822,7 @@ def _live_grading_images(client):
 
 def _refresh_grading_images(logger):
     """Rebuild the cache. Runs on a background thread, never on a request."""
-    client = docker.from_env()
+    client = shared_docker_client()
     images = []
     for name, image in _live_grading_images(client).items():
         labels = image.labels or {}
@@ -390,9 +1901,12 @@ def grading_images(logger):
             _image_cache = {"at": from_file["at"], "images": from_file["images"]}
         return list(from_file["images"])
 
-    # One refresh at a time, and the request does not wait for it.
-    if not _refresh_running.is_set():
+    # One refresh at a time, and the request does not wait for it. Checked and set under the lock: with
+    # threads sharing this process, two requests can both find it unset between the check and the set.
+    with _image_cache_lock:
+        start = not _refresh_running.is_set()
         _refresh_running.set()
+    if start:
         # Captured now, not read inside the thread. See _write_cache_file.
         cache_path = IMAGE_CACHE_FILE
 
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""Deadlines: not grading for a caller who has stopped waiting.
+
+Core gives up on a request after its own timeout, and the executor never knew. During a backlog that
+is the worst case: the requests waiting longest are the ones core has already abandoned, and each
+was still built, run and parsed, taking a container from a request somebody was still waiting for.
+So a request to `/v1/grade` can say when its caller will stop waiting, in either of two headers:
+
+- `X-Request-Timeout`: seconds left, counted from when the request arrives. This one is preferred,
+  because it does not depend on the two hosts' clocks agreeing.
+- `X-Request-Deadline`: the moment itself, as a Unix time in seconds.
+
+If both are sent, the earlier deadline wins. Without either, nothing here applies and a request is
+graded however long it waits, as before.
+
+### Refused up front
+
+A request is refused with 503 before anything runs if its run would probably not finish in time. That
+is when the time left, less `DEADLINE_MARGIN_SEC` for the answer to get back, is shorter than the
+median of recent runs on its image (`load.py`), capped at its `max_time_sec`. With no runs on the image
+yet, only a deadline that has already passed is refused. This is checked when the request arrives.
+It is checked again after the wait for a job thread and for admission, since a backlog spends the
+time there. A grade the result cache remembers (`results.py`) is never refused: answering it takes no
+time.
+
+### Killed at the deadline
+
+A run that was admitted is followed by a `DeadlineListener` (see "following a run" in
+`containers.py`). At the deadline it kills the container, just as a closed stream does. The run ends
+in GradingAbandoned, which is never remembered as a grade, and the request is answered 503 for
+whoever is still reading.
+
+The deadline is the request's, not the run's. An identical request that joined the run (see "identical
+requests at the same time" in `results.py`) does not get the 503: it runs the submission again itself,
+by its own deadline or without one. And a request with a deadline waits for a run somebody else started
+only until its own.
+
+`easy_deadline_refused_total` and `easy_deadline_killed_total` in `/v1/metrics` count both. During
+overload the first should rise and the second stay near zero: stale work dropped before it started.
+"""
+import contextvars
+import os
+import threading
+from time import time
+
+import load
+import metrics
+
+TIMEOUT_HEADER = "X-Request-Timeout"
+DEADLINE_HEADER = "X-Request-Deadline"
+# Left at the end for the answer to reach the caller: parsing the output, and the trip back.
+DEADLINE_MARGIN_SEC = float(os.environ.get("EASY_DEADLINE_MARGIN_SEC", "0.5"))
+
+
+class DeadlinePassed(Exception):
+    """The caller's deadline has passed, or will before the run could finish."""
+
+
+def from_headers(headers, now=None):
+    """The caller's deadline as a Unix time, or None if it did not give one. ValueError if it is not a number."""
+    now = time() if now is None else now
+    deadlines = []
+    timeout = headers.get(TIMEOUT_HEADER)
+    if timeout is not None:
+        deadlines.append(now + _seconds(TIMEOUT_HEADER, timeout))
+    deadline = headers.get(DEADLINE_HEADER)
+    if deadline is not None:
+        deadlines.append(_seconds(DEADLINE_HEADER, deadline))
+    return min(deadlines) if deadlines else None
+
+
+def _seconds(name, value):
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise ValueError("{} must be a number of seconds".format(name))
+    if seconds != seconds or seconds in (float("inf"), float("-inf")):
+        raise ValueError("{} must be a number of seconds".format(name))
+    return seconds
+
+
+def check(deadline, max_time_sec, image_name):
+    """Raises DeadlinePassed if a run of this image probably cannot finish before `deadline`. None passes."""
+    if deadline is None:
+        return
+    left = deadline - time() - DEADLINE_MARGIN_SEC
+    typical = load.typical_grade_sec(image_name)
+    needed = min(typical, max_time_sec) if typical is not None else 0
+    if left <= needed:
+        metrics.count("deadline_refused")
+        if left <= 0:
+            raise DeadlinePassed("the caller's deadline has passed")
+        raise DeadlinePassed("{:.1f} s left before the caller's deadline, and runs on {} take {:.1f} s".format(
+            left, image_name, needed))
+
+
+def wait_left(deadline, wait_sec):
+    """`wait_sec`, or less if the deadline comes first: there is no point waiting for room past it."""
+    if deadline is None:
+        return wait_sec
+    return min(wait_sec, max(deadline - time() - DEADLINE_MARGIN_SEC, 0))
+
+
+class DeadlineListener:
+    """
+    Follows a run for `inner` (another listener, or None) and kills it at `deadline`. `expired` says
+    whether it did, which is how the GradingAbandoned that follows is told apart from a closed stream.
+    """
+
+    def __init__(self, deadline, inner=None):
+        self.deadline = deadline
+        self.inner = inner
+        self.expired = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def started(self, container_id):
+        if self.inner is not None:
+            self.inner.started(container_id)
+
+    def output(self, chunk):
+        if self.inner is not None:
+            self.inner.output(chunk)
+
+    def on_abandon(self, callback):
+        if self.inner is not None:
+            self.inner.on_abandon(callback)
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if callback is None:
+                return
+            left = self.deadline - time()
+            if left > 0:
+                # In the run's trace context, as the time limit's own timer is.
+                self._timer = threading.Timer(left, contextvars.copy_context().run, [self._expire, callback])
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._expire(callback)
+
+    def _expire(self, callback):
+        with self._lock:
+            if self.expired:
+                return
+            self.expired = True
+        metrics.count("deadline_killed")
+        callback()
@@ -0,0 +1,242 @@
+# coding=utf-8
+"""Grading as a job: submitted, answered at once with an ID, and collected later.
+
+`POST /v1/grade` holds a gunicorn worker and an HTTP connection for as long as the container runs, so
+how many submissions grade at once is decided by how many workers there are — a number chosen for
+HTTP, not for the machine — and the worker timeout has to be longer than the slowest exercise. A job
+separates the two. The request that submits it returns immediately; the grading runs on a pool of
+threads sized to the host; the result is fetched by a second request that may wait for it (a long
+poll) but never for longer than `JOB_MAX_WAIT_SEC`, which is what lets the worker timeout come back
+down to something that catches a hung worker.
+
+### Where a job lives
+
+A job runs in the process that accepted it, and under gunicorn the request that asks about it will
+usually land on a *different* worker. So every state a job passes through is written to a file in a
+directory the workers share, and that file is the answer to "how is job X doing", whoever asks. The
+process that runs a job also keeps it in memory, which is only there to wake a long poll the moment
+the job finishes rather than at the next look at the file.
+
+Only jobs submitted through the jobs API have a file. The jobs behind `/v1/grade` and each item of a
+batch are waited for by the request that made them, in the same process, so nobody can ever ask
+about them; they stay in memory, and their feedback is never written to disk.
+
+A job whose process died — a gunicorn restart, a worker killed for its timeout — would otherwise say
+"running" for ever. The file records the pid that owns it, and a reader that finds the pid gone
+reports the job as failed instead. Pid reuse could in principle hide a dead job behind a new process;
+a retention of an hour and a restart that changes every worker's pid make that a non-question here.
+
+### What is bounded
+
+Running jobs, by `JOB_WORKERS` threads per process. Waiting jobs, by `JOB_QUEUE_LIMIT` per process —
+a queue that only grows is memory spent on submissions nobody will get an answer for in time, and a
+clear "come back later" is more use to core than that. Finished jobs, by `JOB_RETENTION_SEC`: a
+result nobody has fetched in an hour will not be.
+"""
+import concurrent.futures
+import json
+import os
+import re
+import tempfile
+import threading
+import uuid
+from time import time
+
+import admission
+
+# Threads grading at once in this process. The default is the machine's CPUs, which is right for one
+# process; the Ansible role divides it between gunicorn workers (`executor_job_workers`).
+JOB_WORKERS = int(os.environ.get("EASY_JOB_WORKERS", "0")) or (os.cpu_count() or 1)
+# Jobs accepted but not finished, per process, before a submission is refused.
+JOB_QUEUE_LIMIT = int(os.environ.get("EASY_JOB_QUEUE_LIMIT", "100"))
+JOB_RETENTION_SEC = int(os.environ.get("EASY_JOB_RETENTION_SEC", str(60 * 60)))
+# The longest a single long poll is held. Well inside the gunicorn timeout, so a poll is never what
+# gets a worker killed.
+JOB_MAX_WAIT_SEC = 30
+# How often a long poll for another process's job looks at the file again.
+JOB_POLL_SEC = 0.2
+JOBS_DIR = os.environ.get("EASY_JOBS_DIR", os.path.join(tempfile.gettempdir(), "easy-jobs"))
+# Finished files are swept on submission, but not more often than this.
+JOB_SWEEP_SEC = 60
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# This process's unfinished jobs. A job leaves when it finishes; from then on only its file knows it.
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+_swept_at = 0.0
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, job_id, persisted):
+        self.id = job_id
+        # Whether its states are written to its file, for another process to read.
+        self.persisted = persisted
+        self.finished = threading.Event()
+        self.future = None
+
+
+def submit(run, bounded=True):
+    """
+    Queues `run(job_id)`, whose return value is the job's result, and returns the job's ID.
+
+    `bounded=False` is for `/v1/grade`, which waits for its own job and so cannot pile anything up: a
+    sync worker has one request at a time. Refusing it for a queue that the job API filled would turn
+    the endpoint core depends on into one that can answer 503, which it never could.
+    """
+    return _submit(run, bounded, persisted=True).id
+
+
+def run_and_wait(run):
+    """Runs `run` as a job and returns its result, raising whatever it raised."""
+    return run_later(run).result()
+
+
+def run_later(run):
+    """
+    Runs `run` as an unbounded job (see `submit`) and returns its future, for a caller that waits. Its
+    ID is never handed out, so it has no file: nothing could ever read one.
+    """
+    return _submit(run, bounded=False, persisted=False).future
+
+
+def _submit(run, bounded, persisted):
+    global _executor
+
+    job = _Job(uuid.uuid4().hex, persisted)
+    with _jobs_lock:
+        if bounded and len(_jobs) >= JOB_QUEUE_LIMIT:
+            raise QueueFull("{} jobs are already waiting".format(len(_jobs)))
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(JOB_WORKERS, thread_name_prefix="easy-job")
+        _jobs[job.id] = job
+    if persisted:
+        _write(job.id, {"status": QUEUED, "submitted_at": time()})
+    job.future = _executor.submit(_run, job, run)
+    if persisted:
+        _sweep()
+    return job
+
+
+def _run(job, run):
+    record = (_read(job.id) if job.persisted else None) or {}
+    record.update(status=RUNNING, started_at=time())
+    if job.persisted:
+        _write(job.id, record)
+    try:
+        result = run(job.id)
+    except Exception as e:
+        record.update(status=FAILED, finished_at=time(), error=str(e) or type(e).__name__)
+        raise
+    else:
+        record.update(status=DONE, finished_at=time(), result=result)
+        return result
+    finally:
+        if job.persisted:
+            _write(job.id, record)
+        with _jobs_lock:
+            _jobs.pop(job.id, None)
+        job.finished.set()
+
+
+def status(job_id):
+    """A job's record, or None if there is no such job (or it finished too long ago to remember)."""
+    if not _JOB_ID.match(job_id):
+        return None
+    record = _read(job_id)
+    if record is None:
+        return None
+    if record["status"] not in FINISHED and _is_orphaned(job_id, record):
+        record.update(status=FAILED, error="the executor process grading this job exited")
+    record.pop("pid", None)
+    record["id"] = job_id
+    return record
+
+
+def wait(job_id, timeout):
+    """
+    A job's record once it has finished, or as it stands after `timeout` seconds, whichever is first.
+    None if there is no such job.
+    """
+    deadline = time() + min(max(timeout, 0), JOB_MAX_WAIT_SEC)
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        job.finished.wait(max(deadline - time(), 0))
+        return status(job_id)
+
+    record = status(job_id)
+    while record is not None and record["status"] not in FINISHED and time() < deadline:
+        threading.Event().wait(min(JOB_POLL_SEC, max(deadline - time(), 0)))
+        record = status(job_id)
+    return record
+
+
+def jobs_status():
+    """How many jobs this process has unfinished, and how many it may have."""
+    with _jobs_lock:
+        unfinished = len(_jobs)
+    return {"pid": os.getpid(), "workers": JOB_WORKERS, "queue_limit": JOB_QUEUE_LIMIT, "unfinished": unfinished}
+
+
+def _is_orphaned(job_id, record):
+    pid = record.get("pid")
+    if pid == os.getpid():
+        with _jobs_lock:
+            return job_id not in _jobs
+    return admission.pid_gone(pid)
+
+
+def _path(job_id):
+    return os.path.join(JOBS_DIR, job_id + ".json")
+
+
+def _write(job_id, record):
+    # Atomically, because a reader in another worker may open it at any moment and a half-written
+    # result reads as no result at all.
+    record["pid"] = os.getpid()
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    tmp = "{}.{}.new".format(_path(job_id), threading.get_ident())
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(record, f)
+    os.replace(tmp, _path(job_id))
+
+
+def _read(job_id):
+    try:
+        with open(_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _sweep():
+    """Removes job files nobody touched for `JOB_RETENTION_SEC`. At most once a `JOB_SWEEP_SEC`."""
+    global _swept_at
+
+    now = time()
+    if now - _swept_at < JOB_SWEEP_SEC:
+        return
+    _swept_at = now
+    try:
+        names = os.listdir(JOBS_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_RETENTION_SEC:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,182 @@
+# coding=utf-8
+"""How loaded this host is, for core to choose an executor by, in one answer that is cheap to poll.
+
+Core's scheduler picks an executor from its own queue lengths and a `maxLoad` somebody typed into the
+database. It cannot tell an executor grading two heavy submissions on a host that is swapping from one
+grading two light ones on an idle host. `/v1/load` gives it what the host knows:
+
+- **Running containers**, from the admission leases (`admission.py`). They are host-wide, so every
+  worker gives the same count.
+- **Memory.** What the running containers' limits add up to, against the budget admission promises
+  from, and the host's total and available memory as the kernel reports them.
+- **CPU pressure.** The kernel's pressure stall information for the CPU, `/proc/pressure/cpu`: the
+  share of time in the last 10, 60 and 300 seconds that some (or all) runnable tasks waited for a CPU.
+  Load average counts tasks. Pressure counts time lost waiting, which is what makes a time limit
+  unfair. Null on a kernel without PSI.
+- **Grade times per image**, the median and 95th percentile of recent runs, by the images' labels in
+  `/v1/metrics`: any image that is not one of the host's grading images counts as `other`. These are
+  for the answering process only, as `typical_duration_sec` in `/v1/admission` is. Under the threaded model
+  (`gunicorn-threads-conf.py.sample`) that is the whole host.
+- **Safe additional slots.** How many more runs of `mem_mb` (a query parameter, `LOAD_SLOT_MB` by
+  default) admission would take now: the fewer of the free container slots and the memory budget left
+  over. It is 0 while CPU pressure over the last 10 seconds is at `LOAD_CPU_PRESSURE_LIMIT` or above:
+  a host whose runs are already waiting for a CPU has no room, whatever the budgets say. Null with
+  admission off, since there is then nothing to count against.
+
+### Cheap to poll
+
+Core polls every few seconds, from every instance, so the answer comes from a snapshot kept in memory
+and rebuilt at most every `LOAD_SNAPSHOT_SEC`. A rebuild reads two files under /proc and lists the
+lease directory. No Docker call is ever made here. The slots arithmetic is done per request, from the
+snapshot's numbers, so a different `mem_mb` does not cost a rebuild.
+"""
+import collections
+import math
+import os
+import threading
+from time import monotonic, time
+
+import admission
+import metrics
+
+# How old the snapshot may be before a request rebuilds it.
+LOAD_SNAPSHOT_SEC = 1.0
+# The run size "safe additional slots" counts in when the request does not say.
+LOAD_SLOT_MB = int(os.environ.get("EASY_LOAD_SLOT_MB", "256"))
+# CPU pressure (some, avg10, in percent) from which the host reports no room.
+LOAD_CPU_PRESSURE_LIMIT = float(os.environ.get("EASY_LOAD_CPU_PRESSURE_LIMIT", "25"))
+# Runs per image kept for the percentiles, and how far back they may be.
+LOAD_GRADE_WINDOW = 200
+LOAD_GRADE_WINDOW_SEC = 10 * 60
+PSI_CPU_FILE = "/proc/pressure/cpu"
+MEMINFO_FILE = "/proc/meminfo"
+
+# image -> (when, seconds) of its recent runs
+_grades = {}
+_grades_lock = threading.Lock()
+_snapshot = {"at": None, "value": None}
+_snapshot_lock = threading.Lock()
+
+
+def record_grade(image_name, seconds):
+    """One finished run on `image_name`, which took `seconds` from claiming a container to its output."""
+    label = metrics.image_label(image_name)
+    with _grades_lock:
+        runs = _grades.get(label)
+        if runs is None:
+            runs = _grades[label] = collections.deque(maxlen=LOAD_GRADE_WINDOW)
+        runs.append((time(), seconds))
+
+
+def typical_grade_sec(image_name):
+    """
+    The median of `image_name`'s recent runs on this process, in seconds. None before there are any,
+    and for an image that is not one of the host's grading images: those are kept together, and how
+    long some other image took says nothing about this one.
+    """
+    label = metrics.image_label(image_name)
+    if label == metrics.OTHER_IMAGE:
+        return None
+    since = time() - LOAD_GRADE_WINDOW_SEC
+    with _grades_lock:
+        times = sorted(s for at, s in _grades.get(label, ()) if at >= since)
+    return _percentile(times, 0.5) if times else None
+
+
+def load_status(mem_mb=None):
+    """The snapshot, with the slots a run of `mem_mb` (LOAD_SLOT_MB if None) would still find."""
+    snapshot = _current_snapshot()
+    mem_mb = LOAD_SLOT_MB if mem_mb is None else mem_mb
+    return dict(snapshot, slot_mem_mb=mem_mb, safe_additional_slots=safe_additional_slots(snapshot, mem_mb))
+
+
+def safe_additional_slots(snapshot, mem_mb):
+    """More runs of `mem_mb` admission would take now, 0 under CPU pressure; None with admission off."""
+    if snapshot["running"] is None:
+        return None
+    pressure = snapshot["cpu_pressure"]
+    if pressure is not None and pressure["some"]["avg10"] >= LOAD_CPU_PRESSURE_LIMIT:
+        return 0
+    slots = snapshot["max_containers"] - snapshot["running"]
+    budget = snapshot["mem_mb"]["budget"]
+    if budget:
+        # As admission counts it: a run bigger than the whole budget takes all of it.
+        slots = min(slots, (budget - snapshot["mem_mb"]["promised"]) // max(min(mem_mb, budget), 1))
+    return max(slots, 0)
+
+
+def _current_snapshot():
+    with _snapshot_lock:
+        if _snapshot["at"] is None or monotonic() - _snapshot["at"] >= LOAD_SNAPSHOT_SEC:
+            _snapshot["value"] = _build_snapshot()
+            _snapshot["at"] = monotonic()
+        return _snapshot["value"]
+
+
+def _build_snapshot():
+    status = admission.admission_status()
+    enabled = status["enabled"]
+    meminfo = _meminfo()
+    return {
+        "pid": os.getpid(),
+        "at": time(),
+        "running": status["running"] if enabled else None,
+        "max_containers": status["max_containers"] if enabled else None,
+        "mem_mb": {
+            "promised": status["mem_mb_promised"] if enabled else None,
+            "budget": status["mem_mb_budget"] if enabled else admission.memory_budget_mb(),
+            "host": meminfo.get("MemTotal"),
+            "available": meminfo.get("MemAvailable"),
+        },
+        "cpu_pressure": cpu_pressure(),
+        "grade_sec": _grade_percentiles(),
+    }
+
+
+def cpu_pressure(path=None):
+    """`/proc/pressure/cpu` as {"some": {"avg10": ...}, "full": {...}}, in percent. None without PSI."""
+    try:
+        with open(path or PSI_CPU_FILE) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    pressure = {}
+    try:
+        for line in lines:
+            kind, *fields = line.split()
+            values = dict(field.split("=", 1) for field in fields)
+            pressure[kind] = {name: float(values[name]) for name in ("avg10", "avg60", "avg300")}
+    except (KeyError, ValueError):
+        return None
+    if "some" not in pressure:
+        return None
+    # Kernels before 5.13 have no `full` line for the CPU.
+    pressure.setdefault("full", None)
+    return pressure
+
+
+def _meminfo():
+    """MemTotal and MemAvailable, in MB. Empty if /proc/meminfo cannot be read."""
+    found = {}
+    try:
+        with open(MEMINFO_FILE) as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in ("MemTotal", "MemAvailable"):
+                    found[name] = int(rest.split()[0]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return found
+
+
+def _grade_percentiles():
+    since = time() - LOAD_GRADE_WINDOW_SEC
+    with _grades_lock:
+        recent = {image: sorted(s for at, s in runs if at >= since) for image, runs in _grades.items()}
+    return {image: {"count": len(times), "p50": _percentile(times, 0.5), "p95": _percentile(times, 0.95)}
+            for image, times in sorted(recent.items()) if times}
+
+
+def _percentile(ordered, q):
+    """Nearest rank: the smallest value that at least `q` of the values do not exceed."""
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
@@ -0,0 +1,359 @@
+# coding=utf-8
+"""Where the time goes when a submission is graded, for the whole host, in Prometheus' text format.
+
+Until this the only timing the executor emitted was "Request started/finished" at debug level, which
+says a grading took eleven seconds and nothing about whether that was the image build, the container
+start, or the student's program. Capacity planning needs the split, so each phase of a grading run
+is timed into a histogram of its own:
+
+- `build` — the per-exercise image, when it has to be built (a cache hit is not a build).
+- `create_start` — claiming a container (from the pool, or created), pinning it, and starting it.
+- `materialise` — the daemon writing the submission's files into the container. The tar itself is
+  built in memory beforehand in well under a millisecond, so what is timed is the copy.
+- `run` — from the start until the container has exited and its status has been read.
+- `logs` — attaching to the output and decoding what was kept. The output is *read* while the
+  container runs (see `OutputCapture`), so most of the reading is inside `run`; this is the rest.
+- `remove` — removing a grading container, or an exercise image the cache evicted. Done by the
+  reaper after the grade has gone back, so it is not part of what a student waits for.
+- `parse` — turning the output into a grade and the feedback a student sees.
+
+Besides those, a counter of finished runs by status and by base image (see `image_label`), a gauge of the grading
+containers in use by a run right now, and the reaper's backlog and the removals it gave up on — the
+containers that leaked — and what the orphan sweep found of them afterwards. And the requests dropped
+before they ran, or killed while they ran, because their caller's deadline passed (`deadlines.py`).
+
+### One answer for the host
+
+Gunicorn's workers are processes, and a scrape lands on one of them, so numbers kept in memory
+would describe whichever worker answered. Each process therefore writes a snapshot of its own
+numbers to a file in `METRICS_DIR` — at most once a second, and within a second of anything
+changing — and a scrape adds up every snapshot. Counters and histograms are summed over every
+process that has ever graded; a snapshot left by a worker that has exited is folded into a
+`retired` file under an `flock`, so a worker restart does not make a counter go backwards. The
+gauge is only summed over live processes: a dead worker has no containers.
+
+The directory is under the unit's private /tmp, so a service restart starts every counter at zero,
+which Prometheus reads as the reset it is.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from time import monotonic, time
+
+import admission
+import tracing
+
+METRICS_DIR = os.environ.get("EASY_METRICS_DIR", os.path.join(tempfile.gettempdir(), "easy-metrics"))
+# Upper bounds, in seconds. From the time a warm container takes to start to the longest time limit.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PHASES = ("build", "create_start", "materialise", "run", "logs", "remove", "parse")
+# The most often a process rewrites its snapshot.
+METRICS_FLUSH_SEC = 1.0
+RETIRED = "retired"
+# The image label of every run on an image the host is not configured to grade with.
+OTHER_IMAGE = "other"
+
+_lock = threading.Lock()
+# phase -> per-bucket counts (the last is +Inf), the sum and the count. Not cumulative until exposed.
+_histograms = {}
+# (status, image label) -> finished runs
+_runs = {}
+_in_flight = 0
+# Other counters and gauges, by name. Only the ones in HELP are exposed.
+_counters = {}
+_gauges = {}
+HELP = {
+    "reaper_failures": "Removals the reaper gave up on: containers or images leaked until the orphan sweep.",
+    "reaper_backlog": "Removals queued for the reaper and not yet done.",
+    "orphan_containers_removed": "Containers of dead or long-finished runs removed by the orphan sweep.",
+    "orphan_images_removed": "Untagged exercise images removed by the orphan sweep.",
+    "deadline_refused": "Requests refused because their caller's deadline would pass before the run finished.",
+    "deadline_killed": "Runs killed because their caller's deadline passed while they ran.",
+}
+_flushed_at = 0.0
+_flush_timer = None
+
+
+def observe(phase, seconds):
+    """Records that one `phase` took `seconds`."""
+    with _lock:
+        histogram = _histograms.get(phase)
+        if histogram is None:
+            histogram = _histograms[phase] = {"buckets": [0] * (len(METRICS_BUCKETS) + 1), "sum": 0.0, "count": 0}
+        histogram["buckets"][_bucket(seconds)] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+    _flush_soon()
+
+
+def _bucket(seconds):
+    for i, bound in enumerate(METRICS_BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(METRICS_BUCKETS)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the block into `name`'s histogram — also when it raises: a failed start took time too."""
+    started = monotonic()
+    try:
+        with tracing.span("phase:" + name):
+            yield
+    finally:
+        observe(name, monotonic() - started)
+
+
+class Phases:
+    """
+    For a phase that is interrupted by another: the files are delivered between a container's create
+    and its start, and `create_start` is one phase either side of that. Each block adds to its phase's
+    total, and `observe()` records the totals once each.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        started = monotonic()
+        try:
+            with tracing.span("phase:" + name):
+                yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + monotonic() - started
+
+    def observe(self):
+        for name, seconds in self.totals.items():
+            observe(name, seconds)
+        self.totals = {}
+
+
+def count_run(status, image_name):
+    """One finished run. `status` is a RunStatus name, "ERROR" for a run that raised, or "ABANDONED"."""
+    label = image_label(image_name)
+    with _lock:
+        _runs[(status, label)] = _runs.get((status, label), 0) + 1
+    _flush_soon()
+
+
+def image_label(image_name):
+    """
+    What a run on `image_name` is counted under: its bare name if it is one of the host's grading
+    images, and OTHER_IMAGE if not. The image is whatever the request named, so labelling by it as
+    given would let requests add series without end, each kept by every snapshot and every scrape.
+    """
+    from containers import grading_image_names  # containers imports this module
+
+    bare = image_name.split("@", 1)[0]
+    if ":" in bare.rsplit("/", 1)[-1]:
+        bare = bare.rsplit(":", 1)[0]
+    return bare if bare in grading_image_names() else OTHER_IMAGE
+
+
+def count(name, n=1):
+    """Adds `n` to the counter `name`, exposed as `easy_<name>_total`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    _flush_soon()
+
+
+def gauge(name, value):
+    """Sets this process's part of the gauge `name`, exposed as `easy_<name>` and summed over live processes."""
+    with _lock:
+        _gauges[name] = value
+    _flush_soon()
+
+
+@contextlib.contextmanager
+def container_in_flight():
+    """Counts a grading container for as long as the block holds it."""
+    global _in_flight
+
+    with _lock:
+        _in_flight += 1
+    # A gauge that lags by a second reads as a container that is not there; written at once.
+    flush()
+    try:
+        yield
+    finally:
+        with _lock:
+            _in_flight -= 1
+        flush()
+
+
+# --- the snapshot ---------------------------------------------------------------------------------
+
+def _flush_soon():
+    """Writes the snapshot now, or — if one was written less than a second ago — a second after it."""
+    global _flush_timer
+
+    with _lock:
+        wait = _flushed_at + METRICS_FLUSH_SEC - monotonic()
+        if wait > 0:
+            if _flush_timer is None:
+                _flush_timer = threading.Timer(wait, flush)
+                _flush_timer.daemon = True
+                _flush_timer.start()
+            return
+    flush()
+
+
+def flush():
+    """Writes this process's numbers to its snapshot. Never raises: metrics are not worth a grade."""
+    global _flushed_at, _flush_timer
+
+    with _lock:
+        _flushed_at = monotonic()
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        snapshot = _snapshot()
+    try:
+        _write(_path(os.getpid()), snapshot)
+    except OSError:
+        pass
+
+
+def _snapshot():
+    return {
+        "pid": os.getpid(),
+        "written_at": time(),
+        "histograms": {name: dict(h, buckets=list(h["buckets"])) for name, h in _histograms.items()},
+        "runs": [[status, image, n] for (status, image), n in _runs.items()],
+        "in_flight": _in_flight,
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+    }
+
+
+def _path(name):
+    return os.path.join(METRICS_DIR, "{}.json".format(name))
+
+
+def _write(path, snapshot):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    tmp = "{}.{}.new".format(path, threading.get_ident())
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# --- adding the processes up ----------------------------------------------------------------------
+
+def host_totals():
+    """Every process's numbers added up, with the snapshots of exited processes folded into `retired`."""
+    flush()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        retired = _read(_path(RETIRED)) or _empty()
+        live = []
+        folded = False
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith(".json") or name == RETIRED + ".json":
+                continue
+            snapshot = _read(os.path.join(METRICS_DIR, name))
+            if snapshot is None:
+                continue
+            if admission.pid_gone(snapshot.get("pid")):
+                _add(retired, snapshot)
+                folded = True
+                os.remove(os.path.join(METRICS_DIR, name))
+            else:
+                live.append(snapshot)
+        if folded:
+            _write(_path(RETIRED), retired)
+
+    totals = _empty()
+    _add(totals, retired)
+    for snapshot in live:
+        _add(totals, snapshot)
+        totals["in_flight"] += snapshot.get("in_flight", 0)
+        for name, value in snapshot.get("gauges", {}).items():
+            totals["gauges"][name] = totals["gauges"].get(name, 0) + value
+    totals["processes"] = len(live)
+    return totals
+
+
+def _empty():
+    return {"histograms": {}, "runs": [], "in_flight": 0, "counters": {}, "gauges": {}}
+
+
+def _add(into, snapshot):
+    """Adds `snapshot`'s counters and histograms to `into`. Not the gauge: that is only for the living."""
+    for name, histogram in snapshot.get("histograms", {}).items():
+        total = into["histograms"].get(name)
+        if total is None or len(total["buckets"]) != len(histogram["buckets"]):
+            # Also when the buckets were changed between deploys: the old counts cannot be rebucketed.
+            into["histograms"][name] = dict(histogram, buckets=list(histogram["buckets"]))
+            continue
+        total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+        total["sum"] += histogram["sum"]
+        total["count"] += histogram["count"]
+    runs = {(status, image): n for status, image, n in into["runs"]}
+    for status, image, n in snapshot.get("runs", []):
+        runs[(status, image)] = runs.get((status, image), 0) + n
+    into["runs"] = [[status, image, n] for (status, image), n in runs.items()]
+    counters = into.setdefault("counters", {})
+    for name, n in snapshot.get("counters", {}).items():
+        counters[name] = counters.get(name, 0) + n
+
+
+# --- the text format ------------------------------------------------------------------------------
+
+def exposition():
+    """The host's numbers in the Prometheus text exposition format, version 0.0.4."""
+    totals = host_totals()
+    lines = [
+        "# HELP easy_grading_phase_seconds Time spent in each phase of grading a submission.",
+        "# TYPE easy_grading_phase_seconds histogram",
+    ]
+    for name in sorted(totals["histograms"], key=lambda n: (PHASES.index(n) if n in PHASES else len(PHASES), n)):
+        histogram = totals["histograms"][name]
+        cumulative = 0
+        for bound, n in zip(list(METRICS_BUCKETS) + ["+Inf"], histogram["buckets"]):
+            cumulative += n
+            lines.append('easy_grading_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                _escape(name), bound, cumulative))
+        lines.append('easy_grading_phase_seconds_sum{{phase="{}"}} {}'.format(_escape(name), histogram["sum"]))
+        lines.append('easy_grading_phase_seconds_count{{phase="{}"}} {}'.format(_escape(name), histogram["count"]))
+
+    lines += [
+        "# HELP easy_grading_runs_total Grading runs finished, by how they ended and the base image.",
+        "# TYPE easy_grading_runs_total counter",
+    ]
+    for status, image, n in sorted(totals["runs"]):
+        lines.append('easy_grading_runs_total{{status="{}",image="{}"}} {}'.format(_escape(status), _escape(image), n))
+
+    lines += [
+        "# HELP easy_grading_containers_in_flight Grading containers that exist right now.",
+        "# TYPE easy_grading_containers_in_flight gauge",
+        "easy_grading_containers_in_flight {}".format(totals["in_flight"]),
+        "# HELP easy_executor_processes Executor processes whose numbers are in this answer.",
+        "# TYPE easy_executor_processes gauge",
+        "easy_executor_processes {}".format(totals["processes"]),
+    ]
+    for name in sorted(HELP):
+        if name in totals["gauges"]:
+            lines += ["# HELP easy_{} {}".format(name, HELP[name]), "# TYPE easy_{} gauge".format(name),
+                      "easy_{} {}".format(name, totals["gauges"][name])]
+        else:
+            lines += ["# HELP easy_{}_total {}".format(name, HELP[name]), "# TYPE easy_{}_total counter".format(name),
+                      "easy_{}_total {}".format(name, totals["counters"].get(name, 0))]
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
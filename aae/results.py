@@ -0,0 +1,284 @@
+# coding=utf-8
+"""Remembering grades: a byte-identical resubmission is answered without running anything.
+
+Students resubmit the same code constantly — a double click, a retry after the page did not seem to
+react, a resubmission "just to be sure" — and each one used to cost a full container run for an
+answer the executor had already given. Grading is deterministic enough that the answer can be kept:
+the same submission, graded by the same script with the same assets, on the same image, within the
+same limits, gets the same grade.
+
+### What the key is made of
+
+All of the above, hashed — and the image by its **ID**, resolved when the request arrives. That is
+what makes a retag safe without anyone invalidating anything: once easy_grading_sync.py moves a bare
+tag to a new grading library, the next submission resolves to a different ID and hashes to a different
+key, and the old entries simply stop being asked for until the LRU drops them.
+
+### What is kept
+
+Only runs that finished (`SUCCESS`). A timeout or a memory kill says as much about how busy the host
+was as about the submission, and caching one would tell a student their program is too slow for as
+long as the entry lived, however idle the host became. What is kept is the response body, so a hit is
+the answer the first run gave: the same grade and feedback, with `cached: true`. Without `usage`,
+since a hit ran nothing, and somebody tuning limits from it would otherwise count one run many times.
+
+### Where
+
+In memory, per process, bounded by `RESULT_CACHE_MB` of feedback with the least recently used
+dropped first. Optionally also on disk in `RESULT_CACHE_DIR`, which every gunicorn worker shares —
+otherwise a resubmission that lands on another worker misses — bounded by `RESULT_CACHE_DISK_MB` the
+same way, with the file mtime as the recency.
+
+### Identical requests at the same time
+
+A double click sends two requests a few milliseconds apart, and a cache that only remembers finished
+runs would run both. So the first becomes the one that runs and the second waits for it and gets its
+answer (single flight). Waiting is not caching: the waiter gets the answer whatever it was, timeout
+included, because it asked the same question at the same moment. What it does not get is a failure
+that was the first request's own — its client went away, or its wait for room ran out — and then it
+tries again itself. Nor does it wait for it past its own deadline, if it has one. Within a process
+that is a future;
+between processes it is an `flock` per key in the disk cache, so without a disk cache two workers can
+still both run the same submission.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from time import time
+
+# 0 turns the cache off.
+RESULT_CACHE_MB = float(os.environ.get("EASY_RESULT_CACHE_MB", "64"))
+# Unset keeps the cache in memory only.
+RESULT_CACHE_DIR = os.environ.get("EASY_RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MB = float(os.environ.get("EASY_RESULT_CACHE_DISK_MB", "512"))
+# A disk trim lists the directory, so it is done at most this often.
+RESULT_CACHE_TRIM_SEC = 60
+RESULT_LOCK_MAX_AGE_SEC = 60 * 60
+# Part of the key, so changing what a result means retires every result kept before.
+RESULT_LAYOUT = 1
+
+_memory = collections.OrderedDict()
+_memory_bytes = 0
+_in_flight = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "collapsed": 0, "stored": 0}
+_trimmed_at = 0.0
+
+
+def enabled():
+    return RESULT_CACHE_MB > 0
+
+
+def result_key(submission, grading_script, assets, base_image_id, limits):
+    """`limits` is everything the container is limited by — time, memory, CPU — as a tuple."""
+    payload = json.dumps([RESULT_LAYOUT, submission, grading_script, [list(a) for a in assets], base_image_id,
+                          list(limits)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StillRunning(Exception):
+    """The identical run a request waited for had not finished when the request stopped waiting."""
+
+
+def get_or_compute(key, compute, retry_on=(), until=None):
+    """
+    The cached response body for `key`, or `compute()`'s.
+
+    `compute` returns `(body, cacheable)`. A `key` of None — the cache is off, or the image could not
+    be resolved — always computes and keeps nothing. `retry_on` are the exceptions that say something
+    about the caller whose `compute` ran rather than about the submission: a request that waited for
+    that run and got one of them tries again, as the one that runs if nobody else has started.
+
+    `until`, a Unix time, is how long a request waits for somebody else's run; past it, it raises
+    StillRunning and leaves the run to those still waiting. Its own `compute` is bounded by itself.
+    """
+    if key is None or not enabled():
+        return compute()[0]
+
+    while True:
+        hit = lookup(key)
+        if hit is not None:
+            return hit
+
+        with _lock:
+            future = _in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = _in_flight[key] = concurrent.futures.Future()
+        if leader:
+            break
+        _count("collapsed")
+        wait = None if until is None else max(until - time(), 0)
+        if not concurrent.futures.wait([future], wait).done:
+            raise StillRunning("an identical request's run is still going")
+        try:
+            return dict(future.result())
+        except retry_on:
+            continue
+
+    try:
+        with _flight_lock(key):
+            # Another worker may have run it while this one waited for the lock.
+            body = _read_disk(key)
+            if body is None:
+                _count("misses")
+                body, cacheable = compute()
+                if cacheable:
+                    _store(key, body)
+            else:
+                _count("hits")
+                _remember(key, body)
+                body = _as_hit(body)
+        future.set_result(body)
+        return dict(body)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _in_flight.pop(key, None)
+
+
+def lookup(key):
+    """The cached body for `key`, from memory or disk, or None."""
+    with _lock:
+        body = _memory.get(key)
+        if body is not None:
+            _memory.move_to_end(key)
+    if body is None:
+        body = _read_disk(key)
+        if body is not None:
+            _remember(key, body)
+    if body is not None:
+        _count("hits")
+        return _as_hit(body)
+    return None
+
+
+def _as_hit(body):
+    """A kept body as a hit answers: marked `cached`. It has no `usage`, as no run used anything for it."""
+    return dict(body, cached=True)
+
+
+def _store(key, body):
+    # What the first run used is not what answering from here uses, so it is not kept.
+    body = {name: value for name, value in body.items() if name != "usage"}
+    _count("stored")
+    _remember(key, body)
+    _write_disk(key, body)
+
+
+def _remember(key, body):
+    global _memory_bytes
+
+    size = _size(body)
+    with _lock:
+        if key in _memory:
+            return
+        _memory[key] = body
+        _memory_bytes += size
+        while _memory and _memory_bytes > RESULT_CACHE_MB * 1024 * 1024:
+            _, dropped = _memory.popitem(last=False)
+            _memory_bytes -= _size(dropped)
+
+
+def _size(body):
+    return len(body.get("feedback", "")) + 64
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+@contextlib.contextmanager
+def _flight_lock(key):
+    if not RESULT_CACHE_DIR:
+        yield
+        return
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        f = open(os.path.join(RESULT_CACHE_DIR, key + ".lock"), "w")
+    except OSError:
+        # Without the lock two workers may run the same submission. That is the cost of an unusable
+        # directory, not a reason to refuse to grade.
+        yield
+        return
+    # Left in place afterwards: removing a lock file that another worker has open and is waiting on
+    # lets a third create a new one, and then two workers hold "the" lock at once.
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _path(key):
+    return os.path.join(RESULT_CACHE_DIR, key + ".json")
+
+
+def _read_disk(key):
+    if not RESULT_CACHE_DIR:
+        return None
+    try:
+        with open(_path(key), encoding="utf-8") as f:
+            body = json.load(f)
+        os.utime(_path(key))
+        return body
+    except (OSError, ValueError):
+        return None
+
+
+def _write_disk(key, body):
+    global _trimmed_at
+
+    if not RESULT_CACHE_DIR:
+        return
+    try:
+        tmp = "{}.{}.new".format(_path(key), threading.get_ident())
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(body, f)
+        os.replace(tmp, _path(key))
+    except OSError:
+        return
+    if time() - _trimmed_at > RESULT_CACHE_TRIM_SEC:
+        _trimmed_at = time()
+        _trim_disk()
+
+
+def _trim_disk():
+    """Removes the least recently used files until the directory fits `RESULT_CACHE_DISK_MB`."""
+    entries = []
+    for name in os.listdir(RESULT_CACHE_DIR):
+        try:
+            stat = os.stat(os.path.join(RESULT_CACHE_DIR, name))
+        except OSError:
+            continue
+        if name.endswith(".json"):
+            entries.append((stat.st_mtime, stat.st_size, name))
+        elif name.endswith(".lock") and time() - stat.st_mtime > RESULT_LOCK_MAX_AGE_SEC:
+            # Empty, but one per submission ever graded adds up. Nothing holds one for an hour.
+            try:
+                os.remove(os.path.join(RESULT_CACHE_DIR, name))
+            except OSError:
+                pass
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= RESULT_CACHE_DISK_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(RESULT_CACHE_DIR, name))
+            total -= size
+        except OSError:
+            pass
+
+
+def result_cache_status():
+    """Hits, misses and how full the in-memory cache is, for this process."""
+    with _lock:
+        return dict(_stats, entries=len(_memory), bytes=_memory_bytes, budget_mb=RESULT_CACHE_MB,
+                    disk=bool(RESULT_CACHE_DIR), pid=os.getpid())
@@ -0,0 +1,706 @@
+# coding=utf-8
+"""What runs a grading container: the interface a run is written against, and the backends without a daemon.
+
+A grading run used to be docker-py calls from end to end, and every one of them is an HTTP round trip
+to a daemon that is also pulling, building, committing and removing for everybody else on the host.
+`containers.py` now asks a **runtime** instead, for each of the things a run needs:
+
+- `create(image_name, max_mem_MB, cpus, limits, logger, request_id)` — a container, created and not
+  started, with its limits fixed: `limits` is a `Limits`, the ones besides memory and CPU. Returns a handle, which is the runtime's own business apart from
+  `handle.short_id`, the name it goes by in logs and in a stream's `started` event;
+- `pin(handle, cpuset)` — the cores admission chose for it, before it starts;
+- `inject(handle, archive)` — a tar, extracted at `/`;
+- `start(handle)`;
+- `output(handle)` — the merged stdout and stderr, as an iterable of byte chunks that ends when the
+  container exits. It has `close()`, which another thread may call to make it end early, and reading
+  it may raise NotExited when even that did not end it;
+- `wait(handle, timeout)` — the exit code, or NotExited after `timeout` seconds;
+- `kill(handle)` — RuntimeRefused if there was nothing left to kill, which is how a timeout tells a
+  container that finished in the same instant from one it stopped;
+- `destroy(handle)` — everything the container left behind. Run on the reaper, so a failure is
+  retried; RuntimeRefused, OSError and the daemon's own errors are what a failure may raise;
+- `stats(handle)` — what the run used, called once it has exited and before `destroy`: a dict with
+  any of `oom_killed`, `memory_peak_bytes`, `cpu_user_sec`, `cpu_system_sec` and `exit_code`. A key
+  the runtime cannot answer is left out, and a caller must cope with any being missing — see
+  "resource usage" below.
+
+Which one is a host setting, `EASY_RUNTIME`, so one executor can try a runtime while the others carry
+on, and the two compared by the phase histograms each host's `/v1/metrics` reports (see
+`metrics.py`) on the same traffic.
+
+- **docker**, the default, is the old behaviour and lives in `containers.py` with the warm pool it
+  claims from.
+- **oci** runs `runc` (or `crun`, `EASY_OCI_RUNTIME`) directly on an unpacked copy of the image. Below.
+- **fake** runs nothing and answers with `FAKE_OUTPUT`. For tests, and for working on the executor on a
+  machine without Docker.
+
+### resource usage
+
+What a run used comes from its cgroup (v2): `memory.peak`, the `oom_kill` count in `memory.events`,
+and `user_usec`/`system_usec` in `cpu.stat`. The catch is that the cgroup goes when the container
+does, and under Docker that is the moment it exits — before anyone could read the final numbers. So
+for Docker a `CgroupSampler` reads them every `CGROUP_SAMPLE_SEC` while the container runs, and what
+`stats` reports is the last reading: the peak is exact up to then (the kernel keeps it, the sampler
+only has to see it once), and the CPU times are short by at most one interval. A run shorter than
+the first reading has no CPU times. The OOM flag does not depend on any of that: Docker records it
+in the container's state, which outlives the exit. The OCI runtime keeps its cgroup until `destroy`
+and reads it once, exactly.
+
+`memory.peak` needs Linux 5.19. On an older kernel the peak is the highest `memory.current` a reading
+saw, which can miss a short spike.
+
+### oci
+
+An image is unpacked once per image ID, under `OCI_DIR/images`, by exporting a container of it through
+the daemon — the one thing the daemon is still asked, and only the first time an image is used on a
+host. The image's tag is resolved at most every `OCI_TAG_TTL_SEC`, so a re-pushed image is picked up
+within that, like the grading image list.
+
+A run is then an overlay: the unpacked image as the read-only lower layer, and a fresh upper layer per
+run in its bundle under `OCI_DIR/runs`. The archive is extracted into the upper layer before the
+overlay is mounted, so `/evaluate.sh` and `/student-submission` are where a Docker run would have them,
+and the container may write anywhere, as it could under Docker, without touching what the next run
+sees. The container gets the image's environment, working directory and user, and pid, mount, IPC,
+UTS and network namespaces of its own. The network namespace is empty apart from loopback, which runc
+brings up, so a run has no network at all. That is stricter than the Docker runtime, which still
+gives grading containers the host's network. Docker's default seccomp profile is approximated by
+`OCI_SECCOMP_DENIED`: every syscall is allowed except the ones that reach past the container (module
+loading, mounts, namespaces, the kernel keyring, BPF and the like), which fail with EPERM. Memory, swap,
+processes and `/tmp` are limited as the Docker runtime limits them, and CPU by the same CFS quota.
+
+What it costs: root, because of the overlay mount and because rootful runc needs it anyway; a copy
+of every image used on the host, on disk; and no per-exercise images — those are a Docker build cache,
+and unpacking one per exercise would cost more than it saves, so `prepare_exercise` grades from the
+base image on this runtime. The warm pool is Docker's too: creating a container here is writing a
+directory, which is what the pool existed to avoid waiting for.
+"""
+import collections
+import contextlib
+import fcntl
+import io
+import json
+import os
+import os.path
+import select
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import uuid
+from time import time
+
+import tracing
+
+
+class NotExited(Exception):
+    """A container that was still running after the wait for it, or for its output, had given up."""
+
+
+class RuntimeRefused(Exception):
+    """The runtime would not do it: a kill with nothing to kill, a removal it could not finish."""
+
+
+# What a run is held to besides memory and CPU (see "PIDs, swap and scratch space" in `containers.py`):
+# at most `pids` processes and threads, 0 for no limit; `swap_mb` of swap beyond the memory limit; and
+# a tmpfs of `tmp_mb` at `/tmp`, none when 0.
+Limits = collections.namedtuple("Limits", "pids swap_mb tmp_mb")
+
+
+class Runtime:
+    """The interface. See the module docstring for what each method promises."""
+
+    name = None
+    # Whether `prepare_exercise` may build per-exercise images for this runtime.
+    exercise_images = False
+
+    def create(self, image_name, max_mem_MB, cpus, limits, logger, request_id):
+        raise NotImplementedError
+
+    def pin(self, handle, cpuset):
+        raise NotImplementedError
+
+    def inject(self, handle, archive):
+        raise NotImplementedError
+
+    def start(self, handle):
+        raise NotImplementedError
+
+    def output(self, handle):
+        raise NotImplementedError
+
+    def wait(self, handle, timeout):
+        raise NotImplementedError
+
+    def kill(self, handle):
+        raise NotImplementedError
+
+    def destroy(self, handle):
+        raise NotImplementedError
+
+    def stats(self, handle):
+        return {}
+
+
+# --- cgroups -----------------------------------------------------------------------------------------
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_SAMPLE_SEC = 0.25
+
+
+def cgroup_usage(path):
+    """One reading of the cgroup at `path`, as `stats` reports it; None if it is not there (any more)."""
+    try:
+        cpu = _read_flat(os.path.join(path, "cpu.stat"))
+    except OSError:
+        return None
+    usage = {}
+    if "user_usec" in cpu:
+        usage["cpu_user_sec"] = cpu["user_usec"] / 1e6
+        usage["cpu_system_sec"] = cpu.get("system_usec", 0) / 1e6
+    for name in ("memory.peak", "memory.current"):
+        try:
+            with open(os.path.join(path, name)) as f:
+                usage["memory_peak_bytes"] = int(f.read())
+            break
+        except (OSError, ValueError):
+            continue
+    try:
+        usage["oom_killed"] = _read_flat(os.path.join(path, "memory.events")).get("oom_kill", 0) > 0
+    except OSError:
+        pass
+    return usage
+
+
+def _read_flat(path):
+    """A cgroup "flat keyed" file: one `key value` per line."""
+    found = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(" ")
+            if value.strip().isdigit():
+                found[key] = int(value)
+    return found
+
+
+class CgroupSampler:
+    """
+    Reads a cgroup every `CGROUP_SAMPLE_SEC` on a thread of its own until stopped or the cgroup is
+    gone, keeping the last reading — the highest peak and OOM flag any reading saw.
+
+    `paths` are where the cgroup may be; the first that exists is it. Under Docker that depends on
+    the daemon's cgroup driver, and finding out would be another round trip.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.usage = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="cgroup-sampler")
+        self._thread.start()
+
+    def _loop(self):
+        found = None
+        while True:
+            for path in ([found] if found else self.paths):
+                reading = cgroup_usage(path)
+                if reading is not None:
+                    found = path
+                    self._merge(reading)
+                    break
+            else:
+                if found:
+                    return  # it was there and is gone: the container has exited
+            if self._stop.wait(CGROUP_SAMPLE_SEC):
+                return
+
+    def _merge(self, reading):
+        merged = dict(self.usage, **reading)
+        if "memory_peak_bytes" in self.usage:
+            merged["memory_peak_bytes"] = max(self.usage["memory_peak_bytes"], merged["memory_peak_bytes"])
+        if self.usage.get("oom_killed"):
+            merged["oom_killed"] = True
+        self.usage = merged
+
+    def stop(self):
+        """The last reading. One more is taken first, in case the cgroup is still there."""
+        self._stop.set()
+        self._thread.join()
+        for path in self.paths:
+            reading = cgroup_usage(path)
+            if reading is not None:
+                self._merge(reading)
+                break
+        return dict(self.usage)
+
+
+# --- fake ---------------------------------------------------------------------------------------------
+
+FAKE_OUTPUT = b"Nothing was run: EASY_RUNTIME is fake.\n"
+
+
+class FakeHandle:
+    def __init__(self, image_name, max_mem_MB, cpus, limits):
+        self.short_id = uuid.uuid4().hex[:10]
+        self.image_name = image_name
+        self.max_mem_MB = max_mem_MB
+        self.cpus = cpus
+        self.limits = limits
+        self.cpuset = None
+        self.archive = None
+        self.started = None
+        self.killed = threading.Event()
+        self.closed = threading.Event()
+        self.destroyed = False
+
+
+class FakeRuntime(Runtime):
+    """
+    Runs nothing. Each run prints `chunks` and exits with `exit_code` after `run_sec`, unless it is
+    killed or its output closed first. Every call is recorded in `calls`, as (method, short_id).
+    """
+
+    name = "fake"
+
+    def __init__(self, chunks=(FAKE_OUTPUT,), exit_code=0, run_sec=0.0, stats=None):
+        self.chunks = list(chunks)
+        self.exit_code = exit_code
+        self.run_sec = run_sec
+        self._stats = stats or {}
+        self.calls = []
+        self.handles = []
+
+    def _record(self, method, handle):
+        self.calls.append((method, handle.short_id))
+
+    def create(self, image_name, max_mem_MB, cpus, limits, logger, request_id):
+        handle = FakeHandle(image_name, max_mem_MB, cpus, limits)
+        self.handles.append(handle)
+        self._record("create", handle)
+        return handle
+
+    def pin(self, handle, cpuset):
+        self._record("pin", handle)
+        handle.cpuset = cpuset
+
+    def inject(self, handle, archive):
+        self._record("inject", handle)
+        handle.archive = archive
+
+    def start(self, handle):
+        self._record("start", handle)
+        handle.started = time()
+
+    def output(self, handle):
+        return _FakeOutput(self, handle)
+
+    def wait(self, handle, timeout):
+        self._record("wait", handle)
+        return 137 if handle.killed.is_set() else self.exit_code
+
+    def kill(self, handle):
+        self._record("kill", handle)
+        if handle.killed.is_set() or time() - handle.started >= self.run_sec:
+            raise RuntimeRefused("container {} is not running".format(handle.short_id))
+        handle.killed.set()
+
+    def destroy(self, handle):
+        self._record("destroy", handle)
+        handle.destroyed = True
+
+    def stats(self, handle):
+        return dict(self._stats, exit_code=137 if handle.killed.is_set() else self.exit_code)
+
+
+class _FakeOutput:
+    def __init__(self, runtime, handle):
+        self.runtime = runtime
+        self.handle = handle
+
+    def __iter__(self):
+        yield from self.runtime.chunks
+        end = self.handle.started + self.runtime.run_sec
+        while time() < end and not self.handle.killed.is_set():
+            if self.handle.closed.wait(min(0.01, max(0.0, end - time()))):
+                raise NotExited("output closed while container {} was running".format(self.handle.short_id))
+
+    def close(self):
+        self.handle.closed.set()
+
+
+# --- oci ----------------------------------------------------------------------------------------------
+
+OCI_RUNTIME = os.environ.get("EASY_OCI_RUNTIME", "runc")
+OCI_DIR = os.environ.get("EASY_OCI_DIR", os.path.join(tempfile.gettempdir(), "easy-oci"))
+OCI_TAG_TTL_SEC = 60
+# How long a `runc kill` or `delete` may take before it counts as refused.
+OCI_COMMAND_TIMEOUT_SEC = 10
+# How often a read of the output looks up to see whether it has been closed.
+OCI_READ_POLL_SEC = 0.25
+OCI_READ_BYTES = 64 * 1024
+
+# What Docker gives a container by default, so a grader sees the same privileges under either runtime.
+OCI_CAPABILITIES = ["CAP_CHOWN", "CAP_DAC_OVERRIDE", "CAP_FSETID", "CAP_FOWNER", "CAP_MKNOD", "CAP_NET_RAW",
+                    "CAP_SETGID", "CAP_SETUID", "CAP_SETFCAP", "CAP_SETPCAP", "CAP_NET_BIND_SERVICE",
+                    "CAP_SYS_CHROOT", "CAP_KILL", "CAP_AUDIT_WRITE"]
+OCI_MASKED_PATHS = ["/proc/acpi", "/proc/kcore", "/proc/keys", "/proc/latency_stats", "/proc/timer_list",
+                    "/proc/timer_stats", "/proc/sched_debug", "/proc/scsi", "/sys/firmware"]
+OCI_READONLY_PATHS = ["/proc/asound", "/proc/bus", "/proc/fs", "/proc/irq", "/proc/sys", "/proc/sysrq-trigger"]
+# The syscalls Docker's default seccomp profile refuses a container without extra capabilities. Names
+# that a kernel or architecture does not have are skipped by runc.
+OCI_SECCOMP_DENIED = ["acct", "add_key", "bpf", "clock_adjtime", "clock_settime", "create_module", "delete_module",
+                      "finit_module", "fsconfig", "fsmount", "fsopen", "fspick", "get_kernel_syms", "get_mempolicy",
+                      "init_module", "ioperm", "iopl", "kcmp", "kexec_file_load", "kexec_load", "keyctl",
+                      "lookup_dcookie", "mbind", "mount", "move_mount", "move_pages", "name_to_handle_at",
+                      "nfsservctl", "open_by_handle_at", "open_tree", "perf_event_open", "pivot_root",
+                      "process_vm_readv", "process_vm_writev", "query_module", "quotactl", "reboot", "request_key",
+                      "set_mempolicy", "setns", "settimeofday", "stime", "swapoff", "swapon", "sysfs", "_sysctl",
+                      "syslog", "umount", "umount2", "unshare", "uselib", "userfaultfd", "ustat", "vm86",
+                      "vm86old"]
+OCI_SECCOMP_ARCHITECTURES = ["SCMP_ARCH_X86_64", "SCMP_ARCH_X86", "SCMP_ARCH_X32", "SCMP_ARCH_AARCH64",
+                             "SCMP_ARCH_ARM"]
+OCI_CPU_PERIOD_US = 100000
+OCI_CGROUP_PARENT = "easy-aae"
+DEFAULT_PATH = "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+
+class OciHandle:
+    def __init__(self, image, max_mem_MB, cpus, limits):
+        self.id = "easy-{}-{}".format(os.getpid(), uuid.uuid4().hex[:12])
+        self.short_id = self.id[-10:]
+        self.image = image
+        self.max_mem_MB = max_mem_MB
+        self.cpus = cpus
+        self.limits = limits
+        self.cpuset = None
+        self.bundle = os.path.join(OCI_DIR, "runs", self.id)
+        self.process = None
+        self.mounted = False
+
+    @property
+    def upper(self):
+        return os.path.join(self.bundle, "upper")
+
+    @property
+    def rootfs(self):
+        return os.path.join(self.bundle, "rootfs")
+
+
+class OciRuntime(Runtime):
+    """runc or crun on an unpacked image, with an overlay per run. See "oci" above."""
+
+    name = "oci"
+
+    def __init__(self, binary=None):
+        self.binary = binary or OCI_RUNTIME
+        self._tags = {}
+        self._tags_lock = threading.Lock()
+
+    def _command(self, *args):
+        return [self.binary, "--root", os.path.join(OCI_DIR, "state")] + list(args)
+
+    # --- images
+
+    def image(self, image_name):
+        """The unpacked image `image_name` names: a dict of its ID, rootfs and config. Unpacked if new."""
+        with self._tags_lock:
+            cached = self._tags.get(image_name)
+        if cached is not None and time() - cached[0] < OCI_TAG_TTL_SEC:
+            return cached[1]
+        from containers import shared_docker_client  # containers imports this module
+
+        # Raises ImageNotFound for a missing image, as the Docker runtime's create would.
+        with tracing.span("oci.image_get"):
+            found = shared_docker_client().images.get(image_name)
+        image = self._unpacked(found)
+        with self._tags_lock:
+            self._tags[image_name] = (time(), image)
+        return image
+
+    def _unpacked(self, found):
+        directory = os.path.join(OCI_DIR, "images", found.id.replace(":", "_"))
+        config_file = os.path.join(directory, "image.json")
+        if not os.path.exists(config_file):
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            with _flocked(directory + ".lock"):
+                if not os.path.exists(config_file):
+                    with tracing.span("oci.unpack"):
+                        _unpack(found, directory)
+        with open(config_file) as f:
+            config = json.load(f)
+        return {"id": found.id, "rootfs": os.path.join(directory, "rootfs"), "config": config}
+
+    # --- the interface
+
+    def create(self, image_name, max_mem_MB, cpus, limits, logger, request_id):
+        handle = OciHandle(self.image(image_name), max_mem_MB, cpus, limits)
+        for name in ("upper", "work", "rootfs"):
+            os.makedirs(os.path.join(handle.bundle, name))
+        logger.debug("Created bundle {} from {} ({})".format(handle.id, image_name, request_id))
+        return handle
+
+    def pin(self, handle, cpuset):
+        handle.cpuset = cpuset
+
+    def inject(self, handle, archive):
+        # The names in it come from the request. `server.check_content` refuses any that could leave
+        # the directory, and this refuses them again, since it writes to the host as root.
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            _extract(tar, handle.upper, "data")
+
+    def start(self, handle):
+        with open(os.path.join(handle.bundle, "config.json"), "w") as f:
+            json.dump(oci_config(handle, _GRADING_ARGS), f)
+        with tracing.span("oci.mount"):
+            subprocess.run(["mount", "-t", "overlay", "overlay", "-o", "lowerdir={},upperdir={},workdir={}".format(
+                handle.image["rootfs"], handle.upper, os.path.join(handle.bundle, "work")), handle.rootfs],
+                check=True, capture_output=True, timeout=OCI_COMMAND_TIMEOUT_SEC)
+        handle.mounted = True
+        # `--keep`: the container stays until `destroy`, so its cgroup can still be read by `stats`.
+        with tracing.span("oci.run"):
+            handle.process = subprocess.Popen(self._command("run", "--keep", "--bundle", handle.bundle, handle.id),
+                                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT)
+
+    def output(self, handle):
+        return _OciOutput(handle)
+
+    def wait(self, handle, timeout):
+        try:
+            return handle.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            raise NotExited("{} still running after {}s".format(handle.id, timeout))
+
+    def kill(self, handle):
+        with tracing.span("oci.kill"):
+            done = subprocess.run(self._command("kill", "--all", handle.id, "KILL"), capture_output=True,
+                                  timeout=OCI_COMMAND_TIMEOUT_SEC)
+        if done.returncode != 0:
+            raise RuntimeRefused(done.stderr.decode("utf-8", errors="replace").strip() or "runc kill failed")
+
+    def destroy(self, handle):
+        with tracing.span("oci.delete"):
+            if handle.process is not None:
+                if handle.process.poll() is None:
+                    handle.process.kill()
+                handle.process.wait(OCI_COMMAND_TIMEOUT_SEC)
+                handle.process.stdout.close()
+                done = subprocess.run(self._command("delete", "--force", handle.id), capture_output=True,
+                                      timeout=OCI_COMMAND_TIMEOUT_SEC)
+                error = done.stderr.decode("utf-8", errors="replace")
+                if done.returncode != 0 and "does not exist" not in error:
+                    raise RuntimeRefused(error.strip() or "runc delete failed")
+            if handle.mounted:
+                subprocess.run(["umount", handle.rootfs], check=True, capture_output=True,
+                               timeout=OCI_COMMAND_TIMEOUT_SEC)
+                handle.mounted = False
+            shutil.rmtree(handle.bundle)
+
+    def stats(self, handle):
+        # Read directly: `--keep` leaves the cgroup in place until `destroy`.
+        found = cgroup_usage(os.path.join(CGROUP_ROOT, OCI_CGROUP_PARENT, handle.id)) or {}
+        if handle.process is not None:
+            found["exit_code"] = handle.process.returncode
+        return found
+
+
+# `containers.GRADING_COMMAND`, repeated rather than imported: `containers` imports this module.
+_GRADING_ARGS = ["/bin/sh", "-c", "/evaluate.sh"]
+
+
+def oci_config(handle, args):
+    """The bundle's `config.json` for a run of `args` in `handle`: the runtime spec, version 1.0."""
+    image_config = handle.image["config"]
+    env = image_config.get("Env") or [DEFAULT_PATH]
+    uid, gid = _user(image_config.get("User") or "", handle.image["rootfs"])
+    limits = handle.limits
+    # `swap` is memory and swap together, as Docker's `memswap_limit`.
+    resources = {"memory": {"limit": handle.max_mem_MB * 1024 * 1024,
+                            "swap": (handle.max_mem_MB + limits.swap_mb) * 1024 * 1024}}
+    if limits.pids:
+        resources["pids"] = {"limit": limits.pids}
+    scratch = []
+    if limits.tmp_mb:
+        scratch.append({"destination": "/tmp", "type": "tmpfs", "source": "tmpfs",
+                        "options": ["nosuid", "nodev", "mode=1777", "size={}m".format(limits.tmp_mb)]})
+    cpu = {}
+    if handle.cpus:
+        cpu.update(quota=int(handle.cpus * OCI_CPU_PERIOD_US), period=OCI_CPU_PERIOD_US)
+    if handle.cpuset is not None:
+        cpu["cpus"] = handle.cpuset
+    if cpu:
+        resources["cpu"] = cpu
+    return {
+        "ociVersion": "1.0.2",
+        "process": {
+            "terminal": False,
+            "user": {"uid": uid, "gid": gid},
+            "args": list(args),
+            "env": list(env),
+            "cwd": image_config.get("WorkingDir") or "/",
+            "capabilities": {kind: list(OCI_CAPABILITIES) for kind in ("bounding", "effective", "permitted")},
+            "noNewPrivileges": True,
+        },
+        "root": {"path": "rootfs", "readonly": False},
+        "hostname": handle.short_id,
+        "mounts": [
+            {"destination": "/proc", "type": "proc", "source": "proc"},
+            {"destination": "/dev", "type": "tmpfs", "source": "tmpfs",
+             "options": ["nosuid", "strictatime", "mode=755", "size=65536k"]},
+            {"destination": "/dev/pts", "type": "devpts", "source": "devpts",
+             "options": ["nosuid", "noexec", "newinstance", "ptmxmode=0666", "mode=0620"]},
+            {"destination": "/dev/shm", "type": "tmpfs", "source": "shm",
+             "options": ["nosuid", "noexec", "nodev", "mode=1777", "size=65536k"]},
+            {"destination": "/dev/mqueue", "type": "mqueue", "source": "mqueue",
+             "options": ["nosuid", "noexec", "nodev"]},
+            {"destination": "/sys", "type": "sysfs", "source": "sysfs",
+             "options": ["nosuid", "noexec", "nodev", "ro"]},
+        ] + scratch,
+        "linux": {
+            "cgroupsPath": "/{}/{}".format(OCI_CGROUP_PARENT, handle.id),
+            "resources": resources,
+            # `uts` as well because of `hostname`, which runc refuses to set without one.
+            "namespaces": [{"type": "pid"}, {"type": "ipc"}, {"type": "mount"}, {"type": "uts"},
+                           {"type": "network"}],
+            "seccomp": {
+                "defaultAction": "SCMP_ACT_ALLOW",
+                "architectures": list(OCI_SECCOMP_ARCHITECTURES),
+                "syscalls": [{"names": list(OCI_SECCOMP_DENIED), "action": "SCMP_ACT_ERRNO", "errnoRet": 1}],
+            },
+            "maskedPaths": list(OCI_MASKED_PATHS),
+            "readonlyPaths": list(OCI_READONLY_PATHS),
+        },
+    }
+
+
+def _user(user, rootfs):
+    """The image's `User`, as uid and gid. A name is looked up in the image's own /etc/passwd."""
+    name, _, group = user.partition(":")
+    if not name:
+        return 0, 0
+    uid = gid = None
+    if name.isdigit():
+        uid = int(name)
+    else:
+        with contextlib.suppress(OSError):
+            with open(os.path.join(rootfs, "etc", "passwd")) as f:
+                for line in f:
+                    fields = line.split(":")
+                    if len(fields) > 3 and fields[0] == name:
+                        uid, gid = int(fields[2]), int(fields[3])
+                        break
+        if uid is None:
+            raise RuntimeRefused("image user {!r} is not in its /etc/passwd".format(name))
+    if group.isdigit():
+        gid = int(group)
+    return uid, gid if gid is not None else uid
+
+
+class _OciOutput:
+    def __init__(self, handle):
+        self.handle = handle
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        fd = self.handle.process.stdout.fileno()
+        while True:
+            # The container's processes hold the pipe, not runc, so a blocking read would outlast a kill
+            # of runc itself. Hence a poll, and a look at `closed` between polls.
+            if self.closed.is_set():
+                raise NotExited("output of {} closed while it was running".format(self.handle.id))
+            ready, _, _ = select.select([fd], [], [], OCI_READ_POLL_SEC)
+            if ready:
+                chunk = os.read(fd, OCI_READ_BYTES)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self):
+        self.closed.set()
+
+
+def _unpack(found, directory):
+    """The image's filesystem and config into `directory`, via a created, never started, container."""
+    from containers import ROLE_INSPECT, _owner_labels  # the labels the orphan sweep knows
+
+    staging = tempfile.mkdtemp(prefix=".unpack-", dir=os.path.dirname(directory))
+    container = found.client.containers.create(found.id, command=["true"], labels=_owner_labels(ROLE_INSPECT))
+    try:
+        with tarfile.open(fileobj=_ChunkReader(container.export()), mode="r|") as tar:
+            _extract(tar, os.path.join(staging, "rootfs"), _image_filter)
+        with open(os.path.join(staging, "image.json"), "w") as f:
+            json.dump(found.attrs.get("Config") or {}, f)
+        os.rename(staging, directory)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        container.remove(force=True)
+
+
+def _extract(tar, path, member_filter):
+    """
+    Extracts `tar` into `path`, refusing any member that would land outside it. `member_filter` is a
+    `tarfile` extraction filter: "data" for what a request supplied, `_image_filter` for an image.
+
+    On a Python without extraction filters, each member is checked here instead, before it is written.
+    """
+    if hasattr(tarfile, "data_filter"):
+        tar.extractall(path, filter=member_filter)
+        return
+    root = os.path.realpath(path)
+    for member in tar:
+        _check_member(member, root)
+        tar.extract(member, path)
+
+
+def _image_filter(member, path):
+    """
+    `tarfile`'s "tar" filter, which refuses absolute names and anything resolving outside `path`, but
+    keeping the modes it would clear apart from setuid and setgid. An image's `/tmp` is 1777, and
+    its layers' directories need their group and other bits. Setuid does nothing under
+    `noNewPrivileges` anyway.
+    """
+    safe = tarfile.tar_filter(member, path)
+    if safe.mode is None or member.mode is None:
+        return safe
+    return safe.replace(mode=member.mode & 0o1777, deep=False)
+
+
+def _check_member(member, root):
+    """Raises TarError for a member whose name, or hard link's target, resolves outside `root`."""
+    paths = [member.name] + ([member.linkname] if member.islnk() else [])
+    for name in paths:
+        target = os.path.realpath(os.path.join(root, name))
+        if os.path.isabs(name) or os.path.commonpath([target, root]) != root:
+            raise tarfile.TarError("refusing to extract {!r}: outside the destination".format(member.name))
+
+
+class _ChunkReader(io.RawIOBase):
+    """docker-py's chunk iterator as a file, for `tarfile` to stream from."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, b"")
+            if not self.pending:
+                return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n], self.pending = self.pending[:n], self.pending[n:]
+        return n
+
+
+@contextlib.contextmanager
+def _flocked(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
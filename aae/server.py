@@ -1,5 +1,7 @@
 # coding=utf-8
 
+import concurrent.futures
+import contextvars
 import os
 import subprocess
 from datetime import datetime, timezone
@@ -8,12 +10,22 @@ import json
 import typing as T
 
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
 from werkzeug.exceptions import BadRequest
 
+import admission
+import compression
 import containers
-from containers import grade_submission, RunStatus
+import deadlines
+import jobs
+import load
+import metrics
+import results
+import streaming
+import tracing
+from containers import grade_submission, grade_prepared, prepare_exercise, RunStatus
 
 # TODO: move to conf file
 TIME_EXCEEDED_MESSAGE = "Programmi kontrollimine ületas lubatud käivitusaega."
@@ -22,6 +34,12 @@ SOMETHING_FAILED_MESSAGE = "Automaatkontrollimise käigus tekkis ootamatu viga.
 
 app = Flask(__name__)
 app.logger.setLevel("DEBUG")
+# gzip request bodies in, and gzip answers out to a client that asks (see `compression.py`).
+compression.install(app)
+
+# Whatever a killed worker left behind (see "orphans" in containers.py). At start, which is right
+# after a crash or a restart, and on a timer from then on.
+containers.start_orphan_sweeper(app.logger)
 
 # Version reporting (EZ-1709). Read once at import: the answer cannot change while the process
 # runs, and /v1/version is called by core on a timer rather than by a person.
@@ -89,16 +107,90 @@ COMMIT = _read_commit()
 DEPLOYED_AT = _read_deployed_at()
 
 
+REQUIRED_KEYS = {"submission", "grading_script", "assets", "image_name", "max_time_sec", "max_mem_mb"}
+# Added after core shipped, so a core that does not know them keeps working; one that does is checked.
+OPTIONAL_KEYS = {"max_cpus", "max_pids", "max_swap_mb", "max_tmp_mb"}
+# The limits besides memory and CPU a request may set for itself (see `containers.run_limits`), as the
+# `run_limits` argument each is. 0 switches the PID limit and the tmpfs off.
+LIMIT_KEYS = {"max_pids": "pids", "max_swap_mb": "swap_mb", "max_tmp_mb": "tmp_mb"}
+# How a run ends for reasons of the caller that started it, not of the submission: a client that went
+# away, a wait for room that ran out, or a deadline that passed. An identical request that joined the
+# run tries again instead.
+_CALLERS_OWN = (containers.GradingAbandoned, admission.Saturated, deadlines.DeadlinePassed)
+
+
 def check_content(content):
-    if set(content.keys()) != {"submission", "grading_script", "assets", "image_name", "max_time_sec", "max_mem_mb"}:
+    if not REQUIRED_KEYS <= set(content.keys()) <= REQUIRED_KEYS | OPTIONAL_KEYS:
         raise BadRequest("Missing or incorrect parameter")
 
+    if "max_cpus" in content:
+        cpus = content["max_cpus"]
+        if isinstance(cpus, bool) or not isinstance(cpus, (int, float)) or not 0 < cpus <= len(admission.host_cores()):
+            raise BadRequest("max_cpus must be a number of CPUs this host has")
+
+    for key in LIMIT_KEYS:
+        if key in content:
+            value = content[key]
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise BadRequest("{} must be a whole number, 0 or more".format(key))
+
     if not isinstance(content["assets"], list):
         raise BadRequest("Assets must be list")
 
     for dic in content["assets"]:
         if set(dic.keys()) != {"file_name", "file_content"}:
             raise BadRequest("Missing or incorrect parameter")
+        if not safe_file_name(dic["file_name"]):
+            raise BadRequest("Asset file names must be plain names, without '/' or '..'")
+
+
+def safe_file_name(name):
+    """
+    Whether an asset's name is a plain file name. Assets are written beside the submission, so a name
+    with a `/` or `..` in it would be written somewhere else: into the image under Docker, and onto
+    the host under the OCI runtime, which unpacks as root.
+    """
+    return isinstance(name, str) and name not in ("", ".") and "/" not in name and ".." not in name \
+        and "\0" not in name
+
+
+# A batch is one request, held for as long as all of it takes, so it is bounded like one.
+BATCH_MAX_SUBMISSIONS = int(os.environ.get("EASY_BATCH_MAX_SUBMISSIONS", "500"))
+# Job threads one batch may have at once. 0 for half of them, leaving the rest to `/v1/grade` and jobs.
+BATCH_THREADS = int(os.environ.get("EASY_BATCH_THREADS", "0"))
+
+
+def batch_threads():
+    """How many of a batch's submissions may grade at once: its share of the job threads, never all."""
+    share = BATCH_THREADS or jobs.JOB_WORKERS // 2
+    return max(1, min(share, jobs.JOB_WORKERS - 1))
+
+
+def check_batch_content(batch):
+    """
+    A batch is a grade request with `submissions` — a list of `{"id", "submission"}` — in place of
+    `submission`. Checked by the same rules, so that a batch never accepts an exercise `/v1/grade`
+    would refuse.
+    """
+    if not isinstance(batch, dict) or "submissions" not in batch or "submission" in batch:
+        raise BadRequest("Missing or incorrect parameter")
+
+    submissions = batch["submissions"]
+    if not isinstance(submissions, list) or not submissions:
+        raise BadRequest("Submissions must be a non-empty list")
+    if len(submissions) > BATCH_MAX_SUBMISSIONS:
+        raise BadRequest("At most {} submissions per batch".format(BATCH_MAX_SUBMISSIONS))
+    for item in submissions:
+        if not isinstance(item, dict) or set(item.keys()) != {"id", "submission"}:
+            raise BadRequest("Missing or incorrect parameter")
+
+    exercise = {key: value for key, value in batch.items() if key != "submissions"}
+    check_content(dict(exercise, submission=""))
+
+
+def run_limits(content):
+    """The PID, swap and /tmp limits for a validated request: its own, and the host's for the rest."""
+    return containers.run_limits(**{name: content[key] for key, name in LIMIT_KEYS.items() if key in content})
 
 
 def assets_to_tuples(assets):
@@ -124,15 +216,33 @@ def parse_v3(raw_output) -> T.Optional[T.Tuple[int, str]]:
     return None
 
 
+def parse_truncated_v3(tail) -> T.Optional[T.Tuple[int, str]]:
+    """
+    A V3 document at the end of output whose middle was dropped.
+
+    The JSON is the last thing a V3 grader prints, so if it fits in the kept tail it is there whole —
+    after whatever else survived. Tried from the last line that opens an object, which is where a
+    grader's `json.dumps` starts.
+    """
+    if tail.startswith("{"):
+        return parse_v3(tail)
+    start = tail.rfind("\n{")
+    if start < 0:
+        return None
+    return parse_v3(tail[start + 1:])
+
+
 def parse_assessment_output(raw_output) -> T.Tuple[int, str]:
     assessment_v3 = parse_v3(raw_output)
+    if assessment_v3 is None and getattr(raw_output, "truncated", False):
+        assessment_v3 = parse_truncated_v3(raw_output.tail)
     if assessment_v3 is not None:
         return assessment_v3
 
     # TODO: pygrader and imgrec should produce OK_LEGACY json messages
     grade_separator = "#" * 50
 
-    grade_string = raw_output.rstrip().split("\n")[-1].lower().strip()
+    grade_string = raw_output.rstrip().rsplit("\n", 1)[-1].lower().strip()
     app.logger.debug("Grade string: " + grade_string)
 
     if not grade_string.startswith("grade:"):
@@ -158,29 +268,96 @@ def parse_assessment_output(raw_output) -> T.Tuple[int, str]:
     return round(float(grade)), grade_separator.join(output_rsplit[0:-1])
 
 
-@app.route('/v1/grade', methods=['POST'])
-def post_grade():
-    # app.logger.info("Request: " + request.get_data(as_text=True))
-    request_time = time.time()
-    app.logger.info("Request started: {}".format(request_time))
+def grade(content, logger, request_id, wait_sec=0, listener=None, deadline=None) -> dict:
+    """
+    Grades one validated request and returns the response body: the grade, the feedback,
+    `output_truncated` when the output had to be cut, and `usage` when the run's resource use is known.
+
+    Everything that grades goes through here — `/v1/grade` and the jobs behind `/v1/jobs` — so a
+    student is told the same thing whichever way core asked. An identical submission graded before is
+    answered from `results.py` without a container, and so without asking admission for room; a new
+    one waits up to `wait_sec` for room, and raises Saturated if there is none. `listener` follows the
+    run, if there is one (see `streaming.py`).
+
+    `deadline`, a Unix time, is when the caller stops waiting (see `deadlines.py`). A run that would
+    probably not finish by then raises DeadlinePassed rather than starting, and one still running then
+    is killed and raises it too. A remembered answer is given whatever the deadline. A run that an
+    identical request started is waited for only until then, and one started here that is killed at
+    it is run again for whoever joined it.
+    """
+    assets = assets_to_tuples(content["assets"])
+    cpus = content.get("max_cpus", containers.CPU_QUOTA)
+    limits = run_limits(content)
+
+    def run():
+        # Only once nothing remembered answers it: a cached grade costs no time, so no deadline is too
+        # close for it. The time a request spends queued for a job thread is spent by now.
+        deadlines.check(deadline, content["max_time_sec"], content["image_name"])
+        with admission.lease(content["max_mem_mb"], content["max_time_sec"], deadlines.wait_left(deadline, wait_sec),
+                             cpus) as cpuset:
+            follow = listener
+            if deadline is not None:
+                # And the time spent waiting for room.
+                deadlines.check(deadline, content["max_time_sec"], content["image_name"])
+                follow = deadlines.DeadlineListener(deadline, listener)
+            try:
+                outcome, raw_output = grade_submission(content["submission"], content["grading_script"], assets,
+                                                       content["image_name"], content["max_time_sec"],
+                                                       content["max_mem_mb"], logger, request_id, cpus=cpus,
+                                                       cpuset=cpuset, listener=follow, limits=limits)
+            except containers.GradingAbandoned:
+                if follow is not listener and follow.expired:
+                    raise deadlines.DeadlinePassed("killed at the caller's deadline")
+                raise
+        with tracing.context(request_id, content["image_name"]):
+            return response_body(outcome, raw_output, logger), outcome.status == RunStatus.SUCCESS
+
+    # The key resolves the image's tag, and the run's claim reuses the answer rather than asking again.
+    with containers.resolving_once():
+        key = _result_key(content["submission"], content["grading_script"], assets, content["image_name"],
+                          _run_shape(content))
+        # The deadline is this request's alone. An identical run started by another request is waited
+        # for only until it; one started here, with it, is killed at it and retried by whoever joined.
+        until = deadline - deadlines.DEADLINE_MARGIN_SEC if deadline is not None else None
+        try:
+            return results.get_or_compute(key, run, _CALLERS_OWN, until)
+        except results.StillRunning:
+            raise deadlines.DeadlinePassed("the caller's deadline passed while an identical submission was graded")
 
-    if not request.is_json:
-        raise BadRequest("Request body must be JSON")
 
-    content = request.get_json()
-    check_content(content)
+def _remembered(content):
+    """The result cache's answer to a validated request, or None if it has none."""
+    key = _result_key(content["submission"], content["grading_script"], assets_to_tuples(content["assets"]),
+                      content["image_name"], _run_shape(content))
+    return results.lookup(key) if key is not None else None
+
 
-    # TODO: dummy switch from conf
+def _run_shape(content):
+    """What the container is limited by, as the result cache's key has it."""
+    cpus = content.get("max_cpus", containers.CPU_QUOTA)
+    return (content["max_time_sec"], content["max_mem_mb"], cpus) + run_limits(content)
 
-    status, raw_output = grade_submission(content["submission"], content["grading_script"],
-                                          assets_to_tuples(content["assets"]), content["image_name"],
-                                          content["max_time_sec"], content["max_mem_mb"], app.logger, request_time)
 
+def _result_key(submission, grading_script, assets, image_name, limits, base_image_id=None):
+    """The result cache's key, or None when it is off or the image cannot be resolved."""
+    if not results.enabled():
+        return None
+    if base_image_id is None:
+        base_image_id = containers.image_id(image_name)
+        if base_image_id is None:
+            return None
+    return results.result_key(submission, grading_script, assets, base_image_id, limits)
+
+
+def response_body(outcome, raw_output, logger) -> dict:
+    """What a student is told about one run: its `RunOutcome` mapped to a grade and feedback."""
+    status = outcome.status
     if status == RunStatus.SUCCESS:
         try:
-            assessment = parse_assessment_output(raw_output)
+            with metrics.phase("parse"):
+                assessment = parse_assessment_output(raw_output)
         except Exception as e:
-            app.logger.error(e)
+            logger.error(e)
             assessment = (0, SOMETHING_FAILED_MESSAGE + "\n\n" + raw_output)
     elif status == RunStatus.TIME_EXCEEDED:
         assessment = (0, TIME_EXCEEDED_MESSAGE)
@@ -189,10 +366,255 @@ def post_grade():
     else:
         raise Exception("Unhandled run status: " + status.name)
 
+    body = {"grade": assessment[0], "feedback": assessment[1]}
+    if outcome.truncated:
+        # The feedback says so in words where it can, but a V3 document cannot be written into, so
+        # this is the flag that is always there. Core ignores fields it does not know.
+        body["output_truncated"] = True
+    if outcome.usage:
+        # What the run used, for tuning an exercise's limits against; whichever of it the runtime knew.
+        body["usage"] = dict(outcome.usage)
+        if outcome.kill_to_exit_sec is not None:
+            body["usage"]["kill_to_exit_sec"] = outcome.kill_to_exit_sec
+    return body
+
+
+def _grading_job(content):
+    """What a job runs. Logs a failure itself, because a job's exception has nobody else to tell."""
+
+    def run(job_id):
+        try:
+            # Accepted while there was room, which another worker may have taken since: wait for it
+            # rather than fail a job that was accepted to be queued.
+            return grade(content, app.logger, job_id, admission.ADMISSION_JOB_WAIT_SEC)
+        except Exception:
+            app.logger.exception("Job {} failed".format(job_id))
+            raise
+
+    return run
+
+
+def _json_request():
+    if not request.is_json:
+        raise BadRequest("Request body must be JSON")
+
+    content = request.get_json()
+    check_content(content)
+    return content
+
+
+@app.route('/v1/grade', methods=['POST'])
+def post_grade():
+    """
+    Grades a submission and answers when it is done. A job like any other (see `jobs.py`), waited for
+    here, so it is bounded by the same threads — but never refused for a full queue.
+
+    429 with `Retry-After` when the host has no room for the container (see `admission.py`). Decided
+    before anything runs, and the room is held until the container is gone.
+
+    503 when the caller's deadline, from `X-Request-Timeout` or `X-Request-Deadline`, would pass before
+    the run could finish, or passes while it runs: nobody is waiting for that grade (see `deadlines.py`).
+    """
+    # app.logger.info("Request: " + request.get_data(as_text=True))
+    request_time = time.time()
+    app.logger.info("Request started: {}".format(request_time))
+
+    try:
+        deadline = deadlines.from_headers(request.headers, request_time)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    content = _json_request()
+
+    with containers.resolving_once():
+        # A remembered grade is answered at once, however close the deadline: it takes no time.
+        body = _remembered(content)
+        if body is None:
+            deadlines.check(deadline, content["max_time_sec"], content["image_name"])
+
+            # TODO: dummy switch from conf
+
+            # In this request's context, so the job reuses the tag resolved for the lookup above.
+            context = contextvars.copy_context()
+            body = jobs.run_and_wait(lambda job_id: context.run(grade, content, app.logger, request_time,
+                                                                deadline=deadline))
+
     # app.logger.info("Assessment: " + str(assessment))
     app.logger.info("Request finished: {}".format(request_time))
+    return jsonify(body)
+
+
+@app.route('/v1/grade/stream', methods=['POST'])
+def post_grade_stream():
+    """
+    Grades a submission like `/v1/grade`, answering with events as the run goes rather than once at
+    the end: queued, started, output if `?output=1`, running, and finished with what `/v1/grade` would
+    have answered (see `streaming.py`). NDJSON, or server-sent events for `Accept: text/event-stream`.
+
+    Validation and admission are decided before the first event, so a bad request is still a 400 and
+    a full host still a 429 with `Retry-After`. Closing the stream early abandons the run.
+    """
+    request_time = time.time()
+    content = _json_request()
+    admission.check(content["max_mem_mb"], content["max_time_sec"])
+    stream = streaming.GradeStream(include_output=request.args.get("output") == "1")
+    app.logger.info("Streamed request started: {}".format(request_time))
+
+    def run(job_id):
+        if stream.abandoned:
+            raise containers.GradingAbandoned("abandoned by the client before it started")
+        try:
+            # Admitted above, and waiting for the room another worker may have taken since, as a job does.
+            return grade(content, app.logger, request_time, admission.ADMISSION_JOB_WAIT_SEC, listener=stream)
+        except containers.GradingAbandoned as e:
+            app.logger.info("Streamed request {}: {}".format(request_time, e))
+            raise
+        except Exception:
+            app.logger.exception("Streamed request {} failed".format(request_time))
+            raise
+
+    jobs.run_later(run).add_done_callback(stream.settle)
+
+    media_type = streaming.SSE if request.accept_mimetypes.best == streaming.SSE else streaming.NDJSON
+    return Response(stream.lines(media_type), mimetype=media_type, headers={"Cache-Control": "no-cache"})
+
+
+@app.route('/v1/grade/batch', methods=['POST'])
+def post_grade_batch():
+    """
+    Grades many submissions to one exercise — a regrade after a teacher fixed a test. The script, the
+    assets, the image and the limits are sent once, and the per-exercise image is found or built once,
+    rather than once per submission.
+
+    The submissions run as jobs on the same threads as everything else, at most `batch_threads()` of
+    this batch at a time, so a regrade of a whole course cannot take every thread from the students
+    who are submitting right now. One submission failing is that submission's `error`, not the batch's.
+    Refused with 429 when the host has no room for even the first; once accepted, each submission
+    waits for room rather than failing for the lack of it.
+
+    The answer is `{"results": [...]}` in the order the submissions were sent, once all are done. With
+    `Accept: application/x-ndjson` it is instead one line per submission as each finishes, in the
+    order they finish, so core can store them as they come. Either way each result is what
+    `/v1/grade` would have answered, plus the `id` it was sent with.
+
+    Held for the whole batch: under sync gunicorn workers that is bounded by the worker timeout, and
+    `BATCH_MAX_SUBMISSIONS` is there so that a batch is a size that can finish inside it.
+    """
+    request_time = time.time()
+    if not request.is_json:
+        raise BadRequest("Request body must be JSON")
+    batch = request.get_json()
+    check_batch_content(batch)
+    app.logger.info("Batch of {} started: {}".format(len(batch["submissions"]), request_time))
+
+    admission.check(batch["max_mem_mb"], batch["max_time_sec"])
+    exercise = prepare_exercise(batch["grading_script"], assets_to_tuples(batch["assets"]), batch["image_name"],
+                                app.logger, request_time)
+    graded = _grade_batch(exercise, batch, request_time)
+
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        return Response((json.dumps(result) + "\n" for _, result in graded), mimetype="application/x-ndjson")
+
+    ordered = [None] * len(batch["submissions"])
+    for index, result in graded:
+        ordered[index] = result
+    app.logger.info("Batch finished: {}".format(request_time))
+    return jsonify({"results": ordered})
+
+
+def _grade_batch(exercise, batch, request_id):
+    """Yields `(index, result)` for each submission as it finishes, with a bounded number in flight."""
+
+    # Resolved once for the batch, like the exercise: every submission in it is graded on the same image.
+    base_image_id = containers.image_id(exercise.base_image_name) if results.enabled() else None
+
+    cpus = batch.get("max_cpus", containers.CPU_QUOTA)
+    limits = run_limits(batch)
+
+    def run(item):
+        def graded(job_id):
+            def run_container():
+                with admission.lease(batch["max_mem_mb"], batch["max_time_sec"], admission.ADMISSION_JOB_WAIT_SEC,
+                                     cpus) as cpuset:
+                    outcome, raw_output = grade_prepared(exercise, item["submission"], batch["max_time_sec"],
+                                                         batch["max_mem_mb"], app.logger, job_id, cpus, cpuset,
+                                                         limits=limits)
+                with tracing.context(job_id, batch["image_name"]):
+                    return response_body(outcome, raw_output, app.logger), outcome.status == RunStatus.SUCCESS
+
+            key = None
+            if base_image_id is not None:
+                key = _result_key(item["submission"], exercise.grading_script, exercise.assets, exercise.base_image_name,
+                                  (batch["max_time_sec"], batch["max_mem_mb"], cpus) + limits, base_image_id)
+            return results.get_or_compute(key, run_container, _CALLERS_OWN)
+        return graded
+
+    waiting = iter(enumerate(batch["submissions"]))
+    in_flight = {}
+    while True:
+        for index, item in waiting:
+            in_flight[jobs.run_later(run(item))] = index
+            if len(in_flight) >= batch_threads():
+                break
+        if not in_flight:
+            return
+        finished, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            index = in_flight.pop(future)
+            item_id = batch["submissions"][index]["id"]
+            try:
+                yield index, dict(future.result(), id=item_id)
+            except Exception as e:
+                app.logger.error("Batch {}: submission {} failed: {}".format(request_id, item_id, e))
+                yield index, {"id": item_id, "error": str(e) or type(e).__name__}
+
+
+@app.route('/v1/jobs', methods=['POST'])
+def post_job():
+    """
+    Accepts a submission for grading and answers at once with the job's ID; the body is the same as
+    `/v1/grade`'s. The result is fetched from `GET /v1/jobs/<id>`, which the `Location` header names.
+
+    503 with `Retry-After` when this process already has `JOB_QUEUE_LIMIT` jobs unfinished. Another
+    worker may well have room, so retrying soon is the right response. 429 with `Retry-After` when
+    the host has no room for the container now — the job would only wait, and another executor may
+    not have to.
+    """
+    content = _json_request()
+    admission.check(content["max_mem_mb"], content["max_time_sec"])
+
+    try:
+        job_id = jobs.submit(_grading_job(content))
+    except jobs.QueueFull as e:
+        app.logger.warning("Job refused: {}".format(e))
+        return jsonify({"message": "Too many jobs waiting, retry later"}), 503, {"Retry-After": "5"}
+
+    app.logger.info("Job submitted: {}".format(job_id))
+    return jsonify({"id": job_id, "status": jobs.QUEUED}), 202, {"Location": "/v1/jobs/" + job_id}
+
+
+@app.route('/v1/jobs', methods=['GET'])
+def get_jobs():
+    """How many jobs the answering process has unfinished, and its limits. Per process like `/v1/pool`."""
+    return jsonify(jobs.jobs_status())
+
 
-    return jsonify({"grade": assessment[0], "feedback": assessment[1]})
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    A job's status, and its result once it is done. `?wait=<seconds>` holds the request until the job
+    finishes or the time runs out, whichever is first, capped at `JOB_MAX_WAIT_SEC`; without it the
+    answer is immediate. A job that is still running after the wait is a 200 like any other, with its
+    status saying so — the caller simply asks again.
+    """
+    try:
+        wait_sec = float(request.args.get("wait", 0))
+    except ValueError:
+        raise BadRequest("wait must be a number of seconds")
+
+    record = jobs.wait(job_id, wait_sec)
+    if record is None:
+        return jsonify({"message": "No such job"}), 404
+    return jsonify(record)
 
 
 @app.route('/v1/version', methods=['GET'])
@@ -220,6 +642,88 @@ def get_version():
     })
 
 
+@app.route('/v1/pool', methods=['GET'])
+def get_pool():
+    """
+    How the warm container pool is doing: how many containers are ready per image and memory limit,
+    and how often a submission found one. Answered from memory; no Docker work happens here.
+
+    Per process. Under gunicorn this is whichever worker took the request, which is why the answer
+    carries its pid — two calls may well describe two different pools. The reaper that removes the
+    containers afterwards is per process too, and reported here. `orphans` is the exception: the last
+    sweep for containers nobody removed, which is host-wide and read from the file it left.
+
+    `runtime` is what runs this host's containers (see `runtimes.py`). The pool is Docker's: under
+    another runtime it stays empty.
+    """
+    return jsonify(dict(containers.warm_pool_status(), reaper=containers.reaper_status(),
+                        orphans=containers.orphan_sweep_status(), runtime=containers.RUNTIME))
+
+
+@app.route('/v1/exercise-images', methods=['GET'])
+def get_exercise_images():
+    """
+    How the per-exercise image cache is doing: hits, misses, builds, and how much of its disk budget
+    it used when this process last trimmed it. Answered from memory, and per process like `/v1/pool`.
+    """
+    return jsonify(containers.exercise_cache_status())
+
+
+@app.route('/v1/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Per-phase grading times, runs by status and image, and containers in flight, in Prometheus' text
+    format. Host-wide: every worker's numbers are added up, whichever worker answers (see `metrics.py`).
+    """
+    return Response(metrics.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/v1/results', methods=['GET'])
+def get_results():
+    """How the result cache is doing: hits, misses, requests collapsed into another's run. Per process."""
+    return jsonify(results.result_cache_status())
+
+
+@app.route('/v1/admission', methods=['GET'])
+def get_admission():
+    """
+    What is running on this host against the admission budgets. Host-wide, unlike `/v1/pool`: the
+    leases are shared by every worker, so any worker gives the same answer.
+    """
+    return jsonify(admission.admission_status())
+
+
+@app.route('/v1/load', methods=['GET'])
+def get_load():
+    """
+    How loaded this host is, for core to choose an executor by: running containers, memory promised
+    against the host's, CPU pressure, recent grade times per image, and how many more runs of
+    `?mem_mb=<MB>` it would take now. From a snapshot at most a second old, so it is cheap to poll; see
+    `load.py` for what each number means and which are per process.
+    """
+    mem_mb = request.args.get("mem_mb")
+    if mem_mb is not None:
+        try:
+            mem_mb = int(mem_mb)
+        except ValueError:
+            raise BadRequest("mem_mb must be a whole number of megabytes")
+        if mem_mb < 1:
+            raise BadRequest("mem_mb must be at least 1")
+    return jsonify(load.load_status(mem_mb))
+
+
+@app.errorhandler(admission.Saturated)
+def handle_saturated(e):
+    app.logger.warning("Refused, no room: {}".format(e))
+    return jsonify({"message": "Executor is at capacity, retry later"}), 429, {"Retry-After": str(e.retry_after)}
+
+
+@app.errorhandler(deadlines.DeadlinePassed)
+def handle_deadline_passed(e):
+    app.logger.info("Dropped, the caller's deadline: {}".format(e))
+    return jsonify({"message": "Deadline passed before the grade could be given: {}".format(e)}), 503
+
+
 @app.errorhandler(BadRequest)
 def handle_bad_request(e):
     return jsonify({"message": e.description}), 400
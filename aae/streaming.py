@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Grading as it happens: `/v1/grade/stream` says what a run is doing while it does it.
+
+`/v1/grade` answers once, at the end, which for an imgrec run or a heavy silmused suite is a long
+silence in which core cannot tell a slow run from a lost one, cannot show a student anything, and
+cannot stop a run whose student has gone. The stream answers the same request with events instead,
+one per line:
+
+    {"event": "queued"}
+    {"event": "started", "container": "3f2a9c1b"}
+    {"event": "output", "text": "Test 1: OK\\n"}
+    {"event": "running", "elapsed_sec": 15.0}
+    {"event": "finished", "result": {"grade": 100, "feedback": "..."}}
+
+`result` is exactly what `/v1/grade` would have answered. A run that failed ends with
+`{"event": "error", "message": "..."}` instead — by then the status line has long gone out as 200, so
+this is the only place a failure can be said. As NDJSON by default, or as server-sent events
+(`event: started` / `data: {...}`) for a client whose `Accept` prefers `text/event-stream`.
+
+### What is in it
+
+The lifecycle always. `output` only when asked for (`?output=1`), and only the first
+`STREAM_OUTPUT_BYTES` of it: it is for showing progress, and a `while True: print()` should not be
+able to send core hundreds of megabytes of it. The grade is still parsed from the whole output, bounded
+as always by `OUTPUT_LIMIT_BYTES`. The output comes from the container's log stream as it is read
+(see `containers.py`, "following a run"), not from a `logs()` call at the exit.
+
+When nothing has happened for `STREAM_HEARTBEAT_SEC`, the current state is sent again with how long
+the request has been going. That is what tells core the run is alive, and it is also how the executor
+finds out that core is not: a write to a closed connection fails.
+
+### Abandoning
+
+A stream that is closed before it finished — core gave up, the student closed the page — abandons
+its run. A run that has not started is not started; a running one is killed; either ends in
+GradingAbandoned, which is never remembered as a grade. A closed connection is only noticed at the
+next write, so within a heartbeat.
+
+An identical submission that came in at the same moment is answered by the same run (see
+`results.py`), so abandoning one kills the run the other was waiting for. The other then runs it again
+itself: a closed stream costs an identical request the time it had waited, never its answer.
+"""
+import codecs
+import json
+import os
+import queue
+import threading
+from time import time
+
+NDJSON = "application/x-ndjson"
+SSE = "text/event-stream"
+
+STREAM_HEARTBEAT_SEC = 5
+STREAM_OUTPUT_BYTES = int(os.environ.get("EASY_STREAM_OUTPUT_BYTES", str(64 * 1024)))
+
+QUEUED = "queued"
+STARTED = "started"
+RUNNING = "running"
+OUTPUT = "output"
+FINISHED = "finished"
+ERROR = "error"
+
+
+class GradeStream:
+    """
+    One request's events, from the grading thread to the response.
+
+    The grading side is a listener as `containers.py` describes one, plus `settle`, which is handed the
+    job's future. The HTTP side is `lines`, a generator to hand a streamed Response.
+    """
+
+    def __init__(self, include_output=False):
+        self.include_output = include_output
+        self.state = QUEUED
+        self._started_at = time()
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._abandon = None
+        self._abandoned = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._output_bytes = 0
+        self._output_cut = False
+
+    # --- told by the run, on the grading thread
+
+    def started(self, container_id):
+        self.state = RUNNING
+        self._events.put((STARTED, {"container": container_id}))
+
+    def output(self, chunk):
+        if not self.include_output or self._output_cut:
+            return
+        room = STREAM_OUTPUT_BYTES - self._output_bytes
+        self._output_bytes += min(room, len(chunk))
+        event = {"text": self._decoder.decode(chunk[:room], final=len(chunk) > room)}
+        if len(chunk) > room:
+            self._output_cut = True
+            event["truncated"] = True
+        if event["text"] or self._output_cut:
+            self._events.put((OUTPUT, event))
+
+    def on_abandon(self, callback):
+        with self._lock:
+            self._abandon = callback
+            abandoned = self._abandoned
+        if abandoned and callback is not None:
+            callback()
+
+    def settle(self, future):
+        """The job is done: its result is the last event, or its exception is."""
+        try:
+            self._events.put((FINISHED, {"result": future.result()}))
+        except Exception as e:
+            event = {"message": str(e) or type(e).__name__}
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None:
+                event["retry_after"] = retry_after
+            self._events.put((ERROR, event))
+
+    @property
+    def abandoned(self):
+        with self._lock:
+            return self._abandoned
+
+    # --- read by the response, on the request's thread
+
+    def lines(self, media_type=NDJSON):
+        """The events as `media_type` text, until the last. Abandons the run if closed before it."""
+        done = False
+        try:
+            yield _encode(QUEUED, {}, media_type)
+            while True:
+                try:
+                    name, fields = self._events.get(timeout=STREAM_HEARTBEAT_SEC)
+                except queue.Empty:
+                    yield _encode(self.state, {"elapsed_sec": round(time() - self._started_at, 1)}, media_type)
+                    continue
+                yield _encode(name, fields, media_type)
+                if name in (FINISHED, ERROR):
+                    done = True
+                    return
+        finally:
+            if not done:
+                self.abandon()
+
+    def abandon(self):
+        with self._lock:
+            self._abandoned = True
+            callback = self._abandon
+        if callback is not None:
+            callback()
+
+
+def _encode(name, fields, media_type):
+    if media_type == SSE:
+        return "event: {}\ndata: {}\n\n".format(name, json.dumps(fields))
+    return json.dumps(dict({"event": name}, **fields)) + "\n"
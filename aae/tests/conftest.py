@@ -10,10 +10,19 @@ Note what this means: **the suite exercises the modules exactly as deployed**, r
 packaged variant that behaves differently. Turning `aae/` into a package to satisfy the test runner
 would be testing something the executor never runs.
 """
+import collections
 import os
 import sys
+import threading
 
+import docker.errors
 import pytest
+import requests.exceptions
+
+# The orphan sweep starts a thread when `server` is imported, which would list containers on whatever
+# Docker the test that happens to be running has faked. Off before anything imports `containers`;
+# `test_orphans.py` calls the sweep itself.
+os.environ["EASY_ORPHAN_SWEEP_SEC"] = "0"
 
 AAE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if AAE_ROOT not in sys.path:
@@ -46,6 +55,222 @@ def logger():
     return RecordingLogger()
 
 
+# --- a fake Docker daemon -------------------------------------------------------------------------
+#
+# One, configurable, for every test that needs the daemon rather than a `runtimes.FakeRuntime`: a test
+# says what it cares about (what the container prints, how long it runs, which call fails, which
+# images exist) and reads back what was done to it. Stand it in with
+#
+#     monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+#
+# or hand it straight to the function under test where that takes a client.
+
+class FakeContainer:
+    """
+    A container as docker-py hands it out. Every call made on it is appended to `calls`, as
+    `(name, *args)`, and the one named by `fail_on` raises APIError instead.
+
+    Once started it runs for `runs_for` seconds, or until killed or `finish`ed if that is None, and
+    then exits with `exit_code` (137 if it was killed). `output`, bytes or a list of chunks, is what
+    `logs` delivers: all at once when it exits, or as soon as it is read with `streams`, as a program
+    that prints as it goes. A `docker` given is the FakeDocker whose `container_list` it is in.
+    """
+
+    def __init__(self, image=None, kwargs=None, calls=None, output=b"grade: 100\n", runs_for=0.0, exit_code=0,
+                 streams=False, fail_on=None, short_id="c0ffee", labels=None, status="exited", docker=None):
+        self.image = image
+        self.kwargs = kwargs or {}
+        self.calls = [] if calls is None else calls
+        self.output = [output] if isinstance(output, bytes) else output
+        self.runs_for = runs_for
+        self.exit_code = exit_code
+        self.streams = streams
+        self.fail_on = fail_on
+        self.short_id = short_id
+        self.labels = (self.kwargs.get("labels") or {}) if labels is None else labels
+        self.status = status
+        self.docker = docker
+        self.archives = []
+        self.sent = b""
+        self.started = False
+        self.removed = False
+        self.exited = threading.Event()
+        self.killed = threading.Event()
+
+    def _call(self, name, *args):
+        self.calls.append((name,) + args)
+        if name == self.fail_on:
+            raise docker.errors.APIError("refused: " + name)
+
+    def put_archive(self, path, data):
+        self._call("put_archive", path)
+        self.archives.append(data)
+        return True
+
+    def update(self, **kwargs):
+        self._call("update", kwargs)
+
+    def start(self):
+        self._call("start")
+        self.started = True
+        if self.runs_for is not None:
+            timer = threading.Timer(self.runs_for, self.exited.set)
+            timer.daemon = True
+            timer.start()
+
+    def finish(self):
+        """Ends a container that runs until told to, as its program returning would."""
+        self.exited.set()
+
+    def attach_socket(self, params=None):
+        outer = self
+
+        class Socket:
+            def sendall(self, data):
+                outer.sent += data
+
+            def close(self):
+                pass
+
+        return Socket()
+
+    def reload(self):
+        # Once, after the exit, for the OOM flag — never to find out whether it has exited.
+        if not self.exited.is_set():
+            raise AssertionError("the container's status was polled")
+        self._call("reload")
+        self.attrs = {"State": {"OOMKilled": False, "ExitCode": self._exit_status()}}
+
+    def wait(self, timeout=None):
+        self._call("wait")
+        if not self.exited.wait(timeout):
+            raise requests.exceptions.ReadTimeout("wait timed out")
+        return {"StatusCode": self._exit_status()}
+
+    def _exit_status(self):
+        return 137 if self.killed.is_set() else self.exit_code
+
+    def kill(self):
+        if self.exited.is_set():
+            raise docker.errors.APIError("container is not running")
+        self._call("kill")
+        self.killed.set()
+        self.exited.set()
+
+    def logs(self, stream=False, follow=False):
+        assert stream and follow, "the output was read in one piece"
+        return FakeStream(self)
+
+    def remove(self, force=False):
+        self._call("remove", force)
+        if self.docker is not None:
+            if self.docker.refuse:
+                raise docker.errors.APIError("daemon busy")
+            self.docker.container_list.remove(self)
+        self.removed = True
+
+
+class FakeStream:
+    """`logs(stream=True, follow=True)`: the container's output, and the end of it once it has exited."""
+
+    def __init__(self, container):
+        self.container = container
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        container = self.container
+        if container.streams:
+            yield from container.output
+        while not (container.exited.wait(0.01) or self.closed.is_set()):
+            pass
+        if not container.streams and not self.closed.is_set():
+            yield from container.output
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeImage:
+    def __init__(self, image_id, labels=None, tags=(), size=0):
+        self.id = image_id
+        self.labels = labels or {}
+        self.tags = list(tags)
+        self.attrs = {"Size": size}
+
+
+class FakeDocker:
+    """
+    docker-py's client, as far as the executor uses it.
+
+    `containers.create` hands out `container` if one was given, the same one every time, and a new
+    FakeContainer of that image otherwise; `on_create(image, kwargs)`, if given, is called first. What
+    it made is in `created`. `images.get` knows the names in `image_ids` (name -> ID), with the labels
+    in `image_labels` (name -> labels). The lists are `container_list` and `image_list`, filtered by
+    label as the daemon filters them, and `refuse` makes every removal from `container_list` fail.
+    Nothing may be built, and only a listed image removed.
+    """
+
+    def __init__(self, container=None, image_ids=None, image_labels=None, on_create=None):
+        self.container = container
+        self.image_ids = dict(image_ids or {})
+        self.image_labels = dict(image_labels or {})
+        self.on_create = on_create
+        self.created = []
+        self.container_list = []
+        self.image_list = []
+        self.refuse = False
+        self.lists = 0
+        outer = self
+
+        class Containers:
+            def create(self, image, **kwargs):
+                if outer.on_create is not None:
+                    outer.on_create(image, kwargs)
+                if outer.container is None:
+                    container = FakeContainer(image, kwargs)
+                else:
+                    container = outer.container
+                    container.image, container.kwargs = image, kwargs
+                container.calls.append(("create", image))
+                outer.created.append(container)
+                return container
+
+            def list(self, all=False, filters=None):
+                outer.lists += 1
+                return [c for c in outer.container_list if _labelled(c.labels, filters)]
+
+        class Images:
+            def get(self, name):
+                if name not in outer.image_ids:
+                    raise docker.errors.ImageNotFound(name)
+                return FakeImage(outer.image_ids[name], outer.image_labels.get(name))
+
+            def list(self, filters=None):
+                return [i for i in outer.image_list if _labelled(i.labels, filters)]
+
+            def build(self, **kwargs):
+                raise AssertionError("an image was built")
+
+            def remove(self, image, force=False):
+                if image not in [i.id for i in outer.image_list]:
+                    raise AssertionError("an image was removed: " + image)
+                outer.image_list[:] = [i for i in outer.image_list if i.id != image]
+
+        self.containers = Containers()
+        self.images = Images()
+
+    def add_container(self, **kwargs):
+        """A container already on the daemon, for `containers.list` to find."""
+        container = FakeContainer(docker=self, **kwargs)
+        self.container_list.append(container)
+        return container
+
+
+def _labelled(labels, filters):
+    key, _, value = (filters or {}).get("label", "").partition("=")
+    return not key or (labels or {}).get(key) == value
+
+
 @pytest.fixture(autouse=True)
 def isolated_grading_image_cache(tmp_path, monkeypatch):
     """Neutralise `containers`' grading-image cache for every test in this suite.
@@ -62,10 +287,72 @@ def isolated_grading_image_cache(tmp_path, monkeypatch):
     import containers
 
     monkeypatch.setattr(containers, "_image_cache", {"at": 0.0, "images": []})
+    # The warm pool is the same kind of state, and a test that claims from it would otherwise leave
+    # containers behind for the next one to be handed.
+    monkeypatch.setattr(containers, "_warm_pool", collections.OrderedDict())
+    monkeypatch.setattr(containers, "_warm_pool_stale", [])
+    # Off unless a test is about it: with it on, every grading would first look for an exercise image,
+    # and a suite about something else would be asserting on that instead.
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_MB", 0)
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_DIR", str(tmp_path / "exercise-images"))
+    monkeypatch.setattr(containers, "_exercise_cache_stats", dict.fromkeys(containers._exercise_cache_stats, 0))
+    monkeypatch.setattr(containers, "_exercise_cache_trimmed_at", 0.0)
     monkeypatch.setattr(containers, "IMAGE_CACHE_FILE", str(tmp_path / "grading-images.json"))
     containers._refresh_running.clear()
+    monkeypatch.setattr(containers, "_reaper_stats", dict.fromkeys(containers._reaper_stats, 0))
+    monkeypatch.setattr(containers, "ORPHAN_SWEEP_FILE", str(tmp_path / "orphan-sweep.json"))
+    # The shared Docker client, so each test's fake daemon is the one its code talks to.
+    monkeypatch.setattr(containers, "_docker", {"factory": None, "client": None})
+
+    import jobs
+
+    # Job files go to the machine's tempdir otherwise, and outlive the run like the image cache did.
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path / "jobs"))
+    monkeypatch.setattr(jobs, "_jobs", {})
+
+    import admission
+
+    # Leases are host-wide by design, which in a test run means shared with every other run on the
+    # machine. Room for everything, unless a test is about running out of it.
+    monkeypatch.setattr(admission, "ADMISSION_DIR", str(tmp_path / "admission"))
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 1000)
+    monkeypatch.setattr(admission, "ADMISSION_MEM_MB", 1000 * 1000)
+    monkeypatch.setattr(admission, "ADMISSION_PROCESS_SLOTS", 1000)
+    admission._durations.clear()
+
+    import results
+
+    # Off unless a test is about it: a suite that grades the same submission in every test would
+    # otherwise be asserting on the first test's answer.
+    monkeypatch.setattr(results, "RESULT_CACHE_MB", 0)
+    monkeypatch.setattr(results, "RESULT_CACHE_DIR", "")
+    monkeypatch.setattr(results, "_memory", collections.OrderedDict())
+    monkeypatch.setattr(results, "_memory_bytes", 0)
+    monkeypatch.setattr(results, "_stats", dict.fromkeys(results._stats, 0))
+
+    import metrics
+
+    # Snapshots are added up across every process that wrote one to the directory, which outside a
+    # per-test directory would include other runs of this suite.
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path / "metrics"))
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_runs", {})
+    monkeypatch.setattr(metrics, "_in_flight", 0)
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_gauges", {})
+
+    import tracing
+
+    monkeypatch.setattr(tracing, "TRACE_DIR", str(tmp_path / "traces"))
+
+    import load
+
+    monkeypatch.setattr(load, "_grades", {})
+    monkeypatch.setattr(load, "_snapshot", {"at": None, "value": None})
     yield
     containers._refresh_running.clear()
+    # A removal still queued would land in the next test's fakes and counters.
+    containers.drain_reaper(5)
 
 
 @pytest.fixture
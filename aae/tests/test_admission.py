@@ -0,0 +1,335 @@
+# coding=utf-8
+"""Admission control: when a host says it is full, and what it tells core about when it will not be.
+
+A refusal that should not happen is a submission bounced to another executor for nothing; an
+admission that should not happen is an OOM-killed container and a student told their program used
+too much memory when it was the host that did. So most of these pin the arithmetic — memory promised
+is summed as limits, leases from dead processes do not count — and the rest pin the HTTP side: 429,
+a `Retry-After` worth believing, and that a refused request ran nothing.
+
+The leases are real files in a per-test directory; only the capacity is set per test.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import admission
+import server
+from containers import RunOutcome, RunStatus
+
+SEP = "#" * 50
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [],
+    "image_name": "python:3.12",
+    "max_time_sec": 20,
+    "max_mem_mb": 64,
+}
+
+
+@pytest.fixture(autouse=True)
+def admission_on(monkeypatch):
+    """Off by default until core retries a 429; every test here is about it being on."""
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+
+
+@pytest.fixture
+def host(monkeypatch):
+    """A host with room for two 64 MB containers."""
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 10)
+    monkeypatch.setattr(admission, "ADMISSION_MEM_MB", 128)
+
+
+@pytest.fixture
+def grader(monkeypatch):
+    runs = []
+
+    def fake(submission, grading_script, assets, image_name, max_time, max_mem, logger, request_id, cpus=None,
+             cpuset=None, listener=None, limits=None):
+        runs.append(admission.admission_status()["running"])
+        return RunOutcome(RunStatus.SUCCESS), f"feedback\n{SEP}\ngrade: 100"
+
+    monkeypatch.setattr(server, "grade_submission", fake)
+    return runs
+
+
+def write_lease(started_ago=0.0, mem_mb=64, max_time_sec=20, pid=None):
+    os.makedirs(admission.ADMISSION_DIR, exist_ok=True)
+    name = "{}-{}.lease".format(pid or os.getpid(), time.monotonic_ns())
+    with open(os.path.join(admission.ADMISSION_DIR, name), "w") as f:
+        json.dump({"pid": pid or os.getpid(), "mem_mb": mem_mb, "max_time_sec": max_time_sec,
+                   "start": time.time() - started_ago}, f)
+
+
+def post(client, path="/v1/grade", body=VALID):
+    return client.post(path, data=json.dumps(body), content_type="application/json")
+
+
+# --- what counts as full ------------------------------------------------------------------------
+
+def test_a_run_holds_its_lease_while_it_runs_and_gives_it_back(client, host, grader):
+    assert post(client).status_code == 200
+
+    assert grader == [1]
+    assert admission.admission_status()["running"] == 0
+
+
+def test_memory_is_counted_as_the_sum_of_limits(host):
+    write_lease(mem_mb=64)
+
+    with admission.lease(64, 20):
+        with pytest.raises(admission.Saturated):
+            admission.check(1, 20)
+
+
+def test_the_container_count_is_a_limit_of_its_own(host, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 1)
+    write_lease(mem_mb=1)
+
+    with pytest.raises(admission.Saturated):
+        admission.check(1, 20)
+
+
+def test_a_run_bigger_than_the_host_still_runs_on_an_empty_host(host):
+    with admission.lease(4096, 20):
+        assert admission.admission_status()["running"] == 1
+
+
+def test_a_lease_left_by_a_dead_process_does_not_count(host):
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    write_lease(mem_mb=128, pid=gone.pid)
+
+    admission.check(64, 20)
+
+    assert admission.admission_status()["running"] == 0
+
+
+def test_a_lease_long_past_its_time_limit_does_not_count(host):
+    write_lease(mem_mb=128, max_time_sec=20, started_ago=20 + admission.ADMISSION_LEASE_GRACE_SEC + 1)
+
+    admission.check(64, 20)
+
+
+# --- which cores -------------------------------------------------------------------------------
+
+@pytest.fixture
+def pinning(host, monkeypatch):
+    """Four cores, pinning on."""
+    monkeypatch.setattr(admission, "ADMISSION_CPU_PINNING", True)
+    monkeypatch.setattr(admission, "host_cores", lambda: [0, 1, 2, 3])
+
+
+def test_without_pinning_a_run_is_given_no_cpuset(host):
+    with admission.lease(64, 20, cpus=1) as cpuset:
+        assert cpuset is None
+
+
+def test_runs_are_kept_apart_while_there_are_idle_cores(pinning):
+    with admission.lease(1, 20, cpus=1) as first, admission.lease(1, 20, cpus=2) as second:
+        with admission.lease(1, 20, cpus=1) as third:
+            assert (first, second, third) == ("0", "1,2", "3")
+
+
+def test_once_every_core_is_taken_runs_go_to_the_least_loaded(pinning):
+    with admission.lease(1, 20, cpus=3):                       # 0,1,2
+        with admission.lease(1, 20, cpus=1):                   # 3
+            with admission.lease(1, 20, cpus=1) as cpuset:     # all have one; lowest first
+                assert cpuset == "0"
+            with admission.lease(1, 20, cpus=0.5) as cpuset:   # a fraction still needs a whole core
+                assert cpuset == "0"
+
+
+def test_a_core_is_free_again_once_its_run_ends(pinning):
+    with admission.lease(1, 20, cpus=1):
+        pass
+
+    with admission.lease(1, 20, cpus=1) as cpuset:
+        assert cpuset == "0"
+        assert admission.admission_status()["leases_per_core"] == {"0": 1, "1": 0, "2": 0, "3": 0}
+
+
+def test_pinning_spreads_runs_with_admission_off_and_refuses_none(pinning, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", False)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 1)
+
+    with admission.lease(1000, 20, cpus=1) as first, admission.lease(1000, 20, cpus=1) as second:
+        assert (first, second) == ("0", "1")
+        assert admission.admission_status() == {"enabled": False, "cpu_pinning": True,
+                                                "leases_per_core": {"0": 1, "1": 1, "2": 0, "3": 0}}
+
+
+# --- slots in this process ---------------------------------------------------------------------
+
+@pytest.fixture
+def one_slot(host, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_PROCESS_SLOTS", 1)
+
+
+def hold_lease(release, **kwargs):
+    """Holds a lease on another thread until `release` is set. Returns once it is held."""
+    held = threading.Event()
+
+    def run():
+        with admission.lease(64, 20, **kwargs):
+            held.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert held.wait(5)
+    return thread
+
+
+def test_a_process_grades_no_more_than_its_slots_at_once(one_slot, monkeypatch):
+    # The host has room; the process does not.
+    monkeypatch.setattr(admission, "ADMISSION_MEM_MB", 1000)
+    release = threading.Event()
+    thread = hold_lease(release)
+
+    with pytest.raises(admission.Saturated) as refused:
+        with admission.lease(64, 20):
+            pass
+    release.set()
+    thread.join(5)
+
+    assert "slots" in str(refused.value) and refused.value.retry_after >= 1
+    assert admission.admission_status()["process_slots_taken"] == 0
+    with admission.lease(64, 20):
+        assert admission.admission_status()["process_slots_taken"] == 1
+
+
+def test_a_waiting_run_takes_the_slot_as_soon_as_it_is_given_back(one_slot):
+    release = threading.Event()
+    thread = hold_lease(release)
+    threading.Timer(0.2, release.set).start()
+
+    started = time.monotonic()
+    with admission.lease(64, 20, wait_sec=5):
+        waited = time.monotonic() - started
+    thread.join(5)
+
+    # Woken by the release, not by the lease directory's poll.
+    assert 0.1 < waited < admission.ADMISSION_POLL_SEC + 0.2
+
+
+def test_slots_limit_a_process_even_with_admission_off(one_slot, monkeypatch):
+    # Off, the run is not refused: it waits for the slot, however long that takes.
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", False)
+    release = threading.Event()
+    thread = hold_lease(release)
+    second = threading.Event()
+
+    def run():
+        with admission.lease(64, 20):
+            second.set()
+
+    waiting = threading.Thread(target=run)
+    try:
+        waiting.start()
+        assert not second.wait(0.3)
+    finally:
+        release.set()
+        thread.join(5)
+    assert second.wait(5)
+    waiting.join(5)
+
+
+# --- Retry-After --------------------------------------------------------------------------------
+
+def test_retry_after_is_when_a_running_container_reaches_its_limit(host):
+    write_lease(mem_mb=128, max_time_sec=20, started_ago=5)
+
+    with pytest.raises(admission.Saturated) as refused:
+        admission.check(64, 20)
+
+    assert 14 <= refused.value.retry_after <= 16
+
+
+def test_retry_after_uses_how_long_runs_have_been_taking(host):
+    # Runs have been taking eight seconds; the one that started five seconds ago is likely three away
+    # from finishing, not the fifteen its limit allows.
+    admission._durations.extend([8.0] * 5)
+    write_lease(mem_mb=128, max_time_sec=20, started_ago=5)
+
+    with pytest.raises(admission.Saturated) as refused:
+        admission.check(64, 20)
+
+    assert 2 <= refused.value.retry_after <= 4
+
+
+def test_retry_after_waits_for_enough_to_end_to_fit_the_request(host):
+    write_lease(mem_mb=64, max_time_sec=20, started_ago=15)  # ends in 5
+    write_lease(mem_mb=64, max_time_sec=20, started_ago=5)   # ends in 15
+
+    with pytest.raises(admission.Saturated) as refused:
+        admission.check(128, 20)
+
+    assert 14 <= refused.value.retry_after <= 16
+
+
+def test_retry_after_is_capped(host):
+    write_lease(mem_mb=128, max_time_sec=3600)
+
+    with pytest.raises(admission.Saturated) as refused:
+        admission.check(64, 20)
+
+    assert refused.value.retry_after == admission.ADMISSION_MAX_RETRY_AFTER_SEC
+
+
+# --- over HTTP ----------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("path", ["/v1/grade", "/v1/jobs"])
+def test_a_full_host_answers_429_with_retry_after_and_runs_nothing(client, host, grader, path):
+    write_lease(mem_mb=128, max_time_sec=20, started_ago=10)
+
+    resp = post(client, path)
+
+    assert resp.status_code == 429
+    assert 9 <= int(resp.headers["Retry-After"]) <= 11
+    assert grader == []
+
+
+def test_a_full_host_refuses_a_batch_up_front(client, host, grader):
+    write_lease(mem_mb=128)
+    batch = {k: v for k, v in VALID.items() if k != "submission"}
+    batch["submissions"] = [{"id": 1, "submission": "print(1)"}]
+
+    assert post(client, "/v1/grade/batch", batch).status_code == 429
+    assert grader == []
+
+
+def test_an_accepted_job_waits_for_room_rather_than_failing(host, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_POLL_SEC", 0.01)
+    held = admission.lease(128, 20)
+    held.__enter__()
+    admitted = threading.Event()
+
+    def job():
+        with admission.lease(64, 20, wait_sec=5):
+            admitted.set()
+
+    thread = threading.Thread(target=job)
+    thread.start()
+    assert not admitted.wait(0.1)
+
+    held.__exit__(None, None, None)
+    assert admitted.wait(5)
+    thread.join()
+
+
+def test_the_admission_endpoint_reports_what_is_promised(client, host):
+    write_lease(mem_mb=64)
+
+    body = client.get("/v1/admission").get_json()
+
+    assert body["running"] == 1
+    assert body["mem_mb_promised"] == 64
+    assert body["mem_mb_budget"] == 128
@@ -0,0 +1,50 @@
+# coding=utf-8
+"""`benchmark.py` still runs, and says what it claims to — a handful of requests per scenario, not a measurement.
+
+A benchmark that nobody runs rots silently: an argument renamed in `grade_submission` and the first
+anyone hears of it is the week somebody wanted numbers. So CI runs every scenario against both
+targets, a few requests each, and checks the shape of what would be kept. The numbers themselves are
+not asserted on; on a shared CI runner they mean nothing.
+"""
+import json
+
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def modules(monkeypatch):
+    # A 64 MB output is the point of the real run and only slows this one down.
+    monkeypatch.setattr(benchmark, "HUGE_OUTPUT_MB", 1)
+    return benchmark.load()
+
+
+def test_every_scenario_runs_against_both_targets(modules):
+    report = benchmark.run(requests=4, alloc_requests=1, modules=modules)
+
+    found = {(r["scenario"], r["target"]) for r in report["results"]}
+    assert found == {(s, t) for s in benchmark.SCENARIOS for t in benchmark.TARGETS}
+    for r in report["results"]:
+        assert r["rps"] > 0 and r["p50_ms"] <= r["p90_ms"] <= r["p99_ms"]
+        assert r["peak_alloc_kib"] > 0
+    json.dumps(report)  # what --json writes
+
+
+def test_dockers_share_is_taken_out_of_the_latency(modules):
+    report = benchmark.run(scenarios=["small"], targets=["containers"], requests=4, alloc_requests=0,
+                           latency_ms={"start": 20, "remove": 50}, modules=modules)
+
+    result = report["results"][0]
+    # start is on the request path; remove is on the reaper, after the answer.
+    assert result["docker_ms"] == pytest.approx(20, abs=1)
+    assert result["p50_ms"] >= 20
+    assert report["config"]["latency_ms"]["start"] == 20
+
+
+def test_a_slower_p50_than_the_baseline_is_a_regression():
+    baseline = {"results": [{"scenario": "small", "target": "server", "p50_ms": 2.0}]}
+    now = {"results": [{"scenario": "small", "target": "server", "p50_ms": 2.3}]}
+
+    assert benchmark.regressions(now, baseline, tolerance=0.2) == []
+    assert len(benchmark.regressions(now, baseline, tolerance=0.1)) == 1
@@ -0,0 +1,150 @@
+# coding=utf-8
+"""gzip on `/v1/grade`: compressed bodies in, compressed answers out, and the old contract untouched.
+
+The cap is the part with consequences. A request body that inflates without limit is a way to take
+an executor's memory with a few kilobytes, so it is pinned that the cap holds *while* inflating. The
+rest is that a core which compresses nothing sees no difference at all, and that a streamed answer is
+never held back to be compressed.
+
+Grading is replaced as in `test_grade_endpoint.py`.
+"""
+import gzip
+import json
+
+import pytest
+
+import compression
+import server
+from containers import RunOutcome, RunStatus
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [{"file_name": "data.txt", "file_content": "1 2 3\n" * 5000}],
+    "image_name": "python:3.12",
+    "max_time_sec": 10,
+    "max_mem_mb": 64,
+}
+FEEDBACK = "Test 1: OK\n" * 500
+
+
+@pytest.fixture
+def grader(monkeypatch):
+    received = []
+
+    def fake(submission, grading_script, assets, image_name, *args, **kwargs):
+        received.append(assets)
+        return RunOutcome(RunStatus.SUCCESS), "{}\n{}\ngrade: 100".format(FEEDBACK, "#" * 50)
+
+    monkeypatch.setattr(server, "grade_submission", fake)
+    return received
+
+
+def post_gzipped(client, payload, **kwargs):
+    return client.post("/v1/grade", data=gzip.compress(payload), content_type="application/json",
+                       headers=dict({"Content-Encoding": "gzip"}, **kwargs.pop("headers", {})), **kwargs)
+
+
+# --- requests -----------------------------------------------------------------------------------
+
+def test_a_gzipped_request_is_graded_like_a_plain_one(client, grader):
+    resp = post_gzipped(client, json.dumps(VALID).encode())
+
+    assert resp.status_code == 200
+    assert resp.get_json()["grade"] == 100
+    assert grader[0] == [("data.txt", VALID["assets"][0]["file_content"])]
+
+
+def test_a_plain_request_and_answer_are_as_they_always_were(client, grader):
+    resp = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json")
+
+    assert resp.status_code == 200
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_json()["feedback"] == FEEDBACK + "\n"
+
+
+def test_a_body_that_inflates_past_the_cap_is_refused_before_it_is_all_inflated(client, grader, monkeypatch):
+    monkeypatch.setattr(compression, "REQUEST_MAX_MB", 1)
+    bomb = b" " * (50 * 1024 * 1024)  # 50 MB of spaces, about 50 KB of gzip
+
+    resp = post_gzipped(client, bomb)
+
+    assert resp.status_code == 413
+    assert "1 MB" in resp.get_json()["message"]
+    assert grader == []
+
+
+def test_the_cap_holds_inside_a_single_chunk():
+    inflated = gzip.compress(b"x" * (10 * 1024 * 1024))
+    assert len(inflated) < compression.CHUNK_BYTES
+
+    with pytest.raises(compression.RequestRefused) as refused:
+        compression.inflate(_Stream(inflated), len(inflated), limit=1024)
+
+    assert refused.value.status == 413
+
+
+def test_a_body_that_is_not_gzip_is_a_bad_request(client, grader):
+    resp = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json",
+                       headers={"Content-Encoding": "gzip"})
+
+    assert resp.status_code == 400
+    assert grader == []
+
+
+def test_a_cut_off_gzip_body_is_a_bad_request(client, grader):
+    resp = client.post("/v1/grade", data=gzip.compress(json.dumps(VALID).encode())[:-20],
+                       content_type="application/json", headers={"Content-Encoding": "gzip"})
+
+    assert resp.status_code == 400
+
+
+def test_another_encoding_is_unsupported(client, grader):
+    resp = client.post("/v1/grade", data=b"...", content_type="application/json", headers={"Content-Encoding": "br"})
+
+    assert resp.status_code == 415
+    assert "gzip" in resp.get_json()["message"]
+
+
+# --- answers ------------------------------------------------------------------------------------
+
+def test_the_answer_is_gzipped_for_a_client_that_accepts_it(client, grader):
+    resp = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json",
+                       headers={"Accept-Encoding": "gzip, deflate"})
+
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert json.loads(gzip.decompress(resp.get_data()))["feedback"] == FEEDBACK + "\n"
+
+
+def test_a_small_answer_is_not_worth_compressing(client):
+    resp = client.get("/v1/version", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_a_client_that_refuses_gzip_gets_plain_text(client, grader):
+    resp = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json",
+                       headers={"Accept-Encoding": "gzip;q=0, identity"})
+
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_a_streamed_answer_is_never_compressed():
+    # A batch's NDJSON: each line has to go out when its submission is graded, not when all are.
+    lines = server.Response((line for line in ["a" * 2000 + "\n"] * 3), mimetype="application/x-ndjson")
+
+    with server.app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        resp = compression.compress_response(lines)
+
+    assert "Content-Encoding" not in resp.headers
+    assert resp.is_streamed
+
+
+class _Stream:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n):
+        chunk, self.data = self.data[:n], self.data[n:]
+        return chunk
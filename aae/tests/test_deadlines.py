@@ -0,0 +1,166 @@
+# coding=utf-8
+"""Deadlines: a request whose caller has stopped waiting is not graded, and a run is killed when it stops.
+
+The point is the waste in a backlog, so what is pinned is what does *not* happen: no container for a
+request refused up front, and a run past its caller's deadline killed rather than finished. Runs go
+through the fake runtime (`runtimes.FakeRuntime`), so a kill is a call the test can see.
+"""
+import threading
+import time
+
+import pytest
+
+import containers
+import deadlines
+import load
+import metrics
+import results
+import runtimes
+import server
+
+SEP = "#" * 50
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [],
+    "image_name": "python:3.12",
+    "max_time_sec": 20,
+    "max_mem_mb": 64,
+}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    runtime = runtimes.FakeRuntime(chunks=["{}\ngrade: 100\n".format(SEP).encode()])
+    monkeypatch.setattr(containers, "_runtime", runtime)
+    monkeypatch.setattr(deadlines, "DEADLINE_MARGIN_SEC", 0.05)
+    # Run times are only kept apart for the host's own grading images.
+    monkeypatch.setenv("EASY_GRADING_IMAGE_NAMES", "python")
+    return runtime
+
+
+# --- the headers ---------------------------------------------------------------------------------
+
+def test_a_timeout_counts_from_arrival_and_the_earlier_of_two_wins():
+    assert deadlines.from_headers({}, now=1000.0) is None
+    assert deadlines.from_headers({"X-Request-Timeout": "30"}, now=1000.0) == 1030.0
+    assert deadlines.from_headers({"X-Request-Deadline": "1010.5"}, now=1000.0) == 1010.5
+    assert deadlines.from_headers({"X-Request-Timeout": "30", "X-Request-Deadline": "1010"}, now=1000.0) == 1010.0
+
+
+@pytest.mark.parametrize("value", ["soon", "nan", "inf"])
+def test_a_header_that_is_not_a_number_of_seconds_is_a_bad_request(client, fake, value):
+    answer = client.post("/v1/grade", json=VALID, headers={"X-Request-Timeout": value})
+
+    assert answer.status_code == 400
+    assert fake.calls == []
+
+
+# --- refused up front ----------------------------------------------------------------------------
+
+def test_a_request_whose_deadline_has_passed_starts_nothing(client, fake):
+    answer = client.post("/v1/grade", json=VALID, headers={"X-Request-Deadline": str(time.time() - 1)})
+
+    assert answer.status_code == 503
+    assert "Deadline passed" in answer.get_json()["message"]
+    assert fake.calls == []
+    assert metrics._counters["deadline_refused"] == 1
+
+
+def test_a_request_shorter_than_its_images_typical_run_starts_nothing(client, fake):
+    load.record_grade("python:3.12", 5.0)
+
+    answer = client.post("/v1/grade", json=VALID, headers={"X-Request-Timeout": "2"})
+
+    assert answer.status_code == 503
+    assert fake.calls == []
+
+
+def test_the_typical_run_is_capped_at_the_requests_own_time_limit(client, fake):
+    load.record_grade("python:3.12", 60.0)
+
+    answer = client.post("/v1/grade", json=dict(VALID, max_time_sec=1), headers={"X-Request-Timeout": "2"})
+
+    assert answer.status_code == 200
+    assert answer.get_json()["grade"] == 100
+
+
+def test_without_a_deadline_nothing_changes(client, fake):
+    load.record_grade("python:3.12", 5.0)
+
+    assert client.post("/v1/grade", json=VALID).status_code == 200
+    assert "deadline_refused" not in metrics._counters
+
+
+# --- killed at the deadline ----------------------------------------------------------------------
+
+def test_a_run_still_going_at_the_deadline_is_killed(client, fake):
+    fake.run_sec = 5
+
+    started = time.monotonic()
+    answer = client.post("/v1/grade", json=VALID, headers={"X-Request-Timeout": "0.3"})
+
+    assert answer.status_code == 503
+    assert time.monotonic() - started < 2
+    assert ("kill", fake.handles[0].short_id) in fake.calls
+    assert metrics._counters["deadline_killed"] == 1
+    assert metrics._runs == {("ABANDONED", "python"): 1}
+
+
+def test_a_run_that_finishes_first_is_answered_and_its_timer_stopped(client, fake):
+    answer = client.post("/v1/grade", json=VALID, headers={"X-Request-Timeout": "0.5"})
+    time.sleep(0.6)
+
+    assert answer.status_code == 200
+    assert "kill" not in [method for method, _ in fake.calls]
+    assert "deadline_killed" not in metrics._counters
+
+
+# --- identical requests with different deadlines ------------------------------------------------
+
+def join_a_run(fake, monkeypatch, first_deadline, second_deadline):
+    """The answers, or exceptions, of two identical requests with these deadlines, the second joining the first's run."""
+    monkeypatch.setattr(results, "RESULT_CACHE_MB", 1)
+    monkeypatch.setattr(containers, "image_id", lambda name: "sha256:one")
+    answers = {}
+
+    def grade(name, deadline):
+        try:
+            answers[name] = server.grade(dict(VALID), server.app.logger, name, deadline=deadline)
+        except Exception as e:
+            answers[name] = e
+
+    first = threading.Thread(target=grade, args=("first", first_deadline))
+    first.start()
+    while not fake.handles:
+        time.sleep(0.01)
+    second = threading.Thread(target=grade, args=("second", second_deadline))
+    second.start()
+    first.join()
+    second.join()
+    return answers
+
+
+def test_a_request_that_joined_a_run_killed_at_anothers_deadline_is_graded(fake, monkeypatch):
+    fake.run_sec = 0.6
+
+    answers = join_a_run(fake, monkeypatch, time.time() + 0.3, None)
+
+    assert isinstance(answers["first"], deadlines.DeadlinePassed)
+    assert ("kill", fake.handles[0].short_id) in fake.calls
+    assert answers["second"]["grade"] == 100
+    assert len(fake.handles) == 2
+
+
+def test_a_request_waits_for_anothers_run_only_until_its_own_deadline(fake, monkeypatch):
+    fake.run_sec = 1
+
+    started = time.monotonic()
+    answers = join_a_run(fake, monkeypatch, None, time.time() + 0.3)
+
+    assert isinstance(answers["second"], deadlines.DeadlinePassed)
+    assert answers["first"]["grade"] == 100
+    assert len(fake.handles) == 1
+    assert "kill" not in [method for method, _ in fake.calls]
+    assert time.monotonic() - started < 2
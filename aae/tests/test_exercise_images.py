@@ -0,0 +1,282 @@
+# coding=utf-8
+"""The per-exercise image cache: one image per (base image, script, assets), and only the student's
+file per submission.
+
+What is at stake is the same thing twice. A submission graded on an image holding *another*
+exercise's script, or an older grading library than the bare tag now names, is graded wrongly and
+nobody can tell from the feedback. So most of these are about the key — what changes it and what does
+not — and about what happens when easy_grading_sync.py moves a tag underneath the cache.
+
+Docker is faked: images are dictionaries, and a commit records the archive it was given.
+"""
+import io
+import itertools
+import tarfile
+
+import pytest
+
+import containers
+from containers import RunOutcome, RunStatus
+
+SCRIPT = "#!/bin/sh\npython3 generated_0.py\n"
+ASSETS = [("generated_0.py", "print('test')")]
+
+
+def files_in(archive):
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        return {m.name: tar.extractfile(m).read().decode() for m in tar.getmembers() if m.isfile()}
+
+
+class FakeImage:
+    def __init__(self, image_id, tags, labels=None, size=0, files=None):
+        self.id = image_id
+        self.tags = tags
+        self.labels = labels or {}
+        self.attrs = {"Size": size}
+        self.files = files or {}
+
+
+class FakeDocker:
+    _ids = itertools.count()
+
+    def __init__(self):
+        self.images_by_id = {}
+        self.committed = []
+        self.removed = []
+        self.in_use = set()
+        self.add("sha256:base1", ["tiivad:latest"], size=1000)
+        outer = self
+
+        class Container:
+            short_id = "builder"
+
+            def __init__(self, image):
+                self.image = image
+                self.archive = None
+
+            def put_archive(self, path, data):
+                self.archive = data
+
+            def commit(self, repository, tag, conf):
+                image_id = "sha256:ex{}".format(next(outer._ids))
+                files = dict(outer.images_by_id[self.image].files)
+                files.update(files_in(self.archive))
+                outer.add(image_id, ["{}:{}".format(repository, tag)], conf["Labels"], size=1000 + 10, files=files)
+                outer.committed.append(image_id)
+
+            def remove(self, force=False):
+                pass
+
+        class Containers:
+            def create(self, image, **kwargs):
+                return Container(image)
+
+        class Images:
+            def get(self, name):
+                for image in outer.images_by_id.values():
+                    if image.id == name or name in image.tags or name + ":latest" in image.tags:
+                        return image
+                raise containers.docker.errors.ImageNotFound(name)
+
+            def list(self, filters=None):
+                label = (filters or {}).get("label")
+                return [i for i in outer.images_by_id.values() if label is None or label in i.labels]
+
+            def remove(self, image, force=False):
+                if image in outer.in_use:
+                    raise containers.docker.errors.APIError("image is in use")
+                outer.removed.append(image)
+                del outer.images_by_id[image]
+
+        self.containers = Containers()
+        self.images = Images()
+
+    def add(self, image_id, tags, labels=None, size=0, files=None):
+        self.images_by_id[image_id] = FakeImage(image_id, tags, labels, size, files)
+
+    def retag(self, name, image_id):
+        for image in self.images_by_id.values():
+            if name + ":latest" in image.tags:
+                image.tags.remove(name + ":latest")
+        self.add(image_id, [name + ":latest"], size=1000)
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_MB", 1)
+    fake = FakeDocker()
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+    return fake
+
+
+def image_for(docker, logger, script=SCRIPT, assets=ASSETS, base="tiivad"):
+    tag = containers.exercise_image(docker, base, script, assets, logger, "req-1")
+    # Trimming happens on the reaper thread; the tests below are about what it removes, not when.
+    assert containers.drain_reaper(5)
+    return tag
+
+
+# --- what the key is made of ------------------------------------------------------------------------
+
+def test_the_same_exercise_is_built_once(docker, logger):
+    first = image_for(docker, logger)
+    second = image_for(docker, logger)
+
+    assert first == second
+    assert len(docker.committed) == 1
+    stats = containers.exercise_cache_status()
+    assert (stats["hits"], stats["misses"], stats["built"]) == (1, 1, 1)
+
+
+def test_the_image_holds_the_script_and_the_assets_but_no_submission(docker, logger):
+    image_for(docker, logger)
+
+    files = docker.images_by_id[docker.committed[0]].files
+    assert files["evaluate.sh"] == SCRIPT
+    assert files["student-submission/generated_0.py"] == "print('test')"
+    assert "student-submission/lahendus.py" not in files
+
+
+@pytest.mark.parametrize("change", [
+    dict(script=SCRIPT + "# edited\n"),
+    dict(assets=[("generated_0.py", "print('other test')")]),
+    dict(assets=ASSETS + [("extra.txt", "")]),
+])
+def test_changing_the_script_or_any_asset_is_a_different_image(docker, logger, change):
+    # A teacher fixing a test must not be graded against the image of the test they just fixed.
+    original = image_for(docker, logger)
+    edited = image_for(docker, logger, **change)
+
+    assert original != edited
+    assert len(docker.committed) == 2
+
+
+def test_the_key_is_the_base_image_id_not_its_name(docker, logger):
+    before = image_for(docker, logger)
+
+    docker.retag("tiivad", "sha256:base2")
+    after = image_for(docker, logger)
+
+    assert before != after, "a retagged base image reused an image built on the old one"
+
+
+# --- what is kept -------------------------------------------------------------------------------------
+
+def test_images_built_on_a_superseded_base_are_removed(docker, logger):
+    stale = image_for(docker, logger)
+    stale_id = docker.images.get(stale).id
+
+    docker.retag("tiivad", "sha256:base2")
+    image_for(docker, logger)
+
+    assert stale_id in docker.removed
+    assert containers.exercise_cache_status()["invalidated"] == 1
+
+
+def test_the_least_recently_used_image_goes_first_when_over_budget(docker, logger, monkeypatch):
+    # Each fake image adds ten bytes over its base; a budget of 25 bytes holds two of them. Recency is
+    # a counter rather than file mtimes, which a fast test would see as all equal.
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_MB", 25 / (1024 * 1024))
+    clock = itertools.count(1)
+    used = {}
+    monkeypatch.setattr(containers, "_touch_exercise_entry", lambda key: used.__setitem__(key, next(clock)))
+    monkeypatch.setattr(containers, "_last_used", lambda key: used.get(key, 0))
+
+    a = image_for(docker, logger, script="a")
+    b = image_for(docker, logger, script="b")
+    image_for(docker, logger, script="a")  # a is now more recent than b
+    a_id, b_id = docker.images.get(a).id, docker.images.get(b).id
+    image_for(docker, logger, script="c")
+
+    assert b_id in docker.removed
+    assert a_id not in docker.removed
+    assert containers.exercise_cache_status()["evicted"] == 1
+
+
+def test_an_image_in_use_survives_until_the_next_pass(docker, logger, monkeypatch):
+    stale = image_for(docker, logger)
+    docker.in_use.add(docker.images.get(stale).id)
+
+    docker.retag("tiivad", "sha256:base2")
+    image_for(docker, logger)
+
+    assert docker.removed == []
+    docker.in_use.clear()
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_TRIM_SEC", 0)
+    image_for(docker, logger)
+    assert len(docker.removed) == 1
+
+
+def test_a_hit_does_not_list_the_cache_every_time(docker, logger, monkeypatch):
+    # A trim is an image listing; thousands of submissions to one exercise must not each pay for one.
+    image_for(docker, logger)
+    listed = []
+    monkeypatch.setattr(containers, "_evict_exercise_images", lambda *args: listed.append(args))
+
+    for _ in range(5):
+        image_for(docker, logger)
+
+    assert listed == []
+
+
+# --- grading on top of it ---------------------------------------------------------------------------
+
+@pytest.fixture
+def ran(docker, monkeypatch):
+    seen = {}
+
+    def fake_run(image_name, archive, max_run_time_sec, max_mem_MB, logger, request_id, cpus=None, cpuset=None,
+                 listener=None, limits=None):
+        seen["image"] = image_name
+        seen["files"] = files_in(archive)
+        return RunOutcome(RunStatus.SUCCESS), "output"
+
+    monkeypatch.setattr(containers, "_run_in_container", fake_run)
+    return seen
+
+
+def test_a_submission_is_run_on_the_exercise_image_with_only_its_own_files(ran, logger):
+    containers.grade_submission("print(1)", SCRIPT, ASSETS, "tiivad", 10, 64, logger, "req-1")
+
+    assert ran["image"].startswith(containers.EXERCISE_IMAGE_REPO + ":")
+    assert ran["files"] == {
+        "student-submission/submission.py": "print(1)",
+        "student-submission/lahendus.py": "print(1)",
+    }
+
+
+def test_an_asset_named_like_the_submission_still_wins(ran, logger):
+    # The asset is already in the image; putting the submission on top would reverse the order
+    # `submission_archive` guarantees.
+    containers.grade_submission("print(1)", SCRIPT, [("lahendus.py", "# fixed")], "tiivad", 10, 64, logger, "r")
+
+    assert "student-submission/lahendus.py" not in ran["files"]
+    assert ran["files"]["student-submission/submission.py"] == "print(1)"
+
+
+def test_a_cache_that_cannot_build_falls_back_to_the_base_image(ran, docker, logger, monkeypatch):
+    def refuse(*args, **kwargs):
+        raise containers.docker.errors.APIError("no space left on device")
+
+    monkeypatch.setattr(containers, "_build_exercise_image", refuse)
+
+    containers.grade_submission("print(1)", SCRIPT, ASSETS, "tiivad", 10, 64, logger, "req-1")
+
+    assert ran["image"] == "tiivad"
+    assert ran["files"]["evaluate.sh"] == SCRIPT
+
+
+def test_a_missing_base_image_is_still_an_error(ran, logger):
+    with pytest.raises(containers.docker.errors.ImageNotFound):
+        containers.grade_submission("print(1)", SCRIPT, ASSETS, "nonexistent", 10, 64, logger, "req-1")
+
+
+def test_the_cache_endpoint_answers_from_memory(client, monkeypatch):
+    def boom(**kwargs):
+        raise AssertionError("/v1/exercise-images reached the Docker daemon")
+
+    monkeypatch.setattr(containers.docker, "from_env", boom)
+
+    body = client.get("/v1/exercise-images").get_json()
+
+    assert {"hits", "misses", "built", "evicted", "invalidated", "budget_mb"} <= set(body)
@@ -0,0 +1,203 @@
+# coding=utf-8
+"""`POST /v1/grade/batch`: one exercise, many submissions — a regrade after a teacher fixed a test.
+
+Three promises. Each submission gets exactly what `/v1/grade` would have told it, tagged with the id
+it was sent with. The exercise is prepared once, not once per submission, which is the point of the
+endpoint. And a batch never has more than its share of the grading threads, so a regrade of a whole
+course does not stall the students submitting at the same time.
+
+The container is faked at `_run_in_container`, below the batch's own code, so what is exercised is
+the same path a real batch takes.
+"""
+import io
+import json
+import tarfile
+import threading
+import time
+
+import pytest
+
+import containers
+import jobs
+from containers import RunOutcome, RunStatus
+
+SEP = "#" * 50
+
+EXERCISE = {
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [{"file_name": "test.py", "file_content": "# test"}],
+    "image_name": "python:3.12",
+    "max_time_sec": 10,
+    "max_mem_mb": 64,
+}
+
+
+def batch_of(*submissions, **changes):
+    body = dict(EXERCISE, submissions=[{"id": i, "submission": s} for i, s in enumerate(submissions)])
+    body.update(changes)
+    return body
+
+
+def submission_in(archive):
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        return tar.extractfile("student-submission/submission.py").read().decode()
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """Replaces the container. A submission `grade: N` prints that grade; `raise` fails the run."""
+
+    class Runs:
+        images = []
+        running = 0
+        most_at_once = 0
+        lock = threading.Lock()
+        # A submission `hold` waits for this.
+        release = threading.Event()
+
+    r = Runs()
+
+    def fake(image_name, archive, max_run_time_sec, max_mem_MB, logger, request_id, cpus=None, cpuset=None,
+             listener=None, limits=None):
+        submission = submission_in(archive)
+        with r.lock:
+            r.images.append(image_name)
+            r.running += 1
+            r.most_at_once = max(r.most_at_once, r.running)
+        try:
+            time.sleep(0.02)
+            if submission == "hold":
+                assert r.release.wait(5), "a test left a submission held"
+                submission = "grade: 0"
+            if submission == "raise":
+                raise containers.docker.errors.APIError("daemon went away")
+            return RunOutcome(RunStatus.SUCCESS), f"feedback for {submission}\n{SEP}\n{submission}"
+        finally:
+            with r.lock:
+                r.running -= 1
+
+    monkeypatch.setattr(containers, "_run_in_container", fake)
+    yield r
+    r.release.set()
+
+
+@pytest.fixture
+def two_threads(monkeypatch):
+    """A process with two job threads, made afresh: the pool is sized when it is first used."""
+    monkeypatch.setattr(jobs, "JOB_WORKERS", 2)
+    monkeypatch.setattr(jobs, "_executor", None)
+
+
+def post(client, body, **headers):
+    return client.post("/v1/grade/batch", data=json.dumps(body), content_type="application/json", headers=headers)
+
+
+# --- results ------------------------------------------------------------------------------------
+
+def test_each_submission_gets_its_own_grade_in_the_order_sent(client, runs):
+    resp = post(client, batch_of("grade: 10", "grade: 20", "grade: 30"))
+
+    assert resp.status_code == 200
+    results = resp.get_json()["results"]
+    assert [(r["id"], r["grade"]) for r in results] == [(0, 10), (1, 20), (2, 30)]
+    assert results[1]["feedback"] == "feedback for grade: 20\n"
+
+
+def test_a_result_is_what_the_single_endpoint_would_have_answered(client, runs):
+    single = dict(EXERCISE, submission="grade: 55")
+    expected = client.post("/v1/grade", data=json.dumps(single), content_type="application/json").get_json()
+
+    result = post(client, batch_of("grade: 55")).get_json()["results"][0]
+
+    assert result == dict(expected, id=0)
+
+
+def test_one_failing_submission_does_not_fail_the_batch(client, runs):
+    results = post(client, batch_of("grade: 10", "raise", "grade: 30")).get_json()["results"]
+
+    assert results[0]["grade"] == 10 and results[2]["grade"] == 30
+    assert results[1]["id"] == 1
+    assert "daemon went away" in results[1]["error"]
+
+
+def test_results_can_be_streamed_as_they_finish(client, runs):
+    resp = post(client, batch_of("grade: 1", "grade: 2", "grade: 3"), Accept="application/x-ndjson")
+
+    assert resp.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert sorted((r["id"], r["grade"]) for r in lines) == [(0, 1), (1, 2), (2, 3)]
+
+
+# --- what is shared, and what is bounded --------------------------------------------------------
+
+def test_the_exercise_is_prepared_once_for_the_whole_batch(client, runs, monkeypatch):
+    monkeypatch.setattr(containers, "EXERCISE_CACHE_MB", 1)
+    prepared = []
+
+    def fake_exercise_image(docker_client, base_image_name, grading_script, assets, logger, request_id):
+        prepared.append(base_image_name)
+        return "easy-exercise:abc"
+
+    monkeypatch.setattr(containers, "exercise_image", fake_exercise_image)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: None)
+
+    post(client, batch_of(*["grade: {}".format(n) for n in range(5)]))
+
+    assert prepared == ["python:3.12"]
+    assert runs.images == ["easy-exercise:abc"] * 5
+
+
+def test_a_batch_never_has_more_than_its_share_of_the_threads(client, runs, two_threads):
+    results = post(client, batch_of(*["grade: {}".format(n) for n in range(8)])).get_json()["results"]
+
+    assert [r["grade"] for r in results] == list(range(8))
+    assert runs.most_at_once == 1
+
+
+def test_a_grade_sent_during_a_batch_that_fills_its_share_still_completes(runs, two_threads):
+    from server import app
+
+    batch = threading.Thread(target=lambda: post(app.test_client(), batch_of("hold", "hold", "hold")))
+    batch.start()
+    try:
+        for _ in range(100):
+            if runs.running:
+                break
+            time.sleep(0.02)
+
+        answer = app.test_client().post("/v1/grade", content_type="application/json", data=json.dumps(
+            dict(EXERCISE, assets=[], submission="grade: 7")))
+
+        assert answer.status_code == 200 and answer.get_json()["grade"] == 7
+        assert runs.running == 1  # the batch is still held, on its one thread
+    finally:
+        runs.release.set()
+        batch.join(10)
+
+
+# --- validation ---------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("body", [
+    dict(EXERCISE),
+    batch_of(submissions=[]),
+    batch_of(submissions="print(1)"),
+    batch_of(submissions=[{"submission": "print(1)"}]),
+    batch_of(submissions=[{"id": 1, "submission": "print(1)", "extra": 1}]),
+    batch_of("print(1)", surprise=1),
+    batch_of("print(1)", assets="nope"),
+    dict(batch_of("print(1)"), submission="print(1)"),
+], ids=["no-submissions", "empty", "not-a-list", "no-id", "extra-item-key", "extra-key", "bad-assets",
+        "single-submission-too"])
+def test_a_malformed_batch_is_refused_before_anything_runs(client, runs, body):
+    resp = post(client, body)
+
+    assert resp.status_code == 400
+    assert runs.images == []
+
+
+def test_a_batch_over_the_limit_is_refused(client, runs, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "BATCH_MAX_SUBMISSIONS", 2)
+
+    assert post(client, batch_of("a", "b", "c")).status_code == 400
@@ -5,9 +5,9 @@ Two halves, and the second is the one with consequences.
 
 **Validation.** A request core sends that this rejects is a submission that never grades, and a
 malformed one it accepts reaches `grade_submission` and fails somewhere less legible. `check_content`
-compares the key set *exactly*, so it rejects both missing and extra keys — which makes it a
-compatibility hinge between two services that deploy separately, and worth pinning in both
-directions.
+requires every original key and refuses any it does not know — only the optional ones added since
+(`max_cpus`) may be left out — which makes it a compatibility hinge between two services that deploy
+separately, and worth pinning in both directions.
 
 **The status → message mapping.** What a student is told when grading did not produce a grade. Every
 branch here returns **0 points** with an Estonian sentence, and getting the branches confused tells a
@@ -22,7 +22,7 @@ import json
 import pytest
 
 import server
-from containers import RunStatus
+from containers import CapturedOutput, RunOutcome, RunStatus
 
 SEP = "#" * 50
 
@@ -41,15 +41,16 @@ def grader(monkeypatch):
     """Replaces grading. Set `grader.result` to the (status, raw_output) the container 'produced'."""
 
     class Grader:
-        result = (RunStatus.SUCCESS, f"feedback\n{SEP}\ngrade: 100")
+        result = (RunOutcome(RunStatus.SUCCESS), f"feedback\n{SEP}\ngrade: 100")
         calls = []
 
     g = Grader()
 
-    def fake(submission, grading_script, assets, image_name, max_time, max_mem, logger, request_id):
+    def fake(submission, grading_script, assets, image_name, max_time, max_mem, logger, request_id, cpus=None,
+             cpuset=None, listener=None, limits=None):
         g.calls.append({
             "submission": submission, "grading_script": grading_script, "assets": assets,
-            "image_name": image_name, "max_time": max_time, "max_mem": max_mem,
+            "image_name": image_name, "max_time": max_time, "max_mem": max_mem, "cpus": cpus, "limits": limits,
         })
         return g.result
 
@@ -85,8 +86,43 @@ def test_the_request_reaches_the_grader_intact(client, grader):
 
 # --- what a student is told when there is no grade ------------------------------------------------
 
+def test_truncated_output_is_flagged_in_the_response(client, grader):
+    grader.result = (RunOutcome(RunStatus.SUCCESS, truncated=True), CapturedOutput(f"feedback\n{SEP}\ngrade: 90", dropped_bytes=5))
+
+    body = post(client, VALID).get_json()
+
+    assert body["grade"] == 90
+    assert body["output_truncated"] is True
+
+
+def test_whole_output_carries_no_truncation_flag(client, grader):
+    # Core deploys separately; the field appears only when it means something.
+    body = post(client, VALID).get_json()
+    assert "output_truncated" not in body
+    assert "usage" not in body
+
+
+def test_what_the_run_used_is_reported_beside_the_grade(client, grader):
+    usage = {"wall_sec": 1.25, "cpu_user_sec": 0.8, "memory_peak_bytes": 41943040, "oom_killed": False}
+    grader.result = (RunOutcome(RunStatus.SUCCESS, 0, usage=usage), f"feedback\n{SEP}\ngrade: 90")
+
+    body = post(client, VALID).get_json()
+
+    assert body["grade"] == 90
+    assert body["usage"] == usage
+
+
+def test_how_long_a_killed_run_took_to_go_is_reported_with_the_usage(client, grader):
+    grader.result = (RunOutcome(RunStatus.TIME_EXCEEDED, 137, None, True, 0.04, usage={"wall_sec": 10.04}), "")
+
+    body = post(client, VALID).get_json()
+
+    assert body["feedback"] == server.TIME_EXCEEDED_MESSAGE
+    assert body["usage"] == {"wall_sec": 10.04, "kill_to_exit_sec": 0.04}
+
+
 def test_a_timeout_is_reported_as_a_timeout(client, grader):
-    grader.result = (RunStatus.TIME_EXCEEDED, "")
+    grader.result = (RunOutcome(RunStatus.TIME_EXCEEDED, timed_out=True), "")
 
     body = post(client, VALID).get_json()
 
@@ -98,7 +134,7 @@ def test_a_timeout_is_reported_as_a_timeout(client, grader):
 def test_running_out_of_memory_is_reported_as_memory_and_not_as_time(client, grader):
     # The two are one `elif` apart and read almost identically in the source. Telling a student their
     # program was too slow when it used too much memory sends them to optimise the wrong thing.
-    grader.result = (RunStatus.MEM_EXCEEDED, "")
+    grader.result = (RunOutcome(RunStatus.MEM_EXCEEDED, oom_killed=True), "")
 
     body = post(client, VALID).get_json()
 
@@ -115,7 +151,7 @@ def test_unparseable_grader_output_gives_zero_and_shows_the_raw_output(client, g
     *exercise*, and the teacher fixing it needs to see what the container printed. Swallowing it
     would leave them with an apology and nothing to act on.
     """
-    grader.result = (RunStatus.SUCCESS, "Traceback (most recent call last):\n  ValueError")
+    grader.result = (RunOutcome(RunStatus.SUCCESS), "Traceback (most recent call last):\n  ValueError")
 
     body = post(client, VALID).get_json()
 
@@ -139,7 +175,7 @@ def test_every_field_is_required(client, grader, missing):
 
 def test_an_unexpected_field_is_rejected(client, grader):
     """
-    Exact key-set comparison, in the other direction.
+    The key-set check, in the other direction.
 
     This is strict enough to be a deployment hazard worth knowing about: core adding a field to the
     grading request breaks every executor that has not been updated, and the failure is 400 on every
@@ -151,6 +187,36 @@ def test_an_unexpected_field_is_rejected(client, grader):
     assert not grader.calls
 
 
+def test_a_cpu_limit_may_be_asked_for_and_reaches_the_grader(client, grader):
+    assert post(client, dict(VALID, max_cpus=0.5)).status_code == 200
+    post(client, VALID)
+
+    assert [call["cpus"] for call in grader.calls] == [0.5, server.containers.CPU_QUOTA]
+
+
+@pytest.mark.parametrize("cpus", [0, -1, "2", True, None, 10 ** 6])
+def test_a_cpu_limit_the_host_cannot_give_is_refused(client, grader, cpus):
+    assert post(client, dict(VALID, max_cpus=cpus)).status_code == 400
+    assert not grader.calls
+
+
+def test_pid_swap_and_tmp_limits_may_be_asked_for_and_the_host_fills_in_the_rest(client, grader):
+    assert post(client, dict(VALID, max_pids=32, max_tmp_mb=0)).status_code == 200
+    post(client, VALID)
+
+    asked, default = [call["limits"] for call in grader.calls]
+    assert asked == server.containers.run_limits(pids=32, tmp_mb=0)
+    assert asked.swap_mb == server.containers.SWAP_MB
+    assert default == server.containers.run_limits()
+
+
+@pytest.mark.parametrize("key", ["max_pids", "max_swap_mb", "max_tmp_mb"])
+@pytest.mark.parametrize("value", [-1, 1.5, "64", True, None])
+def test_a_limit_that_is_not_a_whole_number_is_refused(client, grader, key, value):
+    assert post(client, dict(VALID, **{key: value})).status_code == 400
+    assert not grader.calls
+
+
 def test_assets_must_be_a_list_of_name_and_content_pairs(client, grader):
     assert post(client, dict(VALID, assets={"a": "b"})).status_code == 400
     assert post(client, dict(VALID, assets=[{"file_name": "a"}])).status_code == 400
@@ -158,6 +224,12 @@ def test_assets_must_be_a_list_of_name_and_content_pairs(client, grader):
     assert not grader.calls
 
 
+@pytest.mark.parametrize("name", ["../../../../escaped.txt", "/etc/passwd", "sub/dir.txt", "..", "", None])
+def test_an_asset_name_that_is_not_a_plain_file_name_is_refused(client, grader, name):
+    assert post(client, dict(VALID, assets=[{"file_name": name, "file_content": "x"}])).status_code == 400
+    assert not grader.calls
+
+
 def test_a_body_that_is_not_json_is_refused(client, grader):
     resp = client.post("/v1/grade", data="submission=print(1)", content_type="text/plain")
 
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""`/v1/grade/stream`: the lifecycle as events, the output as it comes, and a closed stream killing its run.
+
+What core would build on is the order and the last event — `finished` carrying exactly what
+`/v1/grade` answers, or `error` saying why not — so that is pinned first. Then that output arrives
+before the container has exited, which is the point of the endpoint and what a `logs()` call at the
+end would silently break, and that it is bounded. Last, abandoning: closing the stream kills the
+container and nothing is remembered as a grade.
+
+Docker is faked at `docker.from_env`. A container's log stream is a generator the test controls, so
+"still running" is a real state here rather than a race.
+"""
+import json
+import time
+
+import pytest
+
+import containers
+import metrics
+import streaming
+from conftest import FakeContainer, FakeDocker
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [],
+    "image_name": "python:3.12",
+    "max_time_sec": 10,
+    "max_mem_mb": 64,
+}
+SEP = "#" * 50
+
+
+@pytest.fixture
+def container(monkeypatch):
+    """Prints as it goes, and runs until it is killed or the test `finish`es it."""
+    made = FakeContainer(output=[b"Test 1: OK\n", b"Test 2: OK\n", "{}\ngrade: 100\n".format(SEP).encode()],
+                         runs_for=None, streams=True)
+    fake = FakeDocker(made)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+    return made
+
+
+def post(client, query="", **kwargs):
+    return client.post("/v1/grade/stream" + query, data=json.dumps(VALID), content_type="application/json",
+                       buffered=False, **kwargs)
+
+
+def events(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+# --- the lifecycle ------------------------------------------------------------------------------
+
+def test_the_lifecycle_ends_with_what_v1_grade_answers(client, container):
+    container.finish()
+
+    found = events(post(client).get_data(as_text=True).splitlines())
+
+    assert [e["event"] for e in found] == ["queued", "started", "finished"]
+    assert found[1]["container"] == "c0ffee"
+    result = found[-1]["result"]
+    assert "wall_sec" in result.pop("usage")
+    assert result == {"grade": 100, "feedback": "Test 1: OK\nTest 2: OK\n"}
+
+
+def test_output_arrives_while_the_container_is_still_running(client, container):
+    resp = post(client, "?output=1")
+    lines = resp.response
+
+    seen = []
+    while len([e for e in seen if e["event"] == "output"]) < 3:
+        seen.extend(events([next(lines)]))
+
+    assert not container.exited.is_set()  # nothing has exited yet
+    text = "".join(e["text"] for e in seen if e["event"] == "output")
+    assert text.startswith("Test 1: OK\nTest 2: OK\n")
+
+    container.finish()
+    rest = events(list(lines))
+    assert rest[-1]["event"] == "finished"
+
+
+def test_output_is_only_sent_when_asked_for(client, container):
+    container.finish()
+
+    found = events(post(client).get_data(as_text=True).splitlines())
+
+    assert "output" not in [e["event"] for e in found]
+
+
+def test_streamed_output_is_bounded_but_the_grade_is_not_affected(client, container, monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_OUTPUT_BYTES", 15)
+    container.finish()
+
+    found = events(post(client, "?output=1").get_data(as_text=True).splitlines())
+
+    output = [e for e in found if e["event"] == "output"]
+    assert "".join(e["text"] for e in output) == "Test 1: OK\nTest"
+    assert output[-1]["truncated"] is True
+    assert found[-1]["result"]["grade"] == 100
+
+
+def test_server_sent_events_for_a_client_that_prefers_them(client, container):
+    container.finish()
+
+    resp = post(client, headers={"Accept": "text/event-stream"})
+    text = resp.get_data(as_text=True)
+
+    assert resp.mimetype == "text/event-stream"
+    assert text.startswith("event: queued\ndata: {}\n\n")
+    assert "event: finished\ndata: {\"result\": {\"grade\": 100" in text
+
+
+def test_a_quiet_run_still_says_it_is_running(client, container, monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_HEARTBEAT_SEC", 0.05)
+    lines = post(client).response
+
+    seen = [json.loads(next(lines)) for _ in range(4)]
+
+    assert {"event": "running"}.items() <= seen[-1].items()
+    assert "elapsed_sec" in seen[-1]
+    container.finish()
+    list(lines)
+
+
+def test_a_failed_run_ends_with_an_error_event(client, monkeypatch):
+    def refused(**kwargs):
+        raise containers.docker.errors.APIError("daemon went away")
+
+    monkeypatch.setattr(containers.docker, "from_env", refused)
+
+    found = events(post(client).get_data(as_text=True).splitlines())
+
+    assert found[-1]["event"] == "error"
+    assert "daemon went away" in found[-1]["message"]
+
+
+def test_a_bad_request_is_still_a_400_before_any_event(client):
+    resp = client.post("/v1/grade/stream", data=json.dumps({"submission": "x"}), content_type="application/json")
+
+    assert resp.status_code == 400
+
+
+# --- abandoning ---------------------------------------------------------------------------------
+
+def test_closing_the_stream_kills_the_container_and_nothing_is_remembered(client, container, monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_HEARTBEAT_SEC", 0.05)
+    lines = post(client).response
+    while json.loads(next(lines))["event"] != "started":
+        pass
+
+    lines.close()
+
+    assert container.killed.wait(5)
+    abandoned = 'easy_grading_runs_total{status="ABANDONED",image="other"} 1'
+    for _ in range(100):  # the grading thread counts it once it has seen the kill
+        if abandoned in metrics.exposition():
+            break
+        time.sleep(0.05)
+    assert abandoned in metrics.exposition()
+    assert 'status="SUCCESS"' not in metrics.exposition()
+
+
+def test_a_stream_abandoned_before_its_run_started_never_starts_it():
+    stream = streaming.GradeStream()
+    lines = stream.lines()
+    next(lines)
+    lines.close()
+
+    killed = []
+    stream.on_abandon(lambda: killed.append(True))
+
+    assert stream.abandoned and killed == [True]
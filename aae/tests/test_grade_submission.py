@@ -1,49 +1,57 @@
 # coding=utf-8
-"""What `grade_submission` lays out on disk before it hands anything to Docker.
+"""What `grade_submission` puts into a grading container, and how it gets it there.
 
-The container is built from a directory this function writes, so every property here is part of the
-contract with the grading script — and all of them fail *inside* a container, where the only
-symptom a teacher sees is a submission that will not grade.
+The container is created from the base image and handed a tar of files before it starts, so every
+property here is part of the contract with the grading script — and all of them fail *inside* a
+container, where the only symptom a teacher sees is a submission that will not grade.
 
-Docker is faked. Building a real image per test would make this the slowest thing in the repo and
-would test Docker; what is worth testing is the directory, which is entirely ours.
+Docker is faked. Running a real container per test would make this the slowest thing in the repo and
+would test Docker; what is worth testing is the archive, which is entirely ours, and the order of the
+calls that deliver it.
 """
-import os
-import stat
+import io
+import tarfile
+import time
 
 import pytest
 
 import containers
-from containers import RunStatus, grade_submission
+from conftest import FakeContainer, FakeDocker
+from containers import RunOutcome, RunStatus, grade_submission
 
 SUBMISSION = "print('tere')\n"
 SCRIPT = "#!/bin/sh\npython3 /student-submission/lahendus.py\n"
 
 
+def unpack(archive):
+    """{path: (content, mode, uid)} for every file, and the directories under their own key."""
+    files, dirs = {}, {}
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        for member in tar.getmembers():
+            if member.isdir():
+                dirs[member.name] = member.mode
+                continue
+            content = tar.extractfile(member).read().decode("utf-8")
+            files[member.name] = (content, member.mode, member.uid)
+    return files, dirs
+
+
 @pytest.fixture
 def captured(monkeypatch):
-    """Replaces the container run and hands back a snapshot of the directory it was given.
-
-    A snapshot rather than the directory itself, because `grade_submission` uses
-    `tempfile.TemporaryDirectory()` — by the time it returns, the directory is gone. That is the
-    point of `test_the_temp_directory_is_removed`, and it means anything a test wants to assert has
-    to be read while the fake is executing.
-    """
+    """Replaces the container run and hands back what it was given, archive unpacked."""
     seen = {}
 
-    def fake_run(source_dir, max_run_time_sec, max_mem_MB, logger, request_id):
-        seen["dir"] = source_dir
+    def fake_run(image_name, archive, max_run_time_sec, max_mem_MB, logger, request_id, cpus=None, cpuset=None,
+                 listener=None, limits=None):
+        seen["image"] = image_name
         seen["args"] = (max_run_time_sec, max_mem_MB, request_id)
-        seen["files"] = {}
-        seen["modes"] = {}
-        for root, _, names in os.walk(source_dir):
-            for n in names:
-                path = os.path.join(root, n)
-                rel = os.path.relpath(path, source_dir)
-                with open(path, encoding="utf-8") as f:
-                    seen["files"][rel] = f.read()
-                seen["modes"][rel] = stat.S_IMODE(os.stat(path).st_mode)
-        return RunStatus.SUCCESS, "output"
+        seen["archive"] = archive
+        files, dirs = unpack(archive)
+        seen["files"] = {name: f[0] for name, f in files.items()}
+        seen["modes"] = {name: f[1] for name, f in files.items()}
+        seen["owners"] = {name: f[2] for name, f in files.items()}
+        seen["dirs"] = dirs
+        return RunOutcome(RunStatus.SUCCESS), "output"
 
     monkeypatch.setattr(containers, "_run_in_container", fake_run)
     return seen
@@ -70,27 +78,30 @@ def test_the_submission_is_written_under_both_names(captured, logger):
 
 
 def test_the_grading_script_is_readable_and_executable_and_not_writable(captured, logger):
-    # The Dockerfile ends `CMD /evaluate.sh`, so a script without the execute bit is a container
-    # that exits immediately with a permission error — and `_was_memory_killed` would then be
-    # inspecting a message about permissions.
+    # The container runs `/bin/sh -c /evaluate.sh`, so a script without the execute bit is a
+    # container that exits immediately with a permission error — and `_was_memory_killed` would then
+    # be inspecting a message about permissions.
     run(logger)
 
     mode = captured["modes"]["evaluate.sh"]
 
-    assert mode & stat.S_IXUSR, "evaluate.sh is not executable"
-    assert mode & stat.S_IRUSR, "evaluate.sh is not readable"
+    assert captured["files"]["evaluate.sh"] == SCRIPT
     assert mode == 0o500, f"expected 0o500, got {oct(mode)}"
 
 
-def test_the_dockerfile_names_the_requested_base_image(captured, logger):
-    run(logger)
+def test_everything_is_owned_by_root_as_copy_left_it(captured, logger):
+    # A tar records an owner, and extraction honours it. The executor's own uid leaking into the
+    # container would make the files belong to whoever that happens to be in the image.
+    run(logger, assets=[("input.txt", "1 2 3")])
+
+    assert set(captured["owners"].values()) == {0}
+    assert captured["dirs"] == {"student-submission": 0o755}
+    assert captured["modes"]["student-submission/input.txt"] == 0o644
 
-    dockerfile = captured["files"]["Dockerfile"]
 
-    assert "FROM python:3.12" in dockerfile
-    # Both COPY lines matter: one brings the submission in, the other the script the CMD runs.
-    assert "COPY student-submission /student-submission" in dockerfile
-    assert "COPY evaluate.sh /" in dockerfile
+def test_the_container_is_created_from_the_requested_base_image(captured, logger):
+    run(logger)
+    assert captured["image"] == "python:3.12"
 
 
 def test_assets_are_written_beside_the_submission(captured, logger):
@@ -106,7 +117,7 @@ def test_an_asset_may_overwrite_the_submission_filename(captured, logger):
 
     An exercise whose asset is called `lahendus.py` replaces the student's submission — which is
     deliberate for a test that supplies a fixed program — and the ordering that makes it possible
-    (assets written last) is load-bearing rather than accidental.
+    (assets applied last) is load-bearing rather than accidental.
     """
     run(logger, assets=[("lahendus.py", "# supplied by the exercise")])
 
@@ -115,10 +126,19 @@ def test_an_asset_may_overwrite_the_submission_filename(captured, logger):
     assert captured["files"]["student-submission/submission.py"] == SUBMISSION
 
 
-def test_non_ascii_survives_the_round_trip_to_disk(captured, logger):
-    # Every open() here passes encoding='utf-8' explicitly. Without it the encoding is the host's
-    # locale, so an executor on a machine with a non-UTF-8 default would mangle exactly the
-    # submissions that contain Estonian — and nothing in this repo would notice.
+def test_an_overwritten_name_appears_in_the_archive_once(captured, logger):
+    # Two entries for one path would leave the answer to the extractor's ordering. One entry leaves
+    # nothing to decide.
+    run(logger, assets=[("lahendus.py", "# supplied by the exercise")])
+
+    with tarfile.open(fileobj=io.BytesIO(captured["archive"])) as tar:
+        names = tar.getnames()
+    assert names.count("student-submission/lahendus.py") == 1
+
+
+def test_non_ascii_survives_the_round_trip_into_the_archive(captured, logger):
+    # Every file is encoded as UTF-8 explicitly. Leaving it to the host's locale would mangle exactly
+    # the submissions that contain Estonian — and nothing in this repo would notice.
     run(logger, submission="print('õäöü ŠŽ 🎉')\n")
 
     assert captured["files"]["student-submission/lahendus.py"] == "print('õäöü ŠŽ 🎉')\n"
@@ -129,31 +149,264 @@ def test_the_limits_and_request_id_reach_the_container_runner(captured, logger):
     assert captured["args"] == (10, 64, "req-1")
 
 
-# --- cleanup ------------------------------------------------------------------------------------
+def test_nothing_is_written_to_the_executors_disk(captured, logger, monkeypatch):
+    # The archive is built in memory; a temp dir per submission is what this replaced.
+    def no_temp_dirs(*args, **kwargs):
+        raise AssertionError("grade_submission wrote a temp directory")
 
-def test_the_temp_directory_is_removed_on_success(captured, logger):
+    monkeypatch.setattr(containers.tempfile, "TemporaryDirectory", no_temp_dirs)
+    monkeypatch.setattr(containers.tempfile, "mkdtemp", no_temp_dirs)
     run(logger)
-    assert not os.path.exists(captured["dir"])
 
 
-def test_the_temp_directory_is_removed_when_the_container_run_raises(monkeypatch, logger):
+# --- the calls that deliver it ----------------------------------------------------------------------
+
+@pytest.fixture
+def docker_calls(monkeypatch):
+    calls = []
+    container = FakeContainer(calls=calls)
+    fake = FakeDocker(container)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+    return calls, container, fake
+
+
+def test_files_are_delivered_before_the_container_starts(docker_calls, logger):
+    calls, _, fake = docker_calls
+
+    outcome, output = grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")
+
+    assert outcome.status == RunStatus.SUCCESS
+    assert output == "grade: 100\n"
+    assert containers.drain_reaper(5)
+    assert [c[0] for c in calls] == ["create", "put_archive", "start", "wait", "reload", "remove"]
+    assert calls[1] == ("put_archive", "/")
+
+
+def test_the_container_runs_the_script_under_the_memory_limit(docker_calls, logger):
+    _, _, fake = docker_calls
+
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")
+
+    image, kwargs = fake.created[-1].image, fake.created[-1].kwargs
+    assert image == "python:3.12"
+    assert kwargs["command"] == ["/bin/sh", "-c", "/evaluate.sh"]
+    assert kwargs["mem_limit"] == "64m"
+
+
+def test_the_container_cannot_swap_fork_without_end_or_fill_the_disk_from_tmp(docker_calls, logger, monkeypatch):
+    # Swap beyond the memory limit is Docker's default, and it turned an OOM kill into minutes of
+    # thrashing the disk every other container reads its image from.
+    monkeypatch.setattr(containers, "PIDS_LIMIT", 128)
+    monkeypatch.setattr(containers, "TMPFS_MB", 16)
+
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")
+
+    kwargs = docker_calls[2].created[-1].kwargs
+    assert kwargs["memswap_limit"] == "64m"
+    assert kwargs["pids_limit"] == 128
+    assert kwargs["tmpfs"] == {"/tmp": "rw,nosuid,nodev,mode=1777,size=16m"}
+
+
+def test_a_request_may_set_its_own_limits_and_switch_them_off(docker_calls, logger):
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1",
+                     limits=containers.run_limits(pids=0, swap_mb=32, tmp_mb=0))
+
+    kwargs = docker_calls[2].created[-1].kwargs
+    assert kwargs["memswap_limit"] == "96m"
+    assert "pids_limit" not in kwargs and "tmpfs" not in kwargs
+
+
+def test_the_container_gets_the_cpu_quota_it_was_asked_for(docker_calls, logger):
+    _, _, fake = docker_calls
+
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1", cpus=1.5)
+
+    assert fake.created[-1].kwargs["nano_cpus"] == 1_500_000_000
+
+
+def test_a_cpuset_is_applied_before_the_container_starts(docker_calls, logger):
+    # Pooled containers were created before anyone knew which cores the run would get, so the pinning
+    # has to be an update — and one that lands after `start` would let the first instructions run anywhere.
+    calls, _, _ = docker_calls
+
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1", cpuset="2,3")
+
+    names = [c[0] for c in calls]
+    assert names.index("update") < names.index("start")
+    assert calls[names.index("update")][1] == {"cpuset_cpus": "2,3"}
+
+
+def test_without_a_cpuset_the_container_is_not_updated(docker_calls, logger):
+    calls, _, _ = docker_calls
+
+    grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")
+
+    assert "update" not in [c[0] for c in calls]
+
+
+def test_a_container_that_refuses_its_files_is_still_removed(monkeypatch, logger):
     """
     The leg that matters, because it is the one that runs on a bad day.
 
-    Every submission gets a directory holding its source; an executor that leaks one per failed
-    grading fills the disk of the host that grades everything, and the first symptom is unrelated
-    exercises failing. `tempfile.TemporaryDirectory` as a context manager is what prevents it — this
-    asserts the `with` is actually wrapping the failure path.
+    A created container holds a writable layer on the host that grades everything; leaking one per
+    failed grading is the slow way to fill its disk.
     """
-    leaked = {}
+    calls = []
+    fake = FakeDocker(FakeContainer(calls=calls, fail_on="put_archive"))
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+
+    with pytest.raises(containers.docker.errors.APIError):
+        grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")
+
+    assert containers.drain_reaper(5)
+    assert calls[-1] == ("remove", True), "a failed grading left its container behind"
+
+
+def test_every_run_in_the_process_shares_one_docker_client(monkeypatch, logger):
+    made = []
+
+    def from_env(**kwargs):
+        made.append(kwargs)
+        return FakeDocker(FakeContainer())
+
+    monkeypatch.setattr(containers.docker, "from_env", from_env)
+    monkeypatch.setattr(containers, "DOCKER_POOL_SIZE", 7)
+
+    for request_id in ("req-1", "req-2"):
+        grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, request_id)
+
+    assert made == [{"max_pool_size": 7}]
+    assert containers.shared_docker_client() is containers.shared_docker_client()
+
+
+# --- how a run ends -----------------------------------------------------------------------------------
+
+def run_for(monkeypatch, logger, runs_for, max_time):
+    calls = []
+    container = FakeContainer(calls=calls, runs_for=runs_for)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: FakeDocker(container))
+    started = time.monotonic()
+    outcome, _ = grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", max_time, 64, logger, "req-1")
+    return outcome.status, time.monotonic() - started, [c[0] for c in calls]
+
+
+def test_a_quick_submission_returns_when_it_exits_not_at_the_next_poll(monkeypatch, logger):
+    # The old loop slept half a second between status checks, so this took at least 0.5 s.
+    status, elapsed, calls = run_for(monkeypatch, logger, runs_for=0.05, max_time=10)
+
+    assert status == RunStatus.SUCCESS
+    assert elapsed < 0.4
+    assert "kill" not in calls
+
+
+def test_a_submission_over_its_time_is_killed_at_the_limit(monkeypatch, logger):
+    status, elapsed, calls = run_for(monkeypatch, logger, runs_for=5, max_time=0.2)
+
+    assert status == RunStatus.TIME_EXCEEDED
+    assert "kill" in calls
+    assert 0.2 <= elapsed < 1.0
+
+
+def test_a_container_that_exits_as_the_timer_fires_finished_in_time(monkeypatch, logger):
+    """
+    The kill fails because there is nothing left to kill. That run finished inside its limit, and
+    reporting it as a timeout would tell a student their program was too slow when it was not.
+    """
+    calls = []
+    container = FakeContainer(calls=calls)
+    container.start = lambda: (calls.append(("start",)), container.exited.set())
+    container.wait = lambda timeout=None: (time.sleep(0.1), {"StatusCode": 0})[1]
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: FakeDocker(container))
+
+    outcome, _ = grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 0.01, 64, logger, "req-1")
+
+    assert outcome.status == RunStatus.SUCCESS
+
+
+def test_a_wait_that_never_returns_is_a_timeout(monkeypatch, logger):
+    # A daemon that lost the container: neither the exit nor the kill is ever reported back.
+    calls = []
+    container = FakeContainer(calls=calls, runs_for=60)
+    container.kill = lambda: calls.append(("kill",))
+    monkeypatch.setattr(containers, "WAIT_GRACE_SEC", 0.05)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: FakeDocker(container))
+
+    outcome, _ = grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 0.05, 64, logger, "req-1")
+
+    assert outcome.status == RunStatus.TIME_EXCEEDED
+    assert containers.drain_reaper(5)
+    assert ("remove", True) in calls
+
+
+# --- how much of the output is kept ------------------------------------------------------------------
+
+def output_of(monkeypatch, logger, chunks, limit=None):
+    if limit is not None:
+        monkeypatch.setattr(containers, "OUTPUT_LIMIT_BYTES", limit)
+    container = FakeContainer(output=chunks)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: FakeDocker(container))
+    return grade_submission(SUBMISSION, SCRIPT, [], "python:3.12", 10, 64, logger, "req-1")[1]
+
+
+def test_output_under_the_limit_is_kept_whole(monkeypatch, logger):
+    output = output_of(monkeypatch, logger, [b"line 1\n", b"line 2\n"])
+
+    assert output == "line 1\nline 2\n"
+    assert not output.truncated
+
+
+def test_an_endless_print_keeps_the_beginning_and_the_end(monkeypatch, logger):
+    """
+    The grade is at the end and the first error is near the beginning, so those are what survive.
+    What is dropped is said in the text, because the teacher reading it needs to know it is not all.
+    """
+    chunks = [b"first line\n"] + [b"x" * 1000 + b"\n"] * 1000 + [b"grade: 100\n"]
+
+    output = output_of(monkeypatch, logger, chunks, limit=8000)
+
+    assert output.truncated
+    assert output.startswith("first line\n")
+    assert output.endswith("grade: 100\n")
+    assert "väljundist jäeti vahelt välja" in output
+    assert output.dropped_bytes == sum(map(len, chunks)) - 8000
+    assert len(output.encode("utf-8")) < 8000 + 100
+
+
+def test_the_tail_is_exactly_the_last_part_of_the_output(monkeypatch, logger):
+    chunks = [bytes([65 + i % 26]) * 10 for i in range(100)]
+
+    output = output_of(monkeypatch, logger, chunks, limit=400)
+
+    assert output.tail == b"".join(chunks)[-300:].decode()
+
+
+def test_invalid_utf8_degrades_instead_of_losing_the_grade(monkeypatch, logger):
+    # It used to be `.decode('utf-8')`, which raises — and the exception took the grade with it.
+    output = output_of(monkeypatch, logger, [b"bad \xff byte\ngrade: 100\n"])
+
+    assert output == "bad \ufffd byte\ngrade: 100\n"
+
+
+def test_a_character_split_between_chunks_is_reassembled(monkeypatch, logger):
+    encoded = "õun\n".encode("utf-8")
+
+    output = output_of(monkeypatch, logger, [encoded[:1], encoded[1:]])
+
+    assert output == "õun\n"
+
+
+def test_a_cut_inside_a_character_does_not_leave_a_replacement_at_the_seam(monkeypatch, logger):
+    chunks = ["ä".encode("utf-8") * 500]
+
+    output = output_of(monkeypatch, logger, chunks, limit=401)
 
-    def explode(source_dir, *args, **kwargs):
-        leaked["dir"] = source_dir
-        raise RuntimeError("docker is on fire")
+    assert "\ufffd" not in output.tail
+    assert set(output.tail) == {"ä"}
 
-    monkeypatch.setattr(containers, "_run_in_container", explode)
 
-    with pytest.raises(RuntimeError):
-        run(logger)
+def test_a_head_that_ends_inside_a_character_keeps_what_it_has_of_it(monkeypatch, logger):
+    # 101 bytes of head: fifty characters and the first byte of the next, which is not silently lost.
+    output = output_of(monkeypatch, logger, ["ä".encode("utf-8") * 500], limit=404)
 
-    assert not os.path.exists(leaked["dir"]), "a failed grading left its temp directory behind"
+    assert output.truncated
+    assert output.startswith("ä" * 50 + "\ufffd")
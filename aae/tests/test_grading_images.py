@@ -150,7 +150,7 @@ def test_something_installed_but_not_declared_is_still_reported():
 
 def test_a_labelled_image_needs_no_container(monkeypatch):
     fake = FakeDocker([labelled("silmused", "silmused==1.7.11", "silmused==1.7.11 psycopg2==2.9.9")])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     images = containers._refresh_grading_images(FakeLogger())
 
@@ -165,7 +165,7 @@ def test_an_image_with_no_installed_label_is_asked_with_pip(monkeypatch):
         "sha256:" + "d" * 20, ["silmused:latest"], {containers.LABEL_DECLARED: "silmused==1.7.11"}
     )
     fake = FakeDocker([image], pip_payload=[{"name": "silmused", "version": "1.7.4"}])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     images = containers._refresh_grading_images(FakeLogger())
 
@@ -186,7 +186,7 @@ def test_the_pip_container_is_created_by_image_id_never_by_name(monkeypatch):
     """
     image = FakeImage("sha256:" + "e" * 20, ["silmused:latest"], {containers.LABEL_DECLARED: "silmused==1.0"})
     fake = FakeDocker([image], pip_payload=[{"name": "silmused", "version": "1.0"}])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     containers._refresh_grading_images(FakeLogger())
 
@@ -197,7 +197,7 @@ def test_the_pip_container_is_created_by_image_id_never_by_name(monkeypatch):
 def test_the_pip_container_gets_no_network_and_a_memory_cap(monkeypatch):
     image = FakeImage("sha256:" + "f" * 20, ["tiivad:latest"], {containers.LABEL_DECLARED: "tiivad==1.0"})
     fake = FakeDocker([image], pip_payload=[{"name": "tiivad", "version": "1.0"}])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     containers._refresh_grading_images(FakeLogger())
 
@@ -209,7 +209,7 @@ def test_the_pip_container_gets_no_network_and_a_memory_cap(monkeypatch):
 def test_the_container_is_removed_even_when_the_run_fails(monkeypatch):
     image = FakeImage("sha256:" + "0" * 20, ["tiivad:latest"], {containers.LABEL_DECLARED: "tiivad==1.0"})
     fake = FakeDocker([image], pip_payload=[], fail=True)
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     images = containers._refresh_grading_images(FakeLogger())
 
@@ -220,7 +220,7 @@ def test_the_container_is_removed_even_when_the_run_fails(monkeypatch):
 
 def test_an_image_with_no_grading_labels_is_ignored(monkeypatch):
     fake = FakeDocker([FakeImage("sha256:x", ["postgres:16"], {"maintainer": "someone"})])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
     assert containers._refresh_grading_images(FakeLogger()) == []
 
 
@@ -242,7 +242,7 @@ def test_a_retained_rollback_copy_is_not_reported(monkeypatch):
         {containers.LABEL_DECLARED: "silmused==1.7.4", containers.LABEL_INSTALLED: "silmused==1.7.4"},
     )
     fake = FakeDocker([live, kept])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     images = containers._refresh_grading_images(FakeLogger())
     assert len(images) == 1
@@ -257,7 +257,7 @@ def test_the_name_is_the_bare_one_not_the_registry_reference(monkeypatch):
         ["ghcr.io/kspar/easy/tiivad:idigest", "tiivad:latest"],
         {containers.LABEL_DECLARED: "tiivad==0.0.33", containers.LABEL_INSTALLED: "tiivad==0.0.33"},
     )
-    monkeypatch.setattr(containers.docker, "from_env", lambda: FakeDocker([image]))
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: FakeDocker([image]))
     assert containers._refresh_grading_images(FakeLogger())[0]["name"] == "tiivad"
 
 
@@ -269,7 +269,7 @@ def test_an_unlabelled_image_with_a_grading_name_is_still_reported(monkeypatch):
     """
     image = FakeImage("sha256:" + "4" * 20, ["silmused:latest"], {})
     fake = FakeDocker([image], pip_payload=[{"name": "silmused", "version": "1.6.3"}])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     images = containers._refresh_grading_images(FakeLogger())
     assert images[0]["source"] == "pip"
@@ -277,9 +277,9 @@ def test_an_unlabelled_image_with_a_grading_name_is_still_reported(monkeypatch):
 
 
 def test_an_untagged_image_is_not_reported(monkeypatch):
-    # Nothing can grade with it: containers.py builds `FROM <bare name>`.
+    # Nothing can grade with it: containers.py creates its containers from the bare name.
     fake = FakeDocker([FakeImage("sha256:abcdef0123456789", [], {containers.LABEL_DECLARED: "x==1"})])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
     assert containers._refresh_grading_images(FakeLogger()) == []
 
 
@@ -321,7 +321,7 @@ def test_all_four_images_are_reported_when_all_four_are_present(monkeypatch):
         labelled("pygrader", "numpy~=1.23.4", "numpy==1.23.5"),
         labelled("imgrec", "pillow==12.3.0", "pillow==12.3.0"),
     ])
-    monkeypatch.setattr(containers.docker, "from_env", lambda: fake)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
 
     names = [i["name"] for i in containers._refresh_grading_images(FakeLogger())]
     assert names == ["imgrec", "pygrader", "silmused", "tiivad"]
@@ -358,7 +358,7 @@ def test_a_warm_cache_does_no_work(monkeypatch):
 
 
 def test_a_docker_daemon_that_is_down_yields_nothing_rather_than_raising(monkeypatch):
-    def boom():
+    def boom(**kwargs):
         raise RuntimeError("cannot connect to the docker daemon")
 
     monkeypatch.setattr(containers.docker, "from_env", boom)
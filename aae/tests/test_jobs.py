@@ -0,0 +1,208 @@
+# coding=utf-8
+"""`/v1/jobs`: submit, then poll or long-poll — and `/v1/grade` as a job that is waited for.
+
+The two things that matter most are that a job's answer is *the same answer* `/v1/grade` gives — a
+student must not be told something different because core switched endpoints — and that a job is
+never silently lost: a job whose process went away says it failed, rather than "running" for ever.
+
+Grading is replaced per test, as in `test_grade_endpoint.py`. Jobs run on real threads, so the tests
+that need a job to still be running hold it on an event.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import jobs
+import server
+from containers import RunOutcome, RunStatus
+
+SEP = "#" * 50
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [],
+    "image_name": "python:3.12",
+    "max_time_sec": 10,
+    "max_mem_mb": 64,
+}
+
+
+@pytest.fixture
+def grader(monkeypatch):
+    """Replaces grading. Set `result`, or clear `release` to hold every run until it is set again."""
+
+    class Grader:
+        result = (RunOutcome(RunStatus.SUCCESS), f"feedback\n{SEP}\ngrade: 100")
+        release = threading.Event()
+        threads = []
+
+    g = Grader()
+    g.release.set()
+
+    def fake(submission, grading_script, assets, image_name, max_time, max_mem, logger, request_id, cpus=None,
+             cpuset=None, listener=None, limits=None):
+        g.threads.append(threading.current_thread().name)
+        assert g.release.wait(5), "a test left a job held"
+        if isinstance(g.result, Exception):
+            raise g.result
+        return g.result
+
+    monkeypatch.setattr(server, "grade_submission", fake)
+    yield g
+    g.release.set()
+
+
+def submit(client, body=VALID):
+    return client.post("/v1/jobs", data=json.dumps(body), content_type="application/json")
+
+
+def poll(client, job_id, wait=None):
+    url = "/v1/jobs/" + job_id + ("" if wait is None else "?wait={}".format(wait))
+    return client.get(url)
+
+
+# --- the happy path -----------------------------------------------------------------------------
+
+def test_a_submission_is_accepted_at_once_and_named_by_location(client, grader):
+    resp = submit(client)
+
+    assert resp.status_code == 202
+    body = resp.get_json()
+    assert body["status"] == "queued"
+    assert resp.headers["Location"] == "/v1/jobs/" + body["id"]
+
+
+def test_a_long_poll_returns_the_same_answer_as_the_synchronous_endpoint(client, grader):
+    job_id = submit(client).get_json()["id"]
+
+    job = poll(client, job_id, wait=5).get_json()
+    sync = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json").get_json()
+
+    assert job["status"] == "done"
+    assert job["result"] == sync == {"grade": 100, "feedback": "feedback\n"}
+    assert job["submitted_at"] <= job["started_at"] <= job["finished_at"]
+
+
+def test_a_poll_without_wait_answers_immediately_with_the_status(client, grader):
+    grader.release.clear()
+    job_id = submit(client).get_json()["id"]
+
+    started = time.monotonic()
+    body = poll(client, job_id).get_json()
+
+    assert time.monotonic() - started < 1
+    assert body["status"] in ("queued", "running")
+    assert "result" not in body
+
+
+def test_a_long_poll_is_capped_and_then_reports_the_job_as_still_running(client, grader, monkeypatch):
+    # Capped so that a poll is never what gets a gunicorn worker killed for its timeout.
+    monkeypatch.setattr(jobs, "JOB_MAX_WAIT_SEC", 0.1)
+    grader.release.clear()
+    job_id = submit(client).get_json()["id"]
+
+    started = time.monotonic()
+    body = poll(client, job_id, wait=600).get_json()
+
+    assert time.monotonic() - started < 2
+    assert body["status"] in ("queued", "running")
+
+
+def test_the_synchronous_endpoint_grades_on_the_job_threads(client, grader):
+    client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json")
+
+    assert grader.threads[-1].startswith("easy-job")
+
+
+def test_only_jobs_from_the_jobs_api_are_written_to_disk(client, grader):
+    client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json")
+    assert not os.path.exists(jobs.JOBS_DIR) or os.listdir(jobs.JOBS_DIR) == []
+
+    job_id = submit(client).get_json()["id"]
+    poll(client, job_id, wait=5)
+
+    assert os.listdir(jobs.JOBS_DIR) == [job_id + ".json"]
+
+
+# --- what is refused, and what fails ------------------------------------------------------------
+
+def test_a_job_is_validated_exactly_as_a_grade_request_is(client, grader):
+    resp = submit(client, dict(VALID, surprise=1))
+
+    assert resp.status_code == 400
+    assert grader.threads == []
+
+
+@pytest.mark.parametrize("job_id", ["0" * 32, "../../etc/passwd", "not-a-job"])
+def test_an_unknown_job_is_404(client, job_id):
+    assert poll(client, job_id).status_code == 404
+
+
+def test_a_full_queue_refuses_new_jobs_but_not_the_synchronous_endpoint(client, grader, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_QUEUE_LIMIT", 1)
+    grader.release.clear()
+    submit(client)
+
+    refused = submit(client)
+
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"]
+
+    grader.release.set()
+    sync = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json")
+    assert sync.status_code == 200
+
+
+def test_a_job_whose_grading_raised_is_failed_with_the_reason(client, grader):
+    grader.result = RuntimeError("no such image")
+    job_id = submit(client).get_json()["id"]
+
+    body = poll(client, job_id, wait=5).get_json()
+
+    assert body["status"] == "failed"
+    assert "no such image" in body["error"]
+
+
+def test_a_job_left_running_by_a_process_that_exited_is_reported_failed(client):
+    # Another worker's job, as its file says; the worker is gone. Without this it would say
+    # "running" until the file was swept an hour later, and core would wait that long.
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    job_id = "a" * 32
+    os.makedirs(jobs.JOBS_DIR, exist_ok=True)
+    with open(os.path.join(jobs.JOBS_DIR, job_id + ".json"), "w") as f:
+        json.dump({"status": "running", "submitted_at": 0, "started_at": 0, "pid": gone.pid}, f)
+
+    body = poll(client, job_id).get_json()
+
+    assert body["status"] == "failed"
+    assert "pid" not in body
+
+
+def test_another_workers_finished_job_is_read_from_its_file(client):
+    job_id = "b" * 32
+    os.makedirs(jobs.JOBS_DIR, exist_ok=True)
+    with open(os.path.join(jobs.JOBS_DIR, job_id + ".json"), "w") as f:
+        json.dump({"status": "done", "result": {"grade": 7, "feedback": ""}, "pid": os.getppid()}, f)
+
+    assert poll(client, job_id, wait=5).get_json()["result"]["grade"] == 7
+
+
+def test_finished_jobs_are_forgotten_after_the_retention(client, grader, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETENTION_SEC", 0)
+    monkeypatch.setattr(jobs, "_swept_at", 0.0)
+    old = submit(client).get_json()["id"]
+    poll(client, old, wait=5)
+    stale = time.time() - 10
+    os.utime(os.path.join(jobs.JOBS_DIR, old + ".json"), (stale, stale))
+
+    monkeypatch.setattr(jobs, "_swept_at", 0.0)
+    submit(client)
+
+    assert poll(client, old).status_code == 404
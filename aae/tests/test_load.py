@@ -0,0 +1,112 @@
+# coding=utf-8
+"""`/v1/load`: the numbers core chooses an executor by, and that polling it costs nothing.
+
+The counts come from real lease files, as in `test_admission.py`. `/proc` is not: the host running the
+suite has whatever pressure it has, so PSI and meminfo are read from files the test writes.
+"""
+import os
+import time
+
+import pytest
+
+import admission
+import load
+
+PSI = """some avg10=1.50 avg60=0.80 avg300=0.20 total=123456
+full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+"""
+
+
+@pytest.fixture(autouse=True)
+def admission_on(monkeypatch):
+    """The container and memory numbers come from admission, which is off by default."""
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+
+
+@pytest.fixture
+def host(tmp_path, monkeypatch):
+    """Room for four containers and 1000 MB, a quiet CPU, and 4 GB of RAM with half of it free."""
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 4)
+    monkeypatch.setattr(admission, "ADMISSION_MEM_MB", 1000)
+    (tmp_path / "cpu").write_text(PSI)
+    (tmp_path / "meminfo").write_text("MemTotal:  4194304 kB\nMemFree:  1 kB\nMemAvailable:  2097152 kB\n")
+    monkeypatch.setattr(load, "PSI_CPU_FILE", str(tmp_path / "cpu"))
+    monkeypatch.setattr(load, "MEMINFO_FILE", str(tmp_path / "meminfo"))
+    return tmp_path
+
+
+def lease(mem_mb):
+    os.makedirs(admission.ADMISSION_DIR, exist_ok=True)
+    path = os.path.join(admission.ADMISSION_DIR, "{}-{}.lease".format(os.getpid(), time.monotonic_ns()))
+    with open(path, "w") as f:
+        f.write('{{"pid": {}, "mem_mb": {}, "max_time_sec": 20, "start": {}}}'.format(os.getpid(), mem_mb,
+                                                                                      time.time()))
+
+
+# --- what it says ------------------------------------------------------------------------------
+
+def test_running_containers_and_memory_come_from_the_leases_and_the_host(host):
+    lease(300)
+
+    status = load.load_status()
+
+    assert status["running"] == 1 and status["max_containers"] == 4
+    assert status["mem_mb"] == {"promised": 300, "budget": 1000, "host": 4096, "available": 2048}
+    assert status["cpu_pressure"]["some"] == {"avg10": 1.5, "avg60": 0.8, "avg300": 0.2}
+
+
+def test_safe_slots_are_the_fewer_of_the_free_containers_and_the_memory_left(host):
+    lease(300)
+
+    assert load.load_status(mem_mb=100)["safe_additional_slots"] == 3  # containers
+    assert load.load_status(mem_mb=300)["safe_additional_slots"] == 2  # 700 MB left
+    assert load.load_status(mem_mb=5000)["safe_additional_slots"] == 0  # the whole budget, and it is in use
+
+
+def test_a_host_whose_runs_wait_for_a_cpu_has_no_safe_slots(host, monkeypatch):
+    (host / "cpu").write_text(PSI.replace("avg10=1.50", "avg10=40.00"))
+
+    assert load.load_status()["safe_additional_slots"] == 0
+
+
+def test_without_psi_or_admission_it_says_it_does_not_know(host, monkeypatch):
+    monkeypatch.setattr(load, "PSI_CPU_FILE", str(host / "missing"))
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", False)
+
+    status = load.load_status()
+
+    assert status["cpu_pressure"] is None
+    assert status["running"] is None and status["safe_additional_slots"] is None
+
+
+def test_grade_times_are_percentiles_per_image_over_recent_runs(host):
+    for seconds in range(1, 21):
+        load.record_grade("tiivad", float(seconds))
+    load.record_grade("pygrader", 2.0)
+    load._grades["imgrec"] = [(time.time() - load.LOAD_GRADE_WINDOW_SEC - 1, 9.0)]
+
+    grades = load.load_status()["grade_sec"]
+
+    assert grades == {"tiivad": {"count": 20, "p50": 10.0, "p95": 19.0},
+                      "pygrader": {"count": 1, "p50": 2.0, "p95": 2.0}}
+
+
+# --- what it costs -----------------------------------------------------------------------------
+
+def test_a_poll_within_the_snapshots_age_reads_nothing(host, monkeypatch):
+    load.load_status()
+    monkeypatch.setattr(admission, "admission_status", lambda: pytest.fail("rebuilt the snapshot"))
+
+    load.load_status(mem_mb=64)
+
+
+def test_the_endpoint_answers_without_docker_and_checks_its_parameter(client, host, monkeypatch):
+    monkeypatch.setattr(load.admission, "ADMISSION_MAX_CONTAINERS", 4)
+    monkeypatch.setattr("containers.docker.from_env", lambda **kwargs: pytest.fail("asked Docker"))
+
+    answer = client.get("/v1/load?mem_mb=250")
+
+    assert answer.status_code == 200
+    assert answer.get_json()["safe_additional_slots"] == 4 and answer.get_json()["slot_mem_mb"] == 250
+    assert client.get("/v1/load?mem_mb=lots").status_code == 400
+    assert client.get("/v1/load?mem_mb=0").status_code == 400
@@ -0,0 +1,184 @@
+# coding=utf-8
+"""`/v1/metrics`: per-phase grading times, runs by status and image, containers in flight — for the host.
+
+What would make these numbers useless for capacity planning is the aggregation being wrong, so that
+is most of what is pinned: a scrape adds up every worker's snapshot, a worker that exited still
+counts (a counter must never go backwards), and its containers do not. The rest is that a grading run
+actually lands in the phases it is supposed to, and that the answer is text Prometheus can parse.
+
+Docker is faked at `docker.from_env`; the "other workers" are snapshot files written by the test.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import containers
+import metrics
+from conftest import FakeDocker
+from containers import RunStatus
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    monkeypatch.setenv("EASY_GRADING_IMAGE_NAMES", "python,tiivad")
+    in_flight_at_create = []
+    fake = FakeDocker(on_create=lambda image, kwargs: in_flight_at_create.append(metrics._in_flight))
+    fake.in_flight_at_create = in_flight_at_create
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+    return fake
+
+
+def grade(logger, image="python:3.12"):
+    return containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], image, 10, 64, logger, "req-1")
+
+
+def samples(text):
+    """`name{labels}` -> value, for every sample line."""
+    found = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            found[name] = float(value)
+    return found
+
+
+def write_snapshot(pid, runs=(), in_flight=0, histograms=None):
+    os.makedirs(metrics.METRICS_DIR, exist_ok=True)
+    with open(os.path.join(metrics.METRICS_DIR, "{}.json".format(pid)), "w") as f:
+        json.dump({"pid": pid, "runs": [list(r) for r in runs], "in_flight": in_flight,
+                   "histograms": histograms or {}}, f)
+
+
+def dead_pid():
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    return gone.pid
+
+
+# --- what a run records -------------------------------------------------------------------------
+
+def test_a_run_is_timed_in_each_of_its_phases(docker, logger):
+    grade(logger)
+    containers.drain_reaper(5)  # `remove` is timed where it happens, on the reaper
+
+    found = samples(metrics.exposition())
+
+    for phase in ("create_start", "materialise", "run", "logs", "remove"):
+        assert found['easy_grading_phase_seconds_count{{phase="{}"}}'.format(phase)] == 1, phase
+    assert 'easy_grading_phase_seconds_count{phase="build"}' not in found
+
+
+def test_runs_are_counted_by_status_and_by_base_image(docker, logger):
+    grade(logger)
+    grade(logger)
+    grade(logger, image="python:3.11")
+    grade(logger, image="made-up")
+
+    found = samples(metrics.exposition())
+
+    assert found['easy_grading_runs_total{status="SUCCESS",image="python"}'] == 3
+    assert found['easy_grading_runs_total{status="SUCCESS",image="other"}'] == 1
+
+
+def test_images_the_host_does_not_grade_with_are_counted_together(docker, logger):
+    # The image is whatever the request named; a label per name would be a series per request.
+    for n in range(3):
+        grade(logger, image="made-up-{}:latest".format(n))
+
+    found = samples(metrics.exposition())
+
+    assert found['easy_grading_runs_total{status="SUCCESS",image="other"}'] == 3
+    assert len([name for name in found if name.startswith("easy_grading_runs_total")]) == 1
+
+
+def test_a_run_that_raised_is_counted_as_an_error(monkeypatch, logger):
+    def refused(**kwargs):
+        raise containers.docker.errors.APIError("daemon went away")
+
+    monkeypatch.setattr(containers.docker, "from_env", refused)
+
+    with pytest.raises(containers.docker.errors.APIError):
+        grade(logger)
+
+    assert samples(metrics.exposition())['easy_grading_runs_total{status="ERROR",image="other"}'] == 1
+
+
+def test_a_container_is_in_flight_from_its_create_until_the_run_is_done_with_it(docker, logger):
+    grade(logger)
+
+    assert docker.in_flight_at_create == [1]
+    assert samples(metrics.exposition())["easy_grading_containers_in_flight"] == 0
+
+
+def test_parsing_the_output_is_a_phase_of_its_own(client, docker):
+    body = {"submission": "print(1)", "grading_script": "#!/bin/sh\ntrue", "assets": [],
+            "image_name": "python:3.12", "max_time_sec": 10, "max_mem_mb": 64}
+    client.post("/v1/grade", data=json.dumps(body), content_type="application/json")
+
+    assert samples(metrics.exposition())['easy_grading_phase_seconds_count{phase="parse"}'] == 1
+
+
+# --- one answer for the host --------------------------------------------------------------------
+
+def test_every_workers_numbers_are_added_up(docker, logger):
+    grade(logger)
+    write_snapshot(os.getppid(), runs=[("SUCCESS", "python", 4), ("TIME_EXCEEDED", "tiivad", 1)], in_flight=2)
+
+    found = samples(metrics.exposition())
+
+    assert found['easy_grading_runs_total{status="SUCCESS",image="python"}'] == 5
+    assert found['easy_grading_runs_total{status="TIME_EXCEEDED",image="tiivad"}'] == 1
+    assert found["easy_grading_containers_in_flight"] == 2
+    assert found["easy_executor_processes"] == 2
+
+
+def test_an_exited_workers_counts_stay_but_its_containers_do_not(docker, logger):
+    # A gunicorn worker restart must not make a counter go backwards; Prometheus would read it as a
+    # reset and the rate as nonsense.
+    write_snapshot(dead_pid(), runs=[("SUCCESS", "tiivad", 3)], in_flight=1)
+
+    first = samples(metrics.exposition())
+    second = samples(metrics.exposition())
+
+    assert first['easy_grading_runs_total{status="SUCCESS",image="tiivad"}'] == 3
+    assert second['easy_grading_runs_total{status="SUCCESS",image="tiivad"}'] == 3
+    assert second["easy_grading_containers_in_flight"] == 0
+    assert os.path.exists(os.path.join(metrics.METRICS_DIR, "retired.json"))
+
+
+def test_histograms_are_added_bucket_by_bucket(logger):
+    metrics.observe("run", 0.3)
+    other = [0] * (len(metrics.METRICS_BUCKETS) + 1)
+    other[-1] = 1  # one run longer than the last bound
+    write_snapshot(os.getppid(), histograms={"run": {"buckets": other, "sum": 400.0, "count": 1}})
+
+    found = samples(metrics.exposition())
+
+    assert found['easy_grading_phase_seconds_bucket{phase="run",le="0.25"}'] == 0
+    assert found['easy_grading_phase_seconds_bucket{phase="run",le="0.5"}'] == 1
+    assert found['easy_grading_phase_seconds_bucket{phase="run",le="300"}'] == 1
+    assert found['easy_grading_phase_seconds_bucket{phase="run",le="+Inf"}'] == 2
+    assert found['easy_grading_phase_seconds_sum{phase="run"}'] == pytest.approx(400.3)
+    assert found['easy_grading_phase_seconds_count{phase="run"}'] == 2
+
+
+# --- over HTTP ----------------------------------------------------------------------------------
+
+def test_the_endpoint_answers_in_the_text_format_without_docker(client, monkeypatch):
+    def boom(**kwargs):
+        raise AssertionError("/v1/metrics reached the Docker daemon")
+
+    monkeypatch.setattr(containers.docker, "from_env", boom)
+    # Only a snapshot can still carry a name like this one; it is escaped all the same.
+    write_snapshot(os.getppid(), runs=[(RunStatus.SUCCESS.name, 'an "odd" name', 1)])
+
+    resp = client.get("/v1/metrics")
+
+    assert resp.status_code == 200
+    assert resp.content_type.startswith("text/plain; version=0.0.4")
+    text = resp.get_data(as_text=True)
+    assert "# TYPE easy_grading_phase_seconds histogram" in text
+    assert 'image="an \\"odd\\" name"' in text
@@ -0,0 +1,160 @@
+# coding=utf-8
+"""The orphan sweep: what a killed worker left behind is removed, and nothing else is.
+
+Removing too much is the failure that matters here — a pooled container a live worker is about to
+hand a student, an exercise image the cache still serves, somebody else's container on the same
+host — so most of this pins what the sweep leaves alone. The rest is that everything aae creates
+carries the labels the sweep goes by, and that one sweep per host is what happens when every worker
+tries at once.
+
+Docker is faked: `list` answers from what the test put there, and filters on the owner label the way
+the daemon would.
+"""
+import json
+import os
+import subprocess
+import sys
+from time import time
+
+import pytest
+
+import containers
+import metrics
+from conftest import FakeDocker, FakeImage
+
+
+def orphan(fake, age_sec, role=containers.ROLE_GRADING, pid=None, **kwargs):
+    """A container on the fake daemon, labelled as a run of `pid` (a dead one by default) would label it."""
+    return fake.add_container(labels=labels(age_sec, role, dead_pid() if pid is None else pid), **kwargs)
+
+
+def labels(age_sec, role, pid):
+    return {containers.LABEL_OWNER: containers.OWNER, containers.LABEL_CREATED: str(int(time() - age_sec)),
+            containers.LABEL_PID: str(pid), containers.LABEL_ROLE: role}
+
+
+def dead_pid():
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    return gone.pid
+
+
+OLD = 2 * 60 * 60
+RECENT = 60
+
+
+@pytest.fixture
+def fake():
+    return FakeDocker()
+
+
+# --- what is removed, and what is not -----------------------------------------------------------
+
+def test_an_old_container_of_a_dead_worker_is_removed_and_a_recent_one_is_not(fake, logger):
+    orphan(fake, OLD)
+    recent = orphan(fake, RECENT)
+
+    swept = containers.sweep_orphans(fake, logger)
+
+    assert fake.container_list == [recent]
+    assert swept["containers"] == 1
+    assert "Swept 1 orphaned containers" in logger.text()
+
+
+def test_a_live_workers_pooled_container_is_left_however_old(fake, logger):
+    pooled = orphan(fake, OLD, status="created", pid=os.getpid())
+    orphan(fake, OLD, status="created", pid=dead_pid())  # that worker's pool, with nobody to empty it
+    orphan(fake, OLD, status="exited", pid=os.getpid())  # a run that finished and was never removed
+
+    swept = containers.sweep_orphans(fake, logger)
+
+    assert fake.container_list == [pooled]
+    assert swept["kept_pooled"] == 1
+
+
+def test_a_live_workers_pooled_zygote_is_left_although_it_is_running(fake, logger):
+    zygote = orphan(fake, OLD, status="running", pid=os.getpid())
+    zygote.labels[containers.LABEL_ZYGOTE] = "1"
+    orphan(fake, OLD, status="running", pid=os.getpid())  # not a zygote: a run nobody stopped
+
+    containers.sweep_orphans(fake, logger)
+
+    assert fake.container_list == [zygote]
+
+
+def test_a_build_container_is_not_a_pooled_one(fake, logger):
+    orphan(fake, OLD, status="created", pid=os.getpid(), role=containers.ROLE_BUILD)
+
+    containers.sweep_orphans(fake, logger)
+
+    assert fake.container_list == []
+
+
+def test_what_aae_did_not_create_is_never_touched(fake, logger):
+    fake.add_container(labels={})
+    fake.add_container(labels={"easy.grading.declared": "tiivad==1.0"})
+
+    containers.sweep_orphans(fake, logger)
+
+    assert len(fake.container_list) == 2
+
+
+def test_only_untagged_exercise_images_are_removed(fake, logger):
+    fake.image_list = [
+        FakeImage("sha256:lost", labels(OLD, containers.ROLE_EXERCISE, 1), size=3 * 1024 * 1024),
+        FakeImage("sha256:cached", labels(OLD, containers.ROLE_EXERCISE, 1), tags=["easy-exercise:abc"]),
+        FakeImage("sha256:building", labels(RECENT, containers.ROLE_EXERCISE, 1)),
+    ]
+
+    swept = containers.sweep_orphans(fake, logger)
+
+    assert [i.id for i in fake.image_list] == ["sha256:cached", "sha256:building"]
+    assert swept["images"] == 1 and swept["image_bytes"] == 3 * 1024 * 1024
+
+
+def test_a_container_that_will_not_go_is_counted_and_tried_next_time(fake, logger):
+    orphan(fake, OLD)
+    fake.refuse = True
+
+    swept = containers.sweep_orphans(fake, logger)
+
+    assert swept["failed"] == 1 and swept["containers"] == 0
+    assert "could not remove orphaned container" in logger.text()
+
+
+# --- once per host ------------------------------------------------------------------------------
+
+def test_a_sweep_done_recently_by_another_worker_is_not_repeated(fake, logger, monkeypatch):
+    monkeypatch.setattr(containers, "ORPHAN_SWEEP_SEC", 600)  # off in the suite (see conftest)
+    containers.sweep_orphans(fake, logger)
+
+    assert containers.sweep_orphans(fake, logger) is None
+    assert fake.lists == 1
+    assert containers.sweep_orphans(fake, logger, force=True) is not None
+
+
+def test_what_was_reclaimed_is_reported_for_the_host(client, fake, logger):
+    orphan(fake, OLD)
+    containers.sweep_orphans(fake, logger)
+
+    body = json.loads(client.get("/v1/pool").data)
+    exposed = metrics.exposition()
+
+    assert body["orphans"]["last"]["containers"] == 1
+    assert body["orphans"]["last"]["pid"] == os.getpid()
+    assert "easy_orphan_containers_removed_total 1" in exposed
+
+
+# --- the labels ---------------------------------------------------------------------------------
+
+def test_every_container_a_run_creates_is_labelled_as_ours(monkeypatch, logger):
+    fake = FakeDocker()
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+
+    containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], "python:3.12", 10, 64, logger, "req-1")
+
+    found = fake.created[0].kwargs["labels"]
+    assert found[containers.LABEL_OWNER] == containers.OWNER
+    assert found[containers.LABEL_ROLE] == containers.ROLE_GRADING
+    assert found[containers.LABEL_PID] == str(os.getpid())
+    assert abs(float(found[containers.LABEL_CREATED]) - time()) < 60
@@ -14,6 +14,7 @@ import json
 
 import pytest
 
+from containers import CapturedOutput
 from server import parse_assessment_output, parse_v3
 
 SEP = "#" * 50
@@ -119,3 +120,31 @@ def test_a_students_own_output_cannot_be_read_as_the_grade():
 
     assert points == 0
     assert "grade: 100" in feedback
+
+
+# --- output whose middle was dropped ---------------------------------------------------------
+
+def test_a_v3_document_survives_a_dropped_middle_if_it_fits_in_the_tail():
+    """
+    A V3 grader prints the student's runaway output first and its JSON last, so after truncation the
+    text as a whole is not JSON any more. The kept tail still ends in the whole document.
+    """
+    document = json.dumps({"result_type": "OK_V3", "points": 80, "tests": []})
+    tail = "xxxx\n" + document
+    raw = CapturedOutput("head\n[... marker ...]\n" + tail, dropped_bytes=10_000, tail=tail)
+
+    assert parse_assessment_output(raw) == (80, document)
+
+
+def test_a_v3_document_cut_in_half_is_not_read_as_a_grade():
+    tail = '"points": 100}'
+    raw = CapturedOutput("head\n[... marker ...]\n" + tail, dropped_bytes=10_000, tail=tail)
+
+    with pytest.raises(Exception):
+        parse_assessment_output(raw)
+
+
+def test_a_legacy_grade_survives_a_dropped_middle():
+    raw = CapturedOutput(f"head\n[... marker ...]\nmore\n{SEP}\ngrade: 70", dropped_bytes=10_000, tail="")
+
+    assert parse_assessment_output(raw)[0] == 70
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""The reaper: container removal after the grade has gone back, retried, bounded, and never silent.
+
+Moving removal off the request path trades a visible cost for an invisible risk — a removal nobody
+waits for is a removal nobody notices failing. So beyond "the grade does not wait", these pin that a
+refused removal is tried again, that one given up on is counted and logged as the leak it is, and that
+a full backlog falls back to removing inline rather than growing.
+
+Tasks here are plain functions; `test_grade_submission.py` covers the reaper behind a real run.
+"""
+import threading
+
+import pytest
+
+import containers
+import metrics
+import tracing
+from conftest import FakeContainer, FakeDocker
+from containers import RunStatus
+
+
+class Removal:
+    """A removal that fails `failures` times first, or raises `error` every time."""
+
+    def __init__(self, failures=0, error=None):
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        assert self.release.wait(5)
+        self.attempts += 1
+        if self.error is not None:
+            raise self.error
+        if self.attempts <= self.failures:
+            raise containers.docker.errors.APIError("daemon busy")
+
+
+@pytest.fixture
+def quick_retries(monkeypatch):
+    monkeypatch.setattr(containers, "REAPER_RETRY_SEC", 0.01)
+
+
+def test_a_run_returns_before_its_container_is_removed(monkeypatch, logger):
+    removal = Removal()
+    removal.release.clear()
+
+    container = FakeContainer()
+    container.remove = lambda force=False: removal()
+    fake = FakeDocker(container)
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+
+    outcome, _ = containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], "python:3.12", 10, 64, logger, "r")
+
+    assert outcome.status == RunStatus.SUCCESS
+    assert removal.attempts == 0
+    assert containers.reaper_status()["backlog"] == 1
+    removal.release.set()
+    assert containers.drain_reaper(5)
+    assert removal.attempts == 1
+
+
+def test_a_refused_removal_is_tried_again(quick_retries, logger):
+    removal = Removal(failures=2)
+
+    containers._reap("container x", removal, logger)
+
+    assert containers.drain_reaper(5)
+    assert removal.attempts == 3
+    status = containers.reaper_status()
+    assert (status["retried"], status["done"], status["failed"]) == (2, 1, 0)
+
+
+def test_a_container_that_is_already_gone_is_not_retried(logger):
+    removal = Removal(error=containers.docker.errors.NotFound("no such container"))
+
+    containers._reap("container x", removal, logger)
+
+    assert containers.drain_reaper(5)
+    assert removal.attempts == 1
+    assert containers.reaper_status()["done"] == 1
+
+
+def test_a_removal_given_up_on_is_counted_and_logged_as_a_leak(quick_retries, logger):
+    removal = Removal(error=containers.docker.errors.APIError("device or resource busy"))
+
+    containers._reap("container x", removal, logger)
+
+    assert containers.drain_reaper(5)
+    assert removal.attempts == containers.REAPER_ATTEMPTS
+    assert containers.reaper_status()["failed"] == 1
+    assert "leaked" in logger.text()
+    assert "easy_reaper_failures_total 1" in metrics.exposition()
+
+
+def test_a_full_backlog_removes_inline_instead_of_growing(monkeypatch, logger):
+    monkeypatch.setattr(containers, "REAPER_BACKLOG", 0)
+    removal = Removal()
+
+    containers._reap("container x", removal, logger)
+
+    assert removal.attempts == 1
+    assert containers.reaper_status()["inline"] == 1
+
+
+def test_a_removal_is_traced_under_the_request_that_queued_it(logger):
+    seen = []
+
+    def removal():
+        with tracing.span("docker.remove"):
+            seen.append(tracing._context.get())
+
+    with tracing.context("req-5", "tiivad"):
+        containers._reap("container x", removal, logger)
+    assert containers.drain_reaper(5)
+
+    assert seen == [("req-5", "tiivad")]
+
+
+def test_the_pool_endpoint_shows_the_reaper(client):
+    body = client.get("/v1/pool").get_json()
+
+    assert {"backlog", "done", "retried", "failed", "inline"} <= set(body["reaper"])
@@ -0,0 +1,304 @@
+# coding=utf-8
+"""The result cache: a byte-identical resubmission answered without a container.
+
+The failure that matters is a *wrong hit* — a student shown the grade of different code, or of the
+same code under a test the teacher has since fixed, or under the grading library the host has just
+stopped using. So most of these are about what changes the key. The rest are about what is never kept
+(a timeout says more about the host than the submission) and about two identical requests at once
+running once.
+
+Grading is replaced at `server.grade_submission` and the image ID at `containers.image_id`, so a test
+can move a tag by changing a dictionary.
+"""
+import json
+import threading
+
+import pytest
+
+import admission
+import containers
+import results
+import server
+from containers import RunOutcome, RunStatus
+
+SEP = "#" * 50
+
+VALID = {
+    "submission": "print(1)",
+    "grading_script": "#!/bin/sh\ntrue",
+    "assets": [{"file_name": "test.py", "file_content": "# test"}],
+    "image_name": "tiivad",
+    "max_time_sec": 10,
+    "max_mem_mb": 64,
+}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(results, "RESULT_CACHE_MB", 1)
+    image_ids = {"tiivad": "sha256:one"}
+    monkeypatch.setattr(containers, "image_id", lambda name: image_ids.get(name))
+    return image_ids
+
+
+@pytest.fixture
+def grader(monkeypatch):
+    class Grader:
+        result = (RunOutcome(RunStatus.SUCCESS), f"feedback\n{SEP}\ngrade: 100")
+        runs = []
+        release = threading.Event()
+        # What runs raise instead of returning `result`, the first first.
+        raises = []
+
+    g = Grader()
+    g.release.set()
+
+    def fake(submission, grading_script, assets, image_name, max_time, max_mem, logger, request_id, cpus=None,
+             cpuset=None, listener=None, limits=None):
+        g.runs.append(submission)
+        assert g.release.wait(5)
+        if g.raises:
+            raise g.raises.pop(0)
+        return g.result
+
+    monkeypatch.setattr(server, "grade_submission", fake)
+    yield g
+    g.release.set()
+
+
+def post(client, body=VALID):
+    return client.post("/v1/grade", data=json.dumps(body), content_type="application/json")
+
+
+# --- hits, and what is not one ------------------------------------------------------------------
+
+def test_an_identical_resubmission_is_answered_without_a_run(client, cache, grader):
+    first = post(client).get_json()
+    second = post(client).get_json()
+
+    assert second == dict(first, cached=True)
+    assert len(grader.runs) == 1
+    assert results.result_cache_status()["hits"] == 1
+
+
+def test_a_hit_does_not_repeat_what_the_first_run_used(client, cache, grader):
+    grader.result = (RunOutcome(RunStatus.SUCCESS, usage={"cpu_sec": 1.5}), f"feedback\n{SEP}\ngrade: 100")
+    first = post(client).get_json()
+    second = post(client).get_json()
+
+    assert first["usage"] == {"cpu_sec": 1.5}
+    assert "usage" not in second
+    assert second["cached"] is True
+
+
+def test_a_hit_is_answered_however_close_the_deadline(client, cache, grader, monkeypatch):
+    post(client)
+    # Runs of the image take far longer than the caller will wait.
+    monkeypatch.setattr(server.load, "typical_grade_sec", lambda image_name: 30.0)
+
+    response = client.post("/v1/grade", data=json.dumps(VALID), content_type="application/json",
+                           headers={"X-Request-Timeout": "2"})
+
+    assert response.status_code == 200
+    assert response.get_json()["cached"] is True
+    assert len(grader.runs) == 1
+
+
+@pytest.mark.parametrize("change", [
+    dict(submission="print(2)"),
+    dict(grading_script="#!/bin/sh\nfalse"),
+    dict(assets=[{"file_name": "test.py", "file_content": "# fixed test"}]),
+    dict(assets=[]),
+    dict(max_time_sec=11),
+    dict(max_mem_mb=128),
+    dict(max_cpus=0.5),
+], ids=["submission", "script", "asset-content", "assets", "time-limit", "memory-limit", "cpu-limit"])
+def test_anything_that_could_change_the_grade_is_a_different_entry(client, cache, grader, change):
+    post(client)
+    post(client, dict(VALID, **change))
+
+    assert len(grader.runs) == 2
+
+
+def test_a_retagged_image_is_not_answered_from_the_old_one(client, cache, grader):
+    post(client)
+
+    cache["tiivad"] = "sha256:two"
+    post(client)
+
+    assert len(grader.runs) == 2
+
+
+@pytest.mark.parametrize("status", [RunStatus.TIME_EXCEEDED, RunStatus.MEM_EXCEEDED])
+def test_a_run_that_did_not_finish_is_never_kept(client, cache, grader, status):
+    # Whether a submission times out depends on how busy the host was. Keeping the answer would keep
+    # telling the student their code is too slow after the host had gone quiet.
+    grader.result = (RunOutcome(status), "")
+    post(client)
+    post(client)
+
+    assert len(grader.runs) == 2
+
+
+def test_an_image_that_cannot_be_resolved_is_graded_and_not_kept(client, cache, grader):
+    del cache["tiivad"]
+
+    post(client)
+    post(client)
+
+    assert len(grader.runs) == 2
+
+
+def test_a_hit_does_not_need_room_on_the_host(client, cache, grader, monkeypatch):
+    post(client)
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_CONTAINERS", 1)
+
+    with admission.lease(64, 10):
+        assert post(client).status_code == 200
+
+
+# --- how much is kept, and where ----------------------------------------------------------------
+
+def test_the_least_recently_used_entry_goes_first(client, cache, grader, monkeypatch):
+    # The fake feedback is a few bytes plus the fixed overhead per entry; two fit.
+    monkeypatch.setattr(results, "RESULT_CACHE_MB", 200 / (1024 * 1024))
+    for n in (1, 2):
+        post(client, dict(VALID, submission="print({})".format(n)))
+    post(client, dict(VALID, submission="print(1)"))  # 1 is now more recent than 2
+    post(client, dict(VALID, submission="print(3)"))
+
+    grader.runs.clear()
+    post(client, dict(VALID, submission="print(1)"))
+    post(client, dict(VALID, submission="print(2)"))
+
+    assert grader.runs == ["print(2)"]
+
+
+def test_a_disk_cache_is_shared_with_other_processes(client, cache, grader, monkeypatch, tmp_path):
+    monkeypatch.setattr(results, "RESULT_CACHE_DIR", str(tmp_path / "results"))
+    first = post(client).get_json()
+
+    # Another worker: the same directory, nothing in memory.
+    monkeypatch.setattr(results, "_memory", results.collections.OrderedDict())
+    second = post(client).get_json()
+
+    assert second == dict(first, cached=True)
+    assert len(grader.runs) == 1
+
+
+def test_the_disk_cache_is_trimmed_to_its_budget(cache, monkeypatch, tmp_path):
+    monkeypatch.setattr(results, "RESULT_CACHE_DIR", str(tmp_path / "results"))
+    monkeypatch.setattr(results, "RESULT_CACHE_DISK_MB", 1 / 1024)  # a kilobyte
+    monkeypatch.setattr(results, "RESULT_CACHE_TRIM_SEC", 0)
+    body = {"grade": 1, "feedback": "x" * 400}
+
+    for n in range(5):
+        results.get_or_compute(str(n), lambda: (body, True))
+
+    kept = sorted(p.name for p in (tmp_path / "results").glob("*.json"))
+    assert len(kept) == 2
+    assert "4.json" in kept
+
+
+# --- identical requests at the same time --------------------------------------------------------
+
+def test_identical_requests_at_once_run_once(cache, grader):
+    grader.release.clear()
+    answers = []
+
+    def grade():
+        answers.append(server.grade(dict(VALID), server.app.logger, "req"))
+
+    threads = [threading.Thread(target=grade) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while len(grader.runs) < 1:
+        threading.Event().wait(0.01)
+    threading.Event().wait(0.1)
+    grader.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(grader.runs) == 1
+    assert len(answers) == 3 and all(a == answers[0] for a in answers)
+    assert results.result_cache_status()["collapsed"] == 2
+
+
+def test_waiters_get_the_runs_answer_even_when_it_is_not_kept(cache, grader):
+    # A timeout is not cached, but the request that arrived while it ran asked the same question at the
+    # same moment, and gets the same answer rather than a second run.
+    grader.result = (RunOutcome(RunStatus.TIME_EXCEEDED), "")
+    grader.release.clear()
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(server.grade(dict(VALID), server.app.logger, "r")))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while len(grader.runs) < 1:
+        threading.Event().wait(0.01)
+    threading.Event().wait(0.1)
+    grader.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(grader.runs) == 1
+    assert answers[0]["feedback"] == answers[1]["feedback"] == server.TIME_EXCEEDED_MESSAGE
+    assert results.result_cache_status()["stored"] == 0
+
+
+def join_a_run(grader, **kwargs):
+    """Starts a run that waits for `grader.release`, and a second request that joins it. Both threads' answers."""
+    answers = {}
+
+    def grade(name):
+        try:
+            answers[name] = server.grade(dict(VALID), server.app.logger, name, **kwargs.get(name, {}))
+        except Exception as e:
+            answers[name] = e
+
+    grader.release.clear()
+    first = threading.Thread(target=grade, args=("first",))
+    first.start()
+    while len(grader.runs) < 1:
+        threading.Event().wait(0.01)
+    second = threading.Thread(target=grade, args=("second",))
+    second.start()
+    while results.result_cache_status()["collapsed"] < 1:
+        threading.Event().wait(0.01)
+    grader.release.set()
+    first.join()
+    second.join()
+    return answers
+
+
+def test_a_request_that_joined_an_abandoned_run_runs_it_itself(cache, grader):
+    # The first request's client went away, and its run was killed for it. That is nothing to do with
+    # the second, whose caller is still waiting for a grade.
+    grader.raises = [containers.GradingAbandoned("client went away")]
+
+    answers = join_a_run(grader)
+
+    assert isinstance(answers["first"], containers.GradingAbandoned)
+    assert answers["second"]["grade"] == 100
+    assert len(grader.runs) == 2
+
+
+def test_a_request_that_joined_a_run_without_room_waits_for_room_itself(cache, grader):
+    grader.raises = [admission.Saturated(1, "no room")]
+
+    answers = join_a_run(grader)
+
+    assert isinstance(answers["first"], admission.Saturated)
+    assert answers["second"]["grade"] == 100
+
+
+def test_the_results_endpoint_answers_from_memory(client, monkeypatch):
+    def boom(**kwargs):
+        raise AssertionError("/v1/results reached the Docker daemon")
+
+    monkeypatch.setattr(containers.docker, "from_env", boom)
+
+    body = client.get("/v1/results").get_json()
+
+    assert {"hits", "misses", "collapsed", "stored", "entries", "budget_mb"} <= set(body)
@@ -0,0 +1,300 @@
+# coding=utf-8
+"""Runtimes: a run behaves the same whatever runs its container, and the OCI bundle asks for what Docker did.
+
+The first half drives `grade_submission` through the fake runtime, which is the interface with nothing
+behind it: the order of calls, a timeout being a kill that landed, a container that will not die, and
+the destroy on the reaper. The Docker runtime is covered behind the same calls in
+`test_grade_submission.py`, which fakes docker-py rather than the runtime.
+
+What a run used is read from its cgroup, which here is a directory of files written the way the
+kernel writes them. The part that matters for a grade is the OOM flag: with it, a memory kill is no
+longer guessed from the last line of the output.
+
+The OCI runtime cannot run here — it needs root, runc and an overlay mount. What can be pinned without
+them is the bundle's config, which is where a difference from Docker would hide (a limit not set, the
+image's user ignored), the archive landing where `/evaluate.sh` is expected, and the output reader,
+which has to notice a close while the pipe is still held open by the container.
+"""
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import time
+
+import pytest
+
+import containers
+import runtimes
+from containers import RunStatus
+
+SEP = "#" * 50
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    runtime = runtimes.FakeRuntime(chunks=[b"Test 1: OK\n", "{}\ngrade: 100\n".format(SEP).encode()])
+    monkeypatch.setattr(containers, "_runtime", runtime)
+    return runtime
+
+
+def grade(logger, max_time_sec=10, cpuset=None):
+    return containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], "python:3.12", max_time_sec, 64, logger,
+                                       "req-1", cpus=0.5, cpuset=cpuset)
+
+
+# --- the interface, through a run ---------------------------------------------------------------
+
+def test_a_run_is_create_inject_start_wait_and_destroy(fake, logger):
+    outcome, output = grade(logger)
+    containers.drain_reaper(5)
+
+    assert outcome.status == RunStatus.SUCCESS
+    assert output.endswith("grade: 100\n")
+    assert [method for method, _ in fake.calls] == ["create", "inject", "start", "wait", "destroy"]
+    handle = fake.handles[0]
+    assert (handle.image_name, handle.max_mem_MB, handle.cpus) == ("python:3.12", 64, 0.5)
+    assert handle.limits == containers.run_limits()
+    assert "evaluate.sh" in tarfile.open(fileobj=io.BytesIO(handle.archive)).getnames()
+    assert handle.destroyed
+
+
+def test_the_cores_admission_chose_are_pinned_before_the_start(fake, logger):
+    grade(logger, cpuset="2,3")
+
+    assert [method for method, _ in fake.calls][:4] == ["create", "pin", "inject", "start"]
+    assert fake.handles[0].cpuset == "2,3"
+
+
+def test_a_run_past_its_time_is_killed_and_says_so(fake, logger):
+    fake.run_sec = 5
+
+    outcome, _ = grade(logger, max_time_sec=0.05)
+
+    assert outcome.status == RunStatus.TIME_EXCEEDED
+    assert outcome.timed_out and outcome.exit_code == 137
+    assert 0 <= outcome.kill_to_exit_sec < 1
+    assert ("kill", fake.handles[0].short_id) in fake.calls
+
+
+def test_a_container_that_ignores_the_kill_is_given_up_on(fake, logger, monkeypatch):
+    fake.run_sec = 5
+    monkeypatch.setattr(fake, "kill", lambda handle: None)  # the kill "works" and nothing happens
+    monkeypatch.setattr(containers, "WAIT_GRACE_SEC", 0.05)
+
+    outcome, output = grade(logger, max_time_sec=0.05)
+
+    assert outcome.status == RunStatus.TIME_EXCEEDED
+    assert outcome.timed_out and outcome.kill_to_exit_sec is None
+    assert "Test 1: OK" in output
+    assert "did not exit after being killed" in logger.text()
+
+
+def test_only_docker_builds_per_exercise_images():
+    assert containers.DockerRuntime.exercise_images
+    assert not runtimes.OciRuntime.exercise_images
+    assert not runtimes.FakeRuntime.exercise_images
+
+
+# --- what a run used --------------------------------------------------------------------------------
+
+def test_the_usage_comes_back_with_the_outcome(fake, logger):
+    fake._stats = {"cpu_user_sec": 0.5, "memory_peak_bytes": 1 << 20, "oom_killed": False}
+
+    outcome, _ = grade(logger)
+
+    assert (outcome.exit_code, outcome.oom_killed, outcome.timed_out, outcome.truncated) == (0, False, False, False)
+    assert outcome.usage["memory_peak_bytes"] == 1 << 20
+    assert outcome.usage["exit_code"] == 0
+    assert 0 <= outcome.usage["wall_sec"] < 1
+
+
+def test_a_memory_kill_is_read_from_the_cgroup_not_from_the_output(fake, logger):
+    fake._stats = {"oom_killed": True}
+    assert grade(logger)[0].status == RunStatus.MEM_EXCEEDED
+
+    # A program that prints "Killed" as its last line was not killed for it.
+    fake._stats = {"oom_killed": False}
+    fake.chunks = [b"Killed\n"]
+    assert grade(logger)[0].status == RunStatus.SUCCESS
+
+
+def test_without_an_oom_flag_the_exit_status_decides(fake, logger, monkeypatch):
+    def refused(handle):
+        raise runtimes.RuntimeRefused("no such container")
+
+    monkeypatch.setattr(fake, "stats", refused)
+    fake.chunks = [b"Test 1: OK\n", b"/evaluate.sh: line 2:     7 Killed    python3 test.py\n"]
+    fake.exit_code = 137
+    outcome, _ = grade(logger)
+    assert outcome.status == RunStatus.MEM_EXCEEDED
+    assert outcome.oom_killed is None
+    assert set(outcome.usage) == {"wall_sec", "exit_code"}
+
+    # The same last line from a program that exited by itself.
+    fake.exit_code = 0
+    assert grade(logger)[0].status == RunStatus.SUCCESS
+
+
+def cgroup(path, user_usec=250000, peak=None, current=4096, oom_kill=0):
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "cpu.stat").write_text("usage_usec {}\nuser_usec {}\nsystem_usec 5000\n".format(user_usec + 5000, user_usec))
+    (path / "memory.current").write_text("{}\n".format(current))
+    if peak is not None:
+        (path / "memory.peak").write_text("{}\n".format(peak))
+    (path / "memory.events").write_text("low 0\nhigh 0\nmax 3\noom 1\noom_kill {}\n".format(oom_kill))
+    return path
+
+
+def test_a_cgroup_is_read_as_cpu_seconds_peak_bytes_and_the_oom_flag(tmp_path):
+    usage = runtimes.cgroup_usage(str(cgroup(tmp_path / "c", peak=8192, oom_kill=1)))
+
+    assert usage == {"cpu_user_sec": 0.25, "cpu_system_sec": 0.005, "memory_peak_bytes": 8192, "oom_killed": True}
+    # A kernel older than memory.peak (5.19): the current charge is the best there is.
+    assert runtimes.cgroup_usage(str(cgroup(tmp_path / "old")))["memory_peak_bytes"] == 4096
+    assert runtimes.cgroup_usage(str(tmp_path / "gone")) is None
+
+
+def test_the_sampler_keeps_the_highest_reading_after_the_cgroup_is_gone(tmp_path, monkeypatch):
+    monkeypatch.setattr(runtimes, "CGROUP_SAMPLE_SEC", 0.01)
+    path = cgroup(tmp_path / "docker" / "c0ffee", current=1 << 20, oom_kill=1)
+    sampler = runtimes.CgroupSampler([str(tmp_path / "system.slice" / "nothing"), str(path)])
+    time.sleep(0.1)
+    cgroup(path, current=4096)  # the charge drops as the killed process's pages are freed
+    time.sleep(0.1)
+    for name in os.listdir(path):
+        os.remove(path / name)
+    path.rmdir()  # and Docker removes the cgroup at the exit
+
+    usage = sampler.stop()
+
+    assert usage["memory_peak_bytes"] == 1 << 20
+    assert usage["oom_killed"] is True
+
+
+# --- oci -------------------------------------------------------------------------------------------
+
+def oci_handle(tmp_path, monkeypatch, config=None, cpus=1.5, limits=runtimes.Limits(pids=256, swap_mb=0, tmp_mb=32)):
+    monkeypatch.setattr(runtimes, "OCI_DIR", str(tmp_path))
+    rootfs = tmp_path / "image-rootfs"
+    (rootfs / "etc").mkdir(parents=True)
+    (rootfs / "etc" / "passwd").write_text("root:x:0:0::/root:/bin/sh\ngrader:x:1000:1001::/home/grader:/bin/sh\n")
+    image = {"id": "sha256:abc", "rootfs": str(rootfs), "config": config or {}}
+    return runtimes.OciHandle(image, 64, cpus, limits)
+
+
+def test_the_bundle_has_the_limits_docker_would_have_set(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch)
+    handle.cpuset = "0,3"
+
+    config = runtimes.oci_config(handle, containers.GRADING_COMMAND)
+
+    resources = config["linux"]["resources"]
+    assert resources["memory"] == {"limit": 64 * 1024 * 1024, "swap": 64 * 1024 * 1024}
+    assert resources["cpu"] == {"quota": 150000, "period": 100000, "cpus": "0,3"}
+    assert resources["pids"] == {"limit": 256}
+    tmp = [m for m in config["mounts"] if m["destination"] == "/tmp"]
+    assert tmp == [{"destination": "/tmp", "type": "tmpfs", "source": "tmpfs",
+                    "options": ["nosuid", "nodev", "mode=1777", "size=32m"]}]
+    assert config["process"]["args"] == ["/bin/sh", "-c", "/evaluate.sh"]
+    # runc refuses a hostname without a UTS namespace; a network namespace means no network.
+    assert config["hostname"] == handle.short_id
+    assert {"uts", "network", "pid", "ipc", "mount"} <= {n["type"] for n in config["linux"]["namespaces"]}
+    seccomp = config["linux"]["seccomp"]
+    assert seccomp["defaultAction"] == "SCMP_ACT_ALLOW"
+    assert {"mount", "unshare", "setns", "bpf", "keyctl"} <= set(seccomp["syscalls"][0]["names"])
+    assert seccomp["syscalls"][0]["action"] == "SCMP_ACT_ERRNO"
+    json.dumps(config)
+
+
+def test_an_unlimited_cpu_is_left_unlimited(tmp_path, monkeypatch):
+    config = runtimes.oci_config(oci_handle(tmp_path, monkeypatch, cpus=0), ["true"])
+
+    assert "cpu" not in config["linux"]["resources"]
+
+
+def test_no_pid_limit_and_no_tmpfs_when_switched_off_and_swap_on_top_of_memory(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch, limits=runtimes.Limits(pids=0, swap_mb=16, tmp_mb=0))
+
+    config = runtimes.oci_config(handle, ["true"])
+
+    assert "pids" not in config["linux"]["resources"]
+    assert config["linux"]["resources"]["memory"]["swap"] == 80 * 1024 * 1024
+    assert "/tmp" not in [m["destination"] for m in config["mounts"]]
+
+
+def test_the_bundle_runs_as_the_images_user_in_its_environment(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch, {"User": "grader", "Env": ["PATH=/opt/bin", "LANG=C.UTF-8"],
+                                                "WorkingDir": "/home/grader"})
+
+    process = runtimes.oci_config(handle, ["true"])["process"]
+
+    assert process["user"] == {"uid": 1000, "gid": 1001}
+    assert process["env"] == ["PATH=/opt/bin", "LANG=C.UTF-8"]
+    assert process["cwd"] == "/home/grader"
+
+
+def test_an_image_user_that_does_not_exist_is_refused(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch, {"User": "nobody-here"})
+
+    with pytest.raises(runtimes.RuntimeRefused):
+        runtimes.oci_config(handle, ["true"])
+
+
+def test_the_archive_lands_in_the_runs_own_layer(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch)
+    archive = containers.submission_archive("print(1)", "#!/bin/sh\ntrue", [])
+
+    runtimes.OciRuntime().inject(handle, archive)
+
+    assert (tmp_path / "runs" / handle.id / "upper" / "evaluate.sh").read_text() == "#!/bin/sh\ntrue"
+    assert (tmp_path / "runs" / handle.id / "upper" / "student-submission" / "lahendus.py").exists()
+
+
+def test_an_archive_naming_a_path_outside_the_layer_is_refused(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch)
+    archive = containers.submission_archive("print(1)", "#!/bin/sh\ntrue", [("../../../../escaped.txt", "x")])
+
+    with pytest.raises(tarfile.TarError):
+        runtimes.OciRuntime().inject(handle, archive)
+
+    assert not list(tmp_path.rglob("escaped.txt"))
+
+
+def test_an_image_keeps_its_modes_but_not_setuid_or_a_way_out(tmp_path):
+    def member(name, mode, **kwargs):
+        info = tarfile.TarInfo(name)
+        info.mode = mode
+        for key, value in kwargs.items():
+            setattr(info, key, value)
+        return info
+
+    kept = runtimes._image_filter(member("tmp", 0o1777, type=tarfile.DIRTYPE), str(tmp_path))
+    stripped = runtimes._image_filter(member("usr/bin/sudo", 0o4755), str(tmp_path))
+
+    assert kept.mode == 0o1777 and stripped.mode == 0o755
+    with pytest.raises(tarfile.FilterError):
+        runtimes._image_filter(member("../outside", 0o644), str(tmp_path))
+
+
+def test_the_output_ends_with_the_process_or_when_closed(tmp_path, monkeypatch):
+    handle = oci_handle(tmp_path, monkeypatch)
+    handle.process = subprocess.Popen([sys.executable, "-c", "print('one'); print('two')"], stdout=subprocess.PIPE)
+    assert b"".join(runtimes.OciRuntime().output(handle)) == b"one\ntwo\n"
+    handle.process.wait()
+    handle.process.stdout.close()
+
+    handle.process = subprocess.Popen([sys.executable, "-c", "import os, time; os.write(1, b'x'); time.sleep(30)"],
+                                      stdout=subprocess.PIPE)
+    try:
+        output = runtimes.OciRuntime().output(handle)
+        chunks = iter(output)
+        assert next(chunks) == b"x"
+        output.close()
+        with pytest.raises(runtimes.NotExited):
+            next(chunks)
+    finally:
+        handle.process.kill()
+        handle.process.wait()
+        handle.process.stdout.close()
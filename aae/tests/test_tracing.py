@@ -0,0 +1,161 @@
+# coding=utf-8
+"""Traces: a span per Docker call and per phase, under the request's ID — and the report read from them.
+
+A trace is only worth anything if it can be tied to a request and an image afterwards, so the first
+half pins that every Docker call a run makes is a span carrying both, that nothing is recorded
+outside a request (the pool refills in the background), and that a raising call still leaves its
+span. The second half feeds `trace_report.py` lines written by hand and checks its arithmetic.
+
+Docker is faked as in `test_metrics.py`; the trace directory is per test (see conftest).
+"""
+import glob
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+import containers
+import trace_report
+import tracing
+from conftest import FakeDocker
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    fake = FakeDocker()
+    monkeypatch.setattr(containers.docker, "from_env", lambda **kwargs: fake)
+
+
+def recorded():
+    spans = []
+    for name in glob.glob(os.path.join(tracing.TRACE_DIR, "trace-*.jsonl*")):
+        with open(name, encoding="utf-8") as f:
+            spans.extend(json.loads(line) for line in f)
+    return spans
+
+
+# --- what is recorded ---------------------------------------------------------------------------
+
+def test_every_docker_call_of_a_run_is_a_span_under_the_request(docker, logger):
+    containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], "python:3.12", 10, 64, logger, "req-7")
+    containers.drain_reaper(5)
+
+    spans = recorded()
+    names = [s["name"] for s in spans if s["name"].startswith("docker.")]
+
+    assert names == ["docker.create", "docker.put_archive", "docker.start", "docker.logs", "docker.wait",
+                     "docker.inspect", "docker.remove"]
+    assert {s["req"] for s in spans} == {"req-7"}
+    assert {s["image"] for s in spans} == {"python:3.12"}
+    assert all(s["start"] <= s["end"] for s in spans)
+    assert "phase:run" in {s["name"] for s in spans}
+
+
+def test_nothing_is_recorded_outside_a_request():
+    # The warm pool's refills and anything else in the background: no request, no line.
+    with tracing.span("docker.create"):
+        pass
+
+    assert recorded() == []
+
+
+def test_a_call_that_raised_is_recorded_with_the_error(logger):
+    with tracing.context("req-8", "tiivad"):
+        with pytest.raises(containers.docker.errors.APIError):
+            with tracing.span("docker.start"):
+                raise containers.docker.errors.APIError("no")
+
+    assert recorded()[0]["error"] == "APIError"
+
+
+def test_tracing_can_be_turned_off(docker, logger, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_ENABLED", False)
+
+    containers.grade_submission("print(1)", "#!/bin/sh\ntrue", [], "python:3.12", 10, 64, logger, "req-9")
+
+    assert recorded() == []
+
+
+def test_the_file_is_rotated_at_its_size(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_MAX_MB", 1 / 1024)  # a kilobyte
+    monkeypatch.setattr(tracing, "_writer_key", None)
+
+    with tracing.context("req", "tiivad"):
+        for _ in range(30):
+            with tracing.span("docker.start"):
+                pass
+
+    files = glob.glob(os.path.join(tracing.TRACE_DIR, "trace-{}.jsonl*".format(os.getpid())))
+    assert len(files) > 1
+    assert all(os.path.getsize(name) <= 1024 + 200 for name in files)
+
+
+# --- the report ---------------------------------------------------------------------------------
+
+def at(hour, minute):
+    return datetime(2026, 6, 4, hour, minute).timestamp()
+
+
+def span(req, name, start, ms, image="tiivad"):
+    """A span as a trace file holds it, with the `ms` that `load_spans` adds."""
+    return {"req": req, "name": name, "image": image, "start": start, "end": start + ms / 1000, "ms": ms}
+
+
+def write(tmp_path, spans):
+    path = tmp_path / "trace-1.jsonl"
+    path.write_text("".join(json.dumps(s) + "\n" for s in spans))
+    return str(path)
+
+
+def test_percentiles_are_nearest_rank():
+    values = list(range(1, 101))
+
+    assert trace_report.percentile(values, 50) == 50
+    assert trace_report.percentile(values, 99) == 99
+    assert trace_report.percentile([7], 95) == 7
+
+
+def test_a_docker_call_far_slower_than_its_kind_is_an_outlier():
+    spans = [span("r{}".format(n), "docker.start", at(10, 0), 50) for n in range(20)]
+    spans.append(span("slow", "docker.start", at(10, 2), 900))
+
+    outliers = trace_report.find_outliers(spans, factor=5, min_ms=100)
+
+    assert [s["req"] for s in outliers] == ["slow"]
+
+
+def test_the_report_names_the_hour_the_image_and_the_request(tmp_path, capsys):
+    spans = []
+    for n in range(20):
+        spans.append(span("r{}".format(n), "phase:run", at(9, n), 1000))
+        spans.append(span("r{}".format(n), "docker.start", at(9, n), 50))
+    spans.append(span("exam", "phase:create_start", at(10, 2), 3000))
+    spans.append(span("exam", "docker.start", at(10, 2), 3000))
+    path = write(tmp_path, spans)
+
+    assert trace_report.main([path, "--since", "2026-06-04 00:00"]) == 0
+    text = capsys.readouterr().out
+
+    hour_line = next(line for line in text.splitlines() if line.startswith("2026-06-04 10:00"))
+    assert "create_start" in hour_line
+    worst = text.split("Worst Docker calls")[1]
+    assert "exam" in worst and "tiivad" in worst
+
+
+def test_the_time_window_and_the_image_filter_apply(tmp_path):
+    path = write(tmp_path, [span("a", "docker.start", at(9, 0), 10), span("b", "docker.start", at(10, 0), 10),
+                            span("c", "docker.start", at(10, 30), 10, image="silmused")])
+
+    spans, _ = trace_report.load_spans([path], since=at(10, 0), until=at(11, 0), image="tiivad")
+
+    assert [s["req"] for s in spans] == ["b"]
+
+
+def test_a_cut_off_line_is_skipped_rather_than_ending_the_report(tmp_path):
+    path = tmp_path / "trace-1.jsonl"
+    path.write_text(json.dumps(span("a", "docker.start", at(9, 0), 10)) + "\n" + '{"req": "b", "na')
+
+    spans, skipped = trace_report.load_spans([str(path)])
+
+    assert len(spans) == 1 and skipped == 1
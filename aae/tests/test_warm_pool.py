@@ -0,0 +1,223 @@
+# coding=utf-8
+"""The warm container pool: what is claimed, what is refilled, and what is thrown away.
+
+The property worth the most is the last one. A pooled container is created from whatever image the
+bare tag named *at the time*, and a pool that kept handing those out after a retag would grade with
+the library version the host had just stopped advertising — silently, which is how EZ-1781 began.
+
+Docker is faked, and the refill thread is not started: `_refill_warm_pool` is called directly, so
+each test decides exactly when the background work happens.
+"""
+import pytest
+
+import containers
+from conftest import FakeDocker
+
+IMAGE = "silmused"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(containers, "WARM_POOL_SIZE", 2)
+    monkeypatch.setattr(containers, "_start_warm_pool_thread", lambda logger: None)
+    monkeypatch.setenv("EASY_GRADING_IMAGE_NAMES", "silmused,tiivad")
+    return FakeDocker(image_ids={IMAGE: "sha256:old", "tiivad": "sha256:tiivad", "python:3.12": "sha256:py"})
+
+
+def claim(docker, logger, image=IMAGE, mem=64):
+    return containers._claim_container(docker, image, mem, logger, "req-1")
+
+
+def test_the_first_claim_is_a_miss_and_teaches_the_pool_the_key(pool, logger):
+    container = claim(pool, logger)
+
+    assert container.image == IMAGE
+    status = containers.warm_pool_status()
+    assert (status["hits"], status["misses"]) == (0, 1)
+    assert status["pools"][0]["image_name"] == IMAGE
+    assert status["pools"][0]["max_mem_mb"] == 64
+
+
+def test_a_refill_tops_the_pool_up_and_the_next_claim_is_a_hit(pool, logger):
+    claim(pool, logger)
+    containers._refill_warm_pool(pool, logger)
+
+    assert containers.warm_pool_status()["pools"][0]["ready"] == 2
+
+    container = claim(pool, logger)
+
+    assert container in pool.created[1:]
+    status = containers.warm_pool_status()
+    assert (status["hits"], status["misses"]) == (1, 1)
+    assert status["pools"][0]["ready"] == 1
+
+
+def test_pooled_containers_carry_the_limit_and_are_created_by_image_id(pool, logger):
+    # By ID, so a retag halfway through a refill cannot put the new image in the old image's pool.
+    claim(pool, logger, mem=128)
+    containers._refill_warm_pool(pool, logger)
+
+    pooled = pool.created[1:]
+    assert {c.image for c in pooled} == {"sha256:old"}
+    assert {c.kwargs["mem_limit"] for c in pooled} == {"128m"}
+    assert {tuple(c.kwargs["command"]) for c in pooled} == {tuple(containers.GRADING_COMMAND)}
+
+
+def test_a_different_cpu_quota_is_a_different_pool(pool, logger):
+    # The quota is fixed at create time, so a container made for one share of the host cannot be
+    # handed to a run that asked for another.
+    containers._claim_container(pool, IMAGE, 64, logger, "req-1", cpus=1)
+    containers._claim_container(pool, IMAGE, 64, logger, "req-2", cpus=2)
+    containers._refill_warm_pool(pool, logger)
+
+    pools = {p["cpus"]: p["ready"] for p in containers.warm_pool_status()["pools"]}
+    assert pools == {1: 2, 2: 2}
+    assert {c.kwargs["nano_cpus"] for c in pool.created} == {1_000_000_000, 2_000_000_000}
+
+
+def test_a_different_pid_swap_or_tmp_limit_is_a_different_pool(pool, logger):
+    containers._claim_container(pool, IMAGE, 64, logger, "req-1")
+    containers._claim_container(pool, IMAGE, 64, logger, "req-2", limits=containers.run_limits(pids=64, tmp_mb=0))
+    containers._refill_warm_pool(pool, logger)
+
+    pools = {(p["pids"], p["tmp_mb"]): p["ready"] for p in containers.warm_pool_status()["pools"]}
+    assert pools == {(containers.PIDS_LIMIT, containers.TMPFS_MB): 2, (64, 0): 2}
+    assert {c.kwargs["pids_limit"] for c in pool.created} == {containers.PIDS_LIMIT, 64}
+
+
+def test_a_different_memory_limit_is_a_different_pool(pool, logger):
+    claim(pool, logger, mem=64)
+    containers._refill_warm_pool(pool, logger)
+
+    claim(pool, logger, mem=256)
+
+    status = containers.warm_pool_status()
+    assert status["misses"] == 2
+    assert sorted(p["max_mem_mb"] for p in status["pools"]) == [64, 256]
+
+
+def test_a_retagged_image_throws_the_pool_away_on_the_next_claim(pool, logger):
+    claim(pool, logger)
+    containers._refill_warm_pool(pool, logger)
+    pooled = pool.created[1:]
+
+    pool.image_ids[IMAGE] = "sha256:new"
+    container = claim(pool, logger)
+
+    assert container not in pooled, "a container of the superseded image was handed out"
+    status = containers.warm_pool_status()["pools"][0]
+    assert status["image_id"] == "sha256:new"
+    assert status["discarded"] == 2
+
+    # Removed by the thread rather than on the request.
+    assert not any(c.removed for c in pooled)
+    containers._refill_warm_pool(pool, logger)
+    assert all(c.removed for c in pooled)
+
+
+def test_a_request_resolves_its_tag_once_and_the_next_request_again(pool, logger, monkeypatch):
+    # The result cache's key and the claim both need the ID; one request asks the daemon once.
+    monkeypatch.setattr(containers, "shared_docker_client", lambda: pool)
+    asked = []
+    get = pool.images.get
+    monkeypatch.setattr(pool.images, "get", lambda name: asked.append(name) or get(name))
+
+    with containers.resolving_once():
+        assert containers.image_id(IMAGE) == "sha256:old"
+        claim(pool, logger)
+    assert asked == [IMAGE]
+
+    pool.image_ids[IMAGE] = "sha256:new"
+    with containers.resolving_once():
+        assert containers.image_id(IMAGE) == "sha256:new"
+    assert asked == [IMAGE, IMAGE]
+
+
+def test_a_retag_noticed_by_the_refill_thread_also_discards(pool, logger):
+    claim(pool, logger)
+    containers._refill_warm_pool(pool, logger)
+    pooled = pool.created[1:]
+
+    pool.image_ids[IMAGE] = "sha256:new"
+    containers._refill_warm_pool(pool, logger)
+
+    assert all(c.removed for c in pooled)
+    fresh = pool.created[len(pooled) + 1:]
+    assert {c.image for c in fresh} == {"sha256:new"}
+
+
+def test_images_that_are_not_grading_images_are_never_pooled(pool, logger):
+    claim(pool, logger, image="python:3.12")
+    containers._refill_warm_pool(pool, logger)
+
+    assert containers.warm_pool_status()["pools"] == []
+    assert len(pool.created) == 1
+
+
+def test_a_pool_size_of_zero_turns_it_off(pool, logger, monkeypatch):
+    monkeypatch.setattr(containers, "WARM_POOL_SIZE", 0)
+
+    claim(pool, logger)
+    containers._refill_warm_pool(pool, logger)
+
+    assert containers.warm_pool_status()["pools"] == []
+
+
+def test_the_number_of_pools_is_bounded(pool, logger, monkeypatch):
+    # Exercises choose their own memory limit, so the keys come from teachers, not from this host.
+    monkeypatch.setattr(containers, "WARM_POOL_MAX_KEYS", 2)
+    for mem in (64, 128):
+        claim(pool, logger, mem=mem)
+    containers._refill_warm_pool(pool, logger)
+    oldest = [c for c in pool.created[2:] if c.kwargs["mem_limit"] == "64m"]
+
+    claim(pool, logger, mem=256)
+    containers._refill_warm_pool(pool, logger)
+
+    assert sorted(p["max_mem_mb"] for p in containers.warm_pool_status()["pools"]) == [128, 256]
+    assert all(c.removed for c in oldest)
+
+
+def test_exercise_images_cannot_crowd_out_the_base_images(pool, logger, monkeypatch):
+    # One exercise image per exercise: a week of many exercises must not evict the base pools.
+    monkeypatch.setattr(containers, "WARM_POOL_MAX_KEYS", 2)
+    monkeypatch.setattr(containers, "WARM_POOL_MAX_EXERCISE_KEYS", 1)
+    exercises = ["{}:{}".format(containers.EXERCISE_IMAGE_REPO, n) for n in range(3)]
+    for name in exercises:
+        pool.image_ids[name] = "sha256:" + name
+    claim(pool, logger)
+    claim(pool, logger, image="tiivad")
+
+    for name in exercises:
+        claim(pool, logger, image=name)
+
+    assert sorted(p["image_name"] for p in containers.warm_pool_status()["pools"]) == \
+        sorted([IMAGE, "tiivad", exercises[-1]])
+
+
+def test_exercise_images_can_be_left_out_of_the_pool(pool, logger, monkeypatch):
+    monkeypatch.setattr(containers, "WARM_POOL_MAX_EXERCISE_KEYS", 0)
+    name = containers.EXERCISE_IMAGE_REPO + ":abc"
+    pool.image_ids[name] = "sha256:abc"
+
+    claim(pool, logger, image=name)
+
+    assert containers.warm_pool_status()["pools"] == []
+
+
+def test_a_missing_image_fails_the_claim_as_a_cold_create_would(pool, logger):
+    with pytest.raises(containers.docker.errors.ImageNotFound):
+        claim(FakeDocker(), logger)
+
+
+def test_the_pool_endpoint_answers_from_memory(client, monkeypatch):
+    def boom(**kwargs):
+        raise AssertionError("/v1/pool reached the Docker daemon")
+
+    monkeypatch.setattr(containers.docker, "from_env", boom)
+
+    body = client.get("/v1/pool").get_json()
+
+    assert set(body) == {"pid", "size", "max_keys", "max_exercise_keys", "zygote", "hits", "misses", "pools",
+                         "reaper", "orphans", "runtime"}
+    assert body["pools"] == []
@@ -0,0 +1,195 @@
+# coding=utf-8
+"""The zygote: which scripts it runs warm, that a warm run looks like a cold one, and how the pool starts one.
+
+What a student sees must not depend on whether the host has `EASY_ZYGOTE` on. So beyond "the preloaded
+module is there", most of this pins that the edges come out as they would from `/bin/sh` and a fresh
+`python3`: the exit status, a traceback without the zygote's own frames, `Killed` as the last line of a
+SIGKILL, nothing printed by the preload, and anything but the plain form going through the shell.
+
+`zygote.py` runs for real, as a subprocess of this interpreter standing in for the image's. Docker is
+faked for the pool's half.
+"""
+import io
+import os
+import signal
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+import containers
+import zygote
+from conftest import FakeDocker
+
+ZYGOTE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zygote.py")
+
+
+# --- which scripts run warm ---------------------------------------------------------------------
+
+@pytest.mark.parametrize("script, expected", [
+    ("cd student-submission\npython generated_0.py", ("python", "student-submission", "path", "generated_0.py", [])),
+    ("#!/bin/sh\ncd student-submission\npython -m grader.easy",
+     ("python", "student-submission", "module", "grader.easy", [])),
+    ("python3 -u test.py --quiet\n\n", ("python", None, "path", "test.py", ["--quiet"])),
+])
+def test_a_plain_python_script_is_run_warm(script, expected):
+    assert zygote.plan(script) == expected
+
+
+@pytest.mark.parametrize("script", [
+    "cd student-submission\nmv lahendus.py lahendus.sql\nsilmused lahendus.sql tests.py",
+    "cd student-submission\npython3 kontroll.py\nxvfb-run python3 modified.py",
+    "python3 test.py | tee out.txt",
+    "python3 test.py $ARGS",
+    "python3 -c 'print(1)'",
+    "node test.js",
+])
+def test_anything_else_goes_through_the_shell(script):
+    assert zygote.plan(script) == ("sh",)
+
+
+# --- a warm run looks like a cold one -----------------------------------------------------------
+
+@pytest.fixture
+def image(tmp_path):
+    """A directory standing in for the container: a preloadable module, and a place for the script."""
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "preloaded_grader.py").write_text("print('importing, noisily')\n")
+    (tmp_path / "student-submission").mkdir()
+    return tmp_path
+
+
+def run(image, script, grader=None, stdin=b"go\n"):
+    (image / "evaluate.sh").write_text(script)
+    (image / "evaluate.sh").chmod(0o500)
+    if grader is not None:
+        (image / "student-submission" / "grader.py").write_text(grader)
+    env = dict(os.environ, PYTHONPATH=str(image / "lib"))
+    return subprocess.run([sys.executable, ZYGOTE, "preloaded_grader", str(image / "evaluate.sh")], cwd=str(image),
+                          input=stdin, capture_output=True, env=env, timeout=30)
+
+
+def test_the_child_finds_the_grader_imported_and_the_script_where_python_would(image):
+    done = run(image, "cd student-submission\npython3 grader.py first", grader="\n".join([
+        "import os, sys",
+        "print('preloaded_grader' in sys.modules, os.path.basename(os.getcwd()), sys.argv)",
+        "print(os.path.basename(sys.path[0]))",
+    ]))
+
+    assert done.returncode == 0
+    assert done.stdout.decode().splitlines() == ["True student-submission ['grader.py', 'first']",
+                                                 "student-submission"]
+    assert b"noisily" not in done.stdout + done.stderr
+
+
+def test_the_exit_status_is_the_scripts(image):
+    done = run(image, "cd student-submission\npython3 grader.py", grader="import sys; sys.exit(3)")
+
+    assert done.returncode == 3
+
+
+def test_a_crash_is_reported_as_the_interpreter_would(image):
+    done = run(image, "cd student-submission\npython3 grader.py", grader="def f():\n    raise ValueError('nope')\nf()")
+
+    assert done.returncode == 1
+    err = done.stderr.decode()
+    assert "ValueError: nope" in err and 'grader.py", line 3' in err
+    assert "runpy" not in err and "zygote" not in err
+
+
+def test_a_sigkill_ends_with_the_line_the_shell_prints(image):
+    done = run(image, "cd student-submission\npython3 grader.py",
+               grader="import os, signal; print('so far', flush=True); os.kill(os.getpid(), signal.SIGKILL)")
+
+    assert done.returncode == 128 + 9
+    assert done.stdout == b"so far\n"
+    assert done.stderr.endswith(b"Killed\n")
+
+
+def test_a_shell_script_still_runs_through_the_shell(image):
+    done = run(image, "cd student-submission\necho graded | tr g G\nexit 4")
+
+    assert done.returncode == 4
+    assert done.stdout == b"Graded\n"
+
+
+def test_the_shell_gets_the_signals_a_cold_container_would(image):
+    # The interpreter ignores SIGPIPE, and an ignored signal stays ignored across exec: `yes` would
+    # then write "Broken pipe" errors for ever instead of dying when `head` is done.
+    done = run(image, "grep SigIgn /proc/self/status\nyes | head -n 1")
+
+    ignored = int(done.stdout.decode().split()[1], 16)
+    assert not ignored & (1 << (signal.SIGPIPE - 1))
+    assert not ignored & (1 << (signal.SIGXFSZ - 1))
+    assert done.stdout.decode().splitlines()[1:] == ["y"]
+    assert done.stderr == b""
+
+
+def test_what_a_preloaded_module_does_to_signals_does_not_reach_the_child(image):
+    (image / "lib" / "preloaded_grader.py").write_text("import signal\nsignal.signal(signal.SIGTERM, signal.SIG_IGN)\n")
+    done = run(image, "cd student-submission\npython3 grader.py",
+               grader="import signal; print(signal.getsignal(signal.SIGTERM) == signal.SIG_DFL)")
+
+    assert done.stdout == b"True\n"
+
+
+def test_a_zygote_removed_from_the_pool_runs_nothing(image):
+    done = run(image, "echo ran", stdin=b"")
+
+    assert done.returncode == 0
+    assert done.stdout == b""
+
+
+# --- the pool -----------------------------------------------------------------------------------
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(containers, "WARM_POOL_SIZE", 1)
+    monkeypatch.setattr(containers, "ZYGOTE", True)
+    monkeypatch.setattr(containers, "_start_warm_pool_thread", lambda logger: None)
+    monkeypatch.setenv("EASY_GRADING_IMAGE_NAMES", "tiivad")
+
+
+def fake_docker(labels):
+    return FakeDocker(image_ids={"tiivad": "sha256:tiivad"}, image_labels={"tiivad": labels})
+
+
+def test_a_pooled_zygote_is_started_ahead_and_woken_instead_of_started(pool, logger):
+    docker = fake_docker({containers.LABEL_ZYGOTE_PRELOAD: "tiivad"})
+    containers._claim_container(docker, "tiivad", 64, logger, "req-1")
+    containers._refill_warm_pool(docker, logger)
+
+    pooled = docker.created[-1]
+    assert pooled.kwargs["command"] == ["python3", containers.ZYGOTE_PATH, "tiivad"]
+    assert pooled.kwargs["stdin_open"] and pooled.kwargs["mem_limit"] == "64m"
+    assert pooled.started
+    shipped = tarfile.open(fileobj=io.BytesIO(pooled.archives[0]))
+    assert shipped.extractfile("easy-zygote.py").read() == containers.ZYGOTE_SOURCE
+
+    claimed = containers._claim_container(docker, "tiivad", 64, logger, "req-2")
+    pooled.started = False
+    containers.DockerRuntime().start(claimed)
+
+    assert claimed is pooled
+    assert pooled.sent == b"go\n" and not pooled.started
+
+
+@pytest.mark.parametrize("labels", [{}, {containers.LABEL_ZYGOTE_PRELOAD: ""}])
+def test_an_image_that_does_not_ask_for_one_gets_a_plain_pooled_container(pool, logger, labels):
+    docker = fake_docker(labels)
+    containers._claim_container(docker, "tiivad", 64, logger, "req-1")
+    containers._refill_warm_pool(docker, logger)
+
+    pooled = docker.created[-1]
+    assert pooled.kwargs["command"] == containers.GRADING_COMMAND
+    assert not pooled.started
+
+
+def test_no_zygotes_unless_the_host_says_so(pool, logger, monkeypatch):
+    monkeypatch.setattr(containers, "ZYGOTE", False)
+    docker = fake_docker({containers.LABEL_ZYGOTE_PRELOAD: "tiivad"})
+    containers._claim_container(docker, "tiivad", 64, logger, "req-1")
+    containers._refill_warm_pool(docker, logger)
+
+    assert docker.created[-1].kwargs["command"] == containers.GRADING_COMMAND
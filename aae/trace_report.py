@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Reads the executor's trace files and says where grading time went — after the fact.
+
+    python3 trace_report.py /var/log/easy-executor --since "2026-06-04 09:30" --until "2026-06-04 11:00"
+
+The question this exists for is "why was grading slow at 10:02 during the exam", asked the next
+morning. `/v1/metrics` has the host's histograms but not which hour, which image or which Docker call;
+the traces (see `tracing.py`) have all three, one JSON line per span. Five tables:
+
+- **Spans**: every span name, with how many, p50/p90/p99 and the worst, in milliseconds, and how many
+  raised.
+- **Phases**: the `phase:*` spans by the share of all grading time they account for. The first line is
+  where to look.
+- **By image** and **By hour**: requests and their end-to-end time — first span start to last span end
+  — at p50 and p95, with the phase that was slowest at p95. An hour is local time unless `--utc`.
+- **Docker outliers**: Docker calls that took more than `--factor` times the median of their kind
+  (and at least `--min-ms`), counted by image and hour, then the worst few with their request IDs, so
+  that they can be found in the executor's log.
+
+Reads plain files or directories of them, rotated ones included. Runs on the executor host with only
+the standard library, like the rest of aae/.
+"""
+import argparse
+import collections
+import glob
+import json
+import math
+import os
+import sys
+from datetime import datetime, timezone
+
+DEFAULT_TRACE_DIR = os.environ.get("EASY_TRACE_DIR", "/var/log/easy-executor")
+
+
+def load_spans(paths, since=None, until=None, image=None):
+    """Every span in `paths` (files, or directories of `trace-*` files) that started in [since, until)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "trace-*.jsonl*"))))
+        else:
+            files.append(path)
+
+    spans = []
+    skipped = 0
+    for name in files:
+        with open(name, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                    start, end = float(span["start"]), float(span["end"])
+                    span["name"], span["req"]
+                except (ValueError, KeyError, TypeError):
+                    # A line cut short by a crash or by rotation. One bad line is not a reason to
+                    # throw the night's traces away.
+                    skipped += 1
+                    continue
+                if (since is not None and start < since) or (until is not None and start >= until):
+                    continue
+                if image is not None and span.get("image") != image:
+                    continue
+                span["ms"] = (end - start) * 1000
+                spans.append(span)
+    return spans, skipped
+
+
+def percentile(values, p):
+    """Nearest rank: a value that was actually seen, which is what a reader of a latency table expects."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def requests_of(spans):
+    """request ID -> its spans."""
+    by_request = collections.defaultdict(list)
+    for span in spans:
+        by_request[span["req"]].append(span)
+    return by_request
+
+
+def hour_of(timestamp, utc=False):
+    moment = datetime.fromtimestamp(timestamp, timezone.utc if utc else None)
+    return moment.strftime("%Y-%m-%d %H:00")
+
+
+def report(spans, factor=5.0, min_ms=100.0, top=10, utc=False):
+    """The five tables, as text."""
+    if not spans:
+        return "No spans.\n"
+    out = []
+
+    by_name = collections.defaultdict(list)
+    for span in spans:
+        by_name[span["name"]].append(span)
+
+    rows = []
+    for name in sorted(by_name):
+        durations = [s["ms"] for s in by_name[name]]
+        rows.append([name, len(durations), percentile(durations, 50), percentile(durations, 90),
+                     percentile(durations, 99), max(durations), sum(1 for s in by_name[name] if "error" in s)])
+    out += _table("Spans (ms)", ["span", "count", "p50", "p90", "p99", "max", "errors"], rows)
+
+    phases = {name: [s["ms"] for s in group] for name, group in by_name.items() if name.startswith("phase:")}
+    total = sum(sum(durations) for durations in phases.values()) or 1.0
+    rows = [[name[len("phase:"):], "{:.1f}%".format(100 * sum(d) / total), percentile(d, 95), sum(d) / 1000]
+            for name, d in sorted(phases.items(), key=lambda item: -sum(item[1]))]
+    out += _table("Phases, by share of grading time", ["phase", "share", "p95 ms", "total s"], rows)
+
+    grouped_by_image = collections.defaultdict(list)
+    grouped_by_hour = collections.defaultdict(list)
+    for request_spans in requests_of(spans).values():
+        first = min(request_spans, key=lambda s: s["start"])
+        grouped_by_image[first.get("image") or "?"].append(request_spans)
+        grouped_by_hour[hour_of(first["start"], utc)].append(request_spans)
+    out += _table("By image", ["image", "requests", "p50 ms", "p95 ms", "slowest phase at p95"],
+                  [[key] + _summary(group) for key, group in sorted(grouped_by_image.items())])
+    out += _table("By hour" + (" (UTC)" if utc else ""), ["hour", "requests", "p50 ms", "p95 ms",
+                                                          "slowest phase at p95"],
+                  [[key] + _summary(group) for key, group in sorted(grouped_by_hour.items())])
+
+    outliers = find_outliers(spans, factor, min_ms)
+    counts = collections.Counter((s.get("image") or "?", hour_of(s["start"], utc)) for s in outliers)
+    out += _table("Docker outliers (over {:g}x the median and {:g} ms), by image and hour".format(factor, min_ms),
+                  ["image", "hour", "outliers"], [[image, hour, n] for (image, hour), n in sorted(counts.items())])
+    worst = sorted(outliers, key=lambda s: -s["ms"])[:top]
+    out += _table("Worst Docker calls", ["when", "span", "ms", "x median", "image", "request"],
+                  [[datetime.fromtimestamp(s["start"], timezone.utc if utc else None).strftime("%Y-%m-%d %H:%M:%S"),
+                    s["name"], s["ms"], "{:.0f}".format(s["x_median"]), s.get("image") or "?", s["req"]]
+                   for s in worst])
+    return "\n".join(out)
+
+
+def find_outliers(spans, factor, min_ms):
+    """Docker calls slower than `factor` times the median of their kind, and than `min_ms`."""
+    by_name = collections.defaultdict(list)
+    for span in spans:
+        if span["name"].startswith("docker."):
+            by_name[span["name"]].append(span)
+    outliers = []
+    for group in by_name.values():
+        median = percentile([s["ms"] for s in group], 50) or 1e-3
+        for span in group:
+            if span["ms"] >= min_ms and span["ms"] > factor * median:
+                outliers.append(dict(span, x_median=span["ms"] / median))
+    return outliers
+
+
+def _summary(requests):
+    """[requests, p50, p95, slowest phase at p95] for a group of requests' spans."""
+    durations = [(max(s["end"] for s in r) - min(s["start"] for s in r)) * 1000 for r in requests]
+    per_phase = collections.defaultdict(list)
+    for request_spans in requests:
+        totals = collections.Counter()
+        for span in request_spans:
+            if span["name"].startswith("phase:"):
+                totals[span["name"][len("phase:"):]] += span["ms"]
+        for name, ms in totals.items():
+            per_phase[name].append(ms)
+    slowest = max(per_phase.items(), key=lambda item: percentile(item[1], 95), default=("-", []))
+    return [len(requests), percentile(durations, 50), percentile(durations, 95), slowest[0]]
+
+
+def _table(title, header, rows):
+    cells = [[_cell(value) for value in row] for row in rows]
+    widths = [max(len(str(h)), *(len(row[i]) for row in cells)) for i, h in enumerate(header)]
+    lines = [title, "  ".join(h.ljust(w) for h, w in zip(header, widths)).rstrip()]
+    for row in cells:
+        lines.append("  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+    if not rows:
+        lines.append("(none)")
+    return lines + [""]
+
+
+def _cell(value):
+    if isinstance(value, float):
+        return "{:.1f}".format(value)
+    return str(value)
+
+
+def _moment(text):
+    """A command-line time, local unless it says otherwise, as a Unix timestamp."""
+    return datetime.fromisoformat(text).timestamp()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("paths", nargs="*", default=[DEFAULT_TRACE_DIR],
+                   help="trace files or directories (default: {})".format(DEFAULT_TRACE_DIR))
+    p.add_argument("--since", type=_moment, help="e.g. '2026-06-04 09:30', local time")
+    p.add_argument("--until", type=_moment, help="as --since; exclusive")
+    p.add_argument("--image", help="only requests grading on this base image")
+    p.add_argument("--factor", type=float, default=5.0, help="a Docker call this many times its median is an outlier")
+    p.add_argument("--min-ms", type=float, default=100.0, help="and only if it took at least this long")
+    p.add_argument("--top", type=int, default=10, help="worst Docker calls to list")
+    p.add_argument("--utc", action="store_true", help="hours in UTC rather than local time")
+    args = p.parse_args(argv)
+
+    spans, skipped = load_spans(args.paths, args.since, args.until, args.image)
+    sys.stdout.write(report(spans, args.factor, args.min_ms, args.top, args.utc))
+    if skipped:
+        print("{} unreadable lines skipped".format(skipped), file=sys.stderr)
+    return 0 if spans else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
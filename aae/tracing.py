@@ -0,0 +1,134 @@
+# coding=utf-8
+"""Per-submission traces: every Docker call and every phase of a grading run, with when it started and ended.
+
+`/v1/metrics` says that the 95th percentile of container starts went up during an exam; it cannot say
+which submissions were slow, on which image, or whether it was `create` or `start` the daemon sat on.
+A trace can. Each span is one line of JSON:
+
+    {"req": "...", "name": "docker.start", "image": "tiivad", "start": 1760000000.123456,
+     "end": 1760000000.234567, "pid": 4242}
+
+plus `"error"` with the exception's class name when the call raised. `req` is the request ID the
+executor already logs, so a span can be matched with the "Request started" line it belongs to.
+`image` is the base image a teacher chose, never an exercise image's hash tag. `trace_report.py`
+reads the files afterwards and answers "why was grading slow at 10:02".
+
+### What is traced
+
+Spans are recorded only inside a `context()`, which grading opens with its request ID — so the warm
+pool's background refills, which belong to no request, cost nothing and leave no lines. Phases are
+traced where `metrics.py` times them (`phase:run`, ...), and the Docker calls one by one where
+`containers.py` makes them (`docker.put_archive`, ...).
+
+### Cost
+
+One `json.dumps` and one `write` per span, about a dozen spans per run against Docker calls
+that take milliseconds each: cheap enough to leave on, which is the point — the exam is the trace
+worth having and nobody turns tracing on in advance. `EASY_TRACE=0` turns it off.
+
+### Where
+
+One file per process in `TRACE_DIR`, so no two processes ever append to the same file, rotated at
+`TRACE_MAX_MB` with `TRACE_BACKUPS` kept (stdlib `RotatingFileHandler`, which is safe within a
+process and only within one). Files of processes long gone are removed after `TRACE_RETENTION_DAYS`,
+when a process opens its own.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import tempfile
+import threading
+from time import time
+
+TRACE_ENABLED = os.environ.get("EASY_TRACE", "1") != "0"
+TRACE_DIR = os.environ.get("EASY_TRACE_DIR", os.path.join(tempfile.gettempdir(), "easy-traces"))
+TRACE_MAX_MB = float(os.environ.get("EASY_TRACE_MAX_MB", "20"))
+TRACE_BACKUPS = 5
+TRACE_RETENTION_DAYS = 14
+TRACE_FILE_PREFIX = "trace-"
+
+# (request_id, image) while a grading run is being traced, None otherwise.
+_context = contextvars.ContextVar("easy_trace", default=None)
+
+_writer = None
+_writer_key = None
+_writer_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def context(request_id, image_name):
+    """Spans recorded inside the block belong to `request_id`, grading on `image_name`."""
+    token = _context.set((str(request_id), image_name))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Records the block as a span called `name`, if a trace `context()` is open. Raises what it raises."""
+    current = _context.get()
+    if current is None or not TRACE_ENABLED:
+        yield
+        return
+    start = time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _record(current, name, start, time(), error)
+
+
+def _record(current, name, start, end, error):
+    request_id, image_name = current
+    record = {"req": request_id, "name": name, "image": image_name, "start": round(start, 6),
+              "end": round(end, 6), "pid": os.getpid()}
+    if error is not None:
+        record["error"] = error
+    try:
+        _trace_writer().info(json.dumps(record))
+    except (OSError, ValueError):
+        # A full disk must not cost a student their grade.
+        pass
+
+
+def _trace_writer():
+    """This process's logger onto its own rotating file. Reopened if the directory or the pid changed."""
+    global _writer, _writer_key
+
+    key = (TRACE_DIR, os.getpid())
+    with _writer_lock:
+        if _writer_key != key:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            _remove_old_files()
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(TRACE_DIR, "{}{}.jsonl".format(TRACE_FILE_PREFIX, os.getpid())),
+                maxBytes=int(TRACE_MAX_MB * 1024 * 1024), backupCount=TRACE_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            writer = logging.getLogger("easy.trace.{}".format(os.getpid()))
+            writer.propagate = False
+            writer.setLevel(logging.INFO)
+            for old in list(writer.handlers):
+                writer.removeHandler(old)
+                old.close()
+            writer.addHandler(handler)
+            _writer, _writer_key = writer, key
+        return _writer
+
+
+def _remove_old_files():
+    cutoff = time() - TRACE_RETENTION_DAYS * 24 * 60 * 60
+    for name in os.listdir(TRACE_DIR):
+        path = os.path.join(TRACE_DIR, name)
+        try:
+            if name.startswith(TRACE_FILE_PREFIX) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
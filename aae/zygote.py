@@ -0,0 +1,200 @@
+# coding=utf-8
+"""The zygote: a Python process inside a pooled grading container that has already imported the grader.
+
+Not imported by the executor. `containers.py` copies this file into a warm container as
+`/easy-zygote.py` and starts the container with it as the command, so it runs under the *image's*
+Python — 3.10 in the grading images today, which is why nothing here is newer than that.
+
+    python3 /easy-zygote.py tiivad
+
+imports what it is given (comma-separated), with its own output thrown away so an import's warnings
+never reach a student's feedback, and then waits for one line on stdin. The executor sends it once
+the submission's files are in place, in place of starting the container. It then forks one child,
+which runs `/evaluate.sh`, waits for it, and exits as the shell would have: with the child's status,
+or 128 plus the signal that killed it, after printing `Killed` for a SIGKILL — the same last line
+`/bin/sh` prints when the OOM killer takes its child, and the same 137 exit status, which is what the
+executor reads a memory kill from when the runtime has no OOM flag to give.
+
+What makes it faster is how the child runs the script. A script of the form every Python grader's is
+written in,
+
+    cd student-submission
+    python3 generated_0.py
+
+(`python`, `python3` or `python3.N`, a file or `-m module`, plain arguments, an optional `cd` first)
+is run in the child itself, in the interpreter that has the grader imported already: no interpreter
+start and no import of what the zygote preloaded. Anything else — pipes, a second command, a `$` — is
+handed to `/bin/sh` exactly as a cold container would, which costs the fork and nothing else. Either
+way the child first puts every signal back as the zygote found it, and the shell also gets SIGPIPE
+and SIGXFSZ at their defaults, which the interpreter had set to ignored and exec would have kept so.
+
+One container, one child. The container is thrown away after the run like any other, so nothing a
+submission does in its child can reach the next one, and the container's memory and time limits are
+the child's limits — less what the zygote itself holds, which is the preloaded modules. Those pages are
+shared with the child until either writes to them; `gc.freeze` keeps the collector from being the one
+that does.
+"""
+import gc
+import os
+import re
+import runpy
+import shlex
+import signal
+import sys
+import traceback
+
+SCRIPT = "/evaluate.sh"
+INTERPRETER = re.compile(r"^python(3(\.\d+)?)?$")
+# What a plain word can be made of. Anything else in a line means the shell has work to do.
+WORD = re.compile(r"^[A-Za-z0-9_./=:,+@%-]+$")
+
+
+def plan(script_text):
+    """What to run for this script: ("python", cwd, kind, target, args), or ("sh",) for the shell."""
+    lines = [line.strip() for line in script_text.splitlines()]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    cwd = None
+    if lines and lines[0].startswith("cd "):
+        words = _words(lines.pop(0))
+        if words is None or len(words) != 2:
+            return ("sh",)
+        cwd = words[1]
+    if len(lines) != 1:
+        return ("sh",)
+    words = _words(lines[0])
+    if not words or not INTERPRETER.match(words[0]):
+        return ("sh",)
+    words = words[1:]
+    while words and words[0] == "-u":  # unbuffered: the pipe is read as it comes either way
+        words = words[1:]
+    if len(words) >= 2 and words[0] == "-m":
+        return ("python", cwd, "module", words[1], words[2:])
+    if words and not words[0].startswith("-"):
+        return ("python", cwd, "path", words[0], words[1:])
+    return ("sh",)
+
+
+def _words(line):
+    try:
+        words = shlex.split(line)
+    except ValueError:
+        return None
+    if not all(WORD.match(w) for w in words):
+        return None
+    return words
+
+
+def preload(modules):
+    """Imports `modules`, silently. One that fails is left for the child to import, or fail on, itself."""
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        for module in modules:
+            try:
+                __import__(module)
+            except Exception:
+                pass
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (devnull,):
+            os.close(fd)
+
+
+def dispositions():
+    """What every signal this process can catch is set to now, to put back with `restore`."""
+    found = {}
+    for sig in signal.valid_signals():
+        try:
+            found[sig] = signal.getsignal(sig)
+        except (OSError, ValueError):
+            pass
+    return found
+
+
+def restore(found):
+    """Sets every signal back to what `dispositions` found."""
+    for sig, handler in found.items():
+        if handler is None:
+            continue  # set outside Python, and so not changed since
+        try:
+            signal.signal(sig, handler)
+        except (OSError, ValueError):
+            pass
+
+
+def run_child(steps, script, initial=None):
+    """
+    In the child: the script, as `python3` or `/bin/sh` would have run it. Returns the exit status.
+
+    `initial` is the signal dispositions the zygote started with, before anything was preloaded: a
+    grader's import has no business deciding what the student's program does on a signal.
+    """
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)  # as a cold container's: there is nobody to read from
+    os.close(devnull)
+    restore(initial or {})
+    if steps[0] == "sh":
+        # The interpreter ignores SIGPIPE and SIGXFSZ at startup, and an ignored signal stays ignored
+        # across exec. Left so, `yes | head -1` would end in EPIPE errors rather than quietly, and a
+        # file over the size limit would be an error to handle rather than the end of the program.
+        for sig in (signal.SIGPIPE, signal.SIGXFSZ):
+            signal.signal(sig, signal.SIG_DFL)
+        os.execv("/bin/sh", ["/bin/sh", "-c", script])
+
+    _, cwd, kind, target, args = steps
+    if cwd is not None:
+        os.chdir(cwd)
+    try:
+        if kind == "module":
+            sys.argv = [target] + args
+            sys.path[0] = os.getcwd()
+            runpy.run_module(target, run_name="__main__", alter_sys=True)
+        else:
+            sys.argv = [target] + args
+            sys.path[0] = os.path.dirname(os.path.abspath(target))
+            runpy.run_path(target, run_name="__main__")
+    except SystemExit as e:
+        return e.code
+    except BaseException as e:
+        # As the interpreter would print it, without this file's and runpy's frames on top.
+        tb = e.__traceback__
+        while tb is not None and (tb.tb_frame.f_code.co_filename == __file__
+                                  or tb.tb_frame.f_globals.get("__name__") == "runpy"):
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb)
+        return 1
+    return 0
+
+
+def main(argv):
+    initial = dispositions()
+    preload([m for m in (argv[1] if len(argv) > 1 else "").split(",") if m])
+    script = argv[2] if len(argv) > 2 else SCRIPT
+    if not sys.stdin.buffer.readline():
+        return 0  # removed from the pool without being used
+    with open(script) as f:
+        steps = plan(f.read())
+    sys.stdout.flush()
+    sys.stderr.flush()
+    gc.freeze()
+    pid = os.fork()
+    if pid == 0:
+        # SystemExit rather than os._exit, so the child shuts down as an interpreter does: atexit,
+        # threads joined, buffers flushed.
+        sys.exit(run_child(steps, script, initial))
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        if sig == signal.SIGKILL:
+            os.write(2, b"Killed\n")
+        return 128 + sig
+    return os.WEXITSTATUS(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
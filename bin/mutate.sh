@@ -234,15 +234,15 @@ mutate "tsl/property-default-inverted" \
 
 mutate "aae/no-lahendus-py" \
   aae/containers.py \
-  "s/        with open\(os\.path\.join\(student_dir, 'student-submission', 'lahendus\.py'\), mode='w',\n                  encoding='utf-8'\) as submission_file:\n            submission_file\.write\(submission\)\n//" \
-  "'submission.py'" \
+  's/SUBMISSION_FILE_NAMES = \("submission\.py", "lahendus\.py"\)/SUBMISSION_FILE_NAMES = ("submission.py",)/' \
+  'SUBMISSION_FILE_NAMES = ("submission.py",)' \
   'run_aae' \
   'test_the_submission_is_written_under_both_names'
 
 mutate "aae/evaluate-not-executable" \
   aae/containers.py \
-  "s/'evaluate\.sh'\), 0o500\)/'evaluate.sh'), 0o400)/" \
-  '0o400)' \
+  's/"evaluate\.sh", grading_script, 0o500/"evaluate.sh", grading_script, 0o400/' \
+  'grading_script, 0o400' \
   'run_aae' \
   'executable'
 
@@ -262,8 +262,8 @@ mutate "aae/grade-from-first-line" \
 
 mutate "aae/validation-disabled" \
   aae/server.py \
-  's/    if set\(content\.keys\(\)\) != \{/    if False and set(content.keys()) != {/' \
-  'if False and set(content.keys())' \
+  's/    if not REQUIRED_KEYS <= /    if False and not REQUIRED_KEYS <= /' \
+  'if False and not REQUIRED_KEYS' \
   'run_aae' \
   'test_every_field_is_required'
 